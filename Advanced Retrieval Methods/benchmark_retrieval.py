@@ -1,5 +1,6 @@
 # benchmark_retrieval.py
 import time
+import numpy as np
 from typing import Dict, List
 
 
@@ -49,4 +50,96 @@ def benchmark_retrieval_methods(hybrid_rag, test_queries: List[str]):
     for method, data in results.items():
         avg_time = sum(data['times']) / len(data['times'])
         avg_score = sum(data['avg_scores']) / len(data['avg_scores'])
-        print(f"{method.upper():<12} | Avg Time: {avg_time:.4f}s | Avg Score: {avg_score:.3f}")
\ No newline at end of file
+        print(f"{method.upper():<12} | Avg Time: {avg_time:.4f}s | Avg Score: {avg_score:.3f}")
+
+
+def benchmark_query_expansion(query_expansion_rag, test_queries: List[str], top_k: int = 5):
+    """Compare one hybrid_search per expansion with a single batched expanded_search"""
+
+    hybrid_rag = query_expansion_rag.base_rag
+
+    print(f"{'Query':<40} | {'Variants':>8} | {'Looped':>9} | {'Batched':>9}")
+    print("-" * 76)
+
+    for query in test_queries:
+        weighted_queries = query_expansion_rag.expand_query_weighted(query)
+        variants = [variant for variant, _ in weighted_queries]
+        weights = [weight for _, weight in weighted_queries]
+
+        start = time.time()
+        for variant in variants:
+            hybrid_rag.hybrid_search(variant, top_k=top_k * 2)
+        looped_time = time.time() - start
+
+        start = time.time()
+        hybrid_rag.expanded_search(variants, weights=weights, top_k=top_k)
+        batched_time = time.time() - start
+
+        print(f"{query[:40]:<40} | {len(variants):>8} | {looped_time * 1000:>7.1f}ms | {batched_time * 1000:>7.1f}ms")
+
+
+def sweep_alpha(hybrid_rag, labeled_queries: List[Dict], alphas=None, top_k: int = 5,
+                fusions=('weighted',)) -> Dict:
+    """
+    Evaluate many alpha values on a labeled query set with one retrieval pass
+
+    Args:
+        hybrid_rag: HybridRetrievalRAG with documents indexed
+        labeled_queries: [{'query': ..., 'relevance_scores': {doc_id: grade}}]
+        alphas: Dense weights to try (default 0.0 to 1.0 in steps of 0.1)
+        top_k: Cutoff for NDCG and MRR
+        fusions: Any of 'weighted', 'minmax', 'zscore', 'rrf'
+    """
+    alphas = np.round(np.linspace(0.0, 1.0, 11), 2) if alphas is None else np.asarray(alphas)
+
+    # Encode and score all queries once; every alpha reuses these components
+    start = time.time()
+    components = hybrid_rag.score_components([item['query'] for item in labeled_queries])
+    retrieval_time = time.time() - start
+
+    report = {'alphas': [float(a) for a in alphas], 'retrieval_time': retrieval_time}
+
+    for fusion in fusions:
+        start = time.time()
+        ndcg = np.zeros(len(alphas))
+        mrr = np.zeros(len(alphas))
+
+        for item, component in zip(labeled_queries, components):
+            relevance = item.get('relevance_scores', {})
+            order, _ = hybrid_rag.rank_components(component, alphas, top_k, fusion)
+            ids = np.array([hybrid_rag.knowledge_base.chunk_id(row) for row in component['rows']])
+            gains = np.array([[relevance.get(doc_id, 0) for doc_id in ids[positions]]
+                              for positions in order], dtype=float)
+
+            ndcg += _ndcg(gains, sorted(relevance.values(), reverse=True)[:top_k])
+            hits = gains > 0
+            first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, np.inf)
+            mrr += 1.0 / first_hit
+
+        ndcg /= max(len(labeled_queries), 1)
+        mrr /= max(len(labeled_queries), 1)
+        best = int(np.argmax(ndcg))
+
+        report[fusion] = {
+            'ndcg': ndcg.tolist(),
+            'mrr': mrr.tolist(),
+            'best_alpha': float(alphas[best]),
+            'best_ndcg': float(ndcg[best]),
+            'fusion_time': time.time() - start
+        }
+
+        print(f"{fusion.upper():<9} | Best alpha: {alphas[best]:.2f} | NDCG@{top_k}: {ndcg[best]:.3f} "
+              f"| MRR: {mrr[best]:.3f}")
+
+    return report
+
+
+def _ndcg(gains: np.ndarray, ideal_gains: List[float]) -> np.ndarray:
+    """NDCG for each row of graded gains"""
+    discounts = 1.0 / np.log2(np.arange(2, gains.shape[1] + 2))
+    ideal = np.zeros(gains.shape[1])
+    ideal[:len(ideal_gains)] = ideal_gains[:gains.shape[1]]
+    ideal_dcg = (ideal * discounts).sum()
+    if ideal_dcg == 0:
+        return np.zeros(gains.shape[0])
+    return (gains * discounts).sum(axis=1) / ideal_dcg
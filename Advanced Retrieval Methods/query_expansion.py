@@ -1,9 +1,17 @@
 # query_expansion.py - Fixed version
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from synonym_matcher import SynonymMatcher
 
 
 class QueryExpansionRAG:
-    def __init__(self, base_rag_system):
+    def __init__(self, base_rag_system, synonym_path: str = None, bidirectional: bool = False):
+        """
+        Args:
+            base_rag_system: Retrieval system to search with the expanded queries
+            synonym_path: Lexicon file replacing the built-in synonyms
+            bidirectional: Also expand synonyms back to their head term ("time off" -> "vacation");
+                off by default because common synonyms such as "access" or "update" would then fire
+        """
         self.base_rag = base_rag_system
         self.synonyms = {
             'vacation': ['PTO', 'time off', 'leave', 'holiday', 'days off'],
@@ -15,39 +23,52 @@ class QueryExpansionRAG:
             'portal': ['website', 'platform', 'system', 'site'],
             'VPN': ['virtual private network', 'remote access', 'secure connection']
         }
+        # Relative weight of each expansion against the original query
+        self.expansion_weight = 0.8
+        self.max_expansions = 20
 
-    def expand_query(self, query: str) -> List[str]:
-        """Generate multiple query variations"""
-        expanded_queries = [query]
+        # Precompiled trie; a lexicon file replaces the built-in synonyms
+        if synonym_path:
+            self.matcher = SynonymMatcher.from_file(synonym_path, default_weight=self.expansion_weight)
+        else:
+            self.matcher = SynonymMatcher(self.synonyms, default_weight=self.expansion_weight)
 
-        words = query.lower().split()
-        for word in words:
-            if word in self.synonyms:
-                for synonym in self.synonyms[word]:
-                    expanded_query = query.lower().replace(word, synonym)
-                    expanded_queries.append(expanded_query)
+        if bidirectional and not synonym_path:
+            for term, synonyms in self.synonyms.items():
+                for synonym in synonyms:
+                    self.matcher.add(synonym, [term])
 
-        # Remove duplicates
-        seen = set()
-        unique_queries = []
-        for q in expanded_queries:
-            if q not in seen:
-                unique_queries.append(q)
-                seen.add(q)
+    def expand_query(self, query: str) -> List[str]:
+        """Generate multiple query variations"""
+        return [variant for variant, _ in self.expand_query_weighted(query)]
 
-        return unique_queries
+    def expand_query_weighted(self, query: str) -> List[Tuple[str, float]]:
+        """Query variations with their weights, original query first"""
+        return self.matcher.expand(query, max_expansions=self.max_expansions)
 
     def search_with_expansion(self, query: str, top_k: int = 5) -> Dict:
         """Search using multiple query variations - FIXED VERSION"""
 
         try:
             # Generate expanded queries
-            expanded_queries = self.expand_query(query)
+            weighted_queries = self.expand_query_weighted(query)
+            expanded_queries = [variant for variant, _ in weighted_queries]
             print(f"\n🔍 Query Expansion for: '{query}'")
             print(f"📝 Generated {len(expanded_queries)} variations:")
             for i, eq in enumerate(expanded_queries, 1):
                 print(f"   {i}. '{eq}'")
 
+            # One batched search over every variant when the base system supports it
+            if hasattr(self.base_rag, 'expanded_search'):
+                weights = [weight for _, weight in weighted_queries]
+                results = self.base_rag.expanded_search(expanded_queries, weights=weights, top_k=top_k)
+                return {
+                    'original_query': query,
+                    'expanded_queries': expanded_queries,
+                    'results': results,
+                    'total_found': len(results)
+                }
+
             # Collect all results
             all_results = []
 
@@ -0,0 +1,471 @@
+# sharded_retrieval.py
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import os
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing.connection import Listener, Connection, answer_challenge, deliver_challenge
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# Shared secret between coordinator and shard workers; there is deliberately no built-in default
+ENV_AUTHKEY = os.environ.get('SHARD_AUTHKEY', '').encode() or None
+
+
+class ShardIndex:
+    """One partition of the corpus with its own dense and sparse indexes"""
+
+    def __init__(self, embedding_model_name="all-MiniLM-L6-v2"):
+        self.embedding_model = SentenceTransformer(embedding_model_name)
+        self.documents = []
+        self.embeddings = None
+        self.tfidf_vectorizer = None
+        self.tfidf_matrix = None
+
+    def add_documents(self, documents: List[Dict], tfidf_vectorizer: TfidfVectorizer) -> int:
+        """Index this shard's documents with the coordinator's fitted vectorizer"""
+        self.documents = documents
+        texts = [doc['text'] for doc in documents]
+
+        if not texts:
+            self.embeddings = None
+            self.tfidf_matrix = None
+            return 0
+
+        # Unit-normalize once so a dot product is the cosine similarity
+        embeddings = np.asarray(self.embedding_model.encode(texts), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.maximum(norms, 1e-12)
+
+        # Shared vocabulary and IDF keep sparse scores comparable across shards
+        self.tfidf_vectorizer = tfidf_vectorizer
+        self.tfidf_matrix = tfidf_vectorizer.transform(texts)
+
+        return len(documents)
+
+    def search(self, query: str, top_k: int = 20) -> Dict:
+        """Local dense and sparse top-k for one query"""
+        if self.embeddings is None:
+            return {'dense': [], 'sparse': []}
+
+        query_embedding = np.asarray(self.embedding_model.encode([query])[0], dtype=np.float32)
+        query_embedding /= max(np.linalg.norm(query_embedding), 1e-12)
+        dense_scores = self.embeddings @ query_embedding
+
+        query_vector = self.tfidf_vectorizer.transform([query])
+        sparse_scores = (self.tfidf_matrix @ query_vector.T).toarray().ravel()
+
+        dense = [(self.documents[idx], float(dense_scores[idx]))
+                 for idx in _top_indices(dense_scores, top_k)]
+        sparse = [(self.documents[idx], float(sparse_scores[idx]))
+                  for idx in _top_indices(sparse_scores, top_k)
+                  if sparse_scores[idx] > 0]  # Only include non-zero similarities
+
+        return {'dense': dense, 'sparse': sparse}
+
+
+def _top_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k scores, best first"""
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, top_k)[:top_k]
+    return top[np.argsort(-scores[top])]
+
+
+def serve_shard(address: Tuple[str, int], authkey: bytes = None,
+                embedding_model_name: str = "all-MiniLM-L6-v2", ready_queue=None):
+    """
+    Run a shard worker until a coordinator sends 'shutdown'
+
+    Messages are pickled, and unpickling runs arbitrary code, so every
+    peer that passes the authkey handshake is fully trusted. The key must
+    therefore be a secret: it comes from authkey or SHARD_AUTHKEY, and the
+    worker refuses to start without one.
+    """
+    authkey = authkey or ENV_AUTHKEY
+    if not authkey:
+        raise ValueError(f"Refusing to listen on {address[0]}:{address[1]} without an authkey; "
+                         "set SHARD_AUTHKEY to a shared secret")
+
+    with Listener(address, authkey=authkey) as listener:
+        if ready_queue is not None:
+            ready_queue.put((os.getpid(), listener.address))
+
+        shard = ShardIndex(embedding_model_name)
+        print(f"✅ Shard listening on {listener.address[0]}:{listener.address[1]}")
+
+        running = True
+        while running:
+            with listener.accept() as conn:
+                running = _handle_connection(shard, conn)
+
+
+def _handle_connection(shard: ShardIndex, conn) -> bool:
+    """Answer requests on one coordinator connection; False means shut down"""
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return True
+
+        op = message.get('op')
+        reply = {'request_id': message.get('request_id'), 'ok': True}
+
+        try:
+            if op == 'index':
+                reply['result'] = shard.add_documents(message['documents'], message['vectorizer'])
+            elif op == 'search':
+                start_time = time.perf_counter()
+                reply['result'] = shard.search(message['query'], top_k=message['top_k'])
+                reply['search_time'] = time.perf_counter() - start_time
+            elif op == 'ping':
+                reply['result'] = len(shard.documents)
+            elif op == 'shutdown':
+                _send_reply(conn, reply)
+                return False
+            else:
+                raise ValueError(f"Unknown shard op: {op}")
+        except Exception as e:
+            reply = {'request_id': message.get('request_id'), 'ok': False, 'error': str(e)}
+
+        if not _send_reply(conn, reply):
+            return True
+
+
+def _send_reply(conn, reply: Dict) -> bool:
+    """Send a reply; False when the coordinator has already hung up (e.g. after timing out)"""
+    try:
+        conn.send(reply)
+        return True
+    except (EOFError, OSError):  # BrokenPipeError and ConnectionResetError are OSErrors
+        return False
+
+
+def _connect(address: Tuple[str, int], authkey: bytes, timeout: Optional[float]) -> Connection:
+    """multiprocessing Client with the TCP connect and the authkey handshake bounded by timeout"""
+    sock = socket.create_connection(address, timeout=timeout)
+    sock.setblocking(True)  # Connection reads the raw descriptor
+    conn = Connection(sock.detach())
+
+    try:
+        # The listener sends its challenge first; a shard that accepted but never answers times out here
+        if not conn.poll(timeout):
+            raise TimeoutError(f"Shard {address} did not answer the handshake")
+        answer_challenge(conn, authkey)
+        deliver_challenge(conn, authkey)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+class ShardClient:
+    """Coordinator-side connection to one shard worker"""
+
+    def __init__(self, address: Tuple[str, int], authkey: bytes):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.conn = None
+        self.lock = threading.Lock()
+        self._request_ids = itertools.count()
+
+    def call(self, message: Dict, timeout: Optional[float] = None):
+        """Send one request and wait for its reply, skipping stale replies"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        if not self.lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Shard {self.address} busy")
+
+        try:
+            if self.conn is None:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0.001)
+                self.conn = _connect(self.address, self.authkey, remaining)
+
+            request_id = next(self._request_ids)
+            self.conn.send({**message, 'request_id': request_id})
+
+            while True:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+                if not self.conn.poll(remaining):
+                    raise TimeoutError(f"Shard {self.address} timed out")
+
+                reply = self.conn.recv()
+                # Replies to requests that already timed out arrive late; drop them
+                if reply.get('request_id') != request_id:
+                    continue
+
+                if not reply.get('ok'):
+                    raise RuntimeError(reply.get('error', 'shard error'))
+                return reply
+
+        except (EOFError, OSError):  # Includes timeouts; the connection may hold a late reply
+            self.close()
+            raise
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+
+
+class ShardedHybridRetrievalRAG:
+    """
+    Scatter-gather hybrid retrieval over shard worker processes
+
+    Coordinator and shards exchange pickles, so they must trust each other:
+    anyone holding the authkey can run code on a shard (see serve_shard).
+    """
+
+    def __init__(self, shard_addresses: List[Tuple[str, int]], authkey: bytes = None,
+                 timeout: float = 2.0, candidate_k: int = 20):
+        """
+        Args:
+            shard_addresses: (host, port) of each shard worker, local or remote
+            authkey: Shared secret used by the shard workers (default: SHARD_AUTHKEY)
+            timeout: Seconds to wait for shards, connecting included, before returning partial results
+            candidate_k: Dense and sparse candidates each shard returns per query
+        """
+        authkey = authkey or ENV_AUTHKEY
+        if not authkey:
+            raise ValueError("No shard authkey; pass authkey or set SHARD_AUTHKEY")
+
+        self.shards = [ShardClient(address, authkey) for address in shard_addresses]
+        self.timeout = timeout
+        self.candidate_k = candidate_k
+        self.pool = ThreadPoolExecutor(max_workers=max(len(self.shards), 1))
+        self.processes = []
+
+        # Fitted here on the full corpus and shipped to every shard
+        self.tfidf_vectorizer = TfidfVectorizer(
+            max_features=5000,
+            stop_words='english',
+            ngram_range=(1, 2)  # Include bigrams
+        )
+        self.is_fitted = False
+        # Fingerprint of the indexed content; result caches key on it
+        self.index_version = None
+
+    @classmethod
+    def start_local(cls, num_shards: int, embedding_model_name: str = "all-MiniLM-L6-v2",
+                    host: str = '127.0.0.1', **kwargs) -> 'ShardedHybridRetrievalRAG':
+        """
+        Spawn num_shards worker processes on this machine and connect to them
+
+        Without an authkey (argument or SHARD_AUTHKEY) the pool uses a random
+        key that only this coordinator and its workers know.
+        """
+        ctx = mp.get_context('spawn')
+        ready_queue = ctx.Queue()
+        authkey = kwargs['authkey'] = kwargs.get('authkey') or ENV_AUTHKEY or os.urandom(32)
+
+        processes = []
+        for _ in range(num_shards):
+            process = ctx.Process(
+                target=serve_shard,
+                args=((host, 0), authkey, embedding_model_name, ready_queue),
+                daemon=True
+            )
+            process.start()
+            processes.append(process)
+
+        # Workers report in any order; keep addresses aligned with processes
+        ready = dict(ready_queue.get(timeout=60) for _ in processes)
+        addresses = [ready[process.pid] for process in processes]
+
+        rag = cls(addresses, **kwargs)
+        rag.processes = processes
+        return rag
+
+    def shard_for(self, doc: Dict) -> int:
+        """Stable shard assignment by document id"""
+        return zlib.crc32(str(doc['id']).encode()) % len(self.shards)
+
+    def add_documents(self, documents: List[Dict]):
+        """Fit global TF-IDF statistics, then partition and index on the shards"""
+        texts = [doc['text'] for doc in documents]
+        self.tfidf_vectorizer.fit(texts)
+        self.is_fitted = True
+
+        partitions = [[] for _ in self.shards]
+        for doc in documents:
+            shard_doc = {k: v for k, v in doc.items() if k != 'dense_embedding'}
+            partitions[self.shard_for(doc)].append(shard_doc)
+
+        print(f"🔄 Indexing {len(documents)} documents across {len(self.shards)} shards...")
+        futures = [
+            self.pool.submit(shard.call, {
+                'op': 'index',
+                'documents': partition,
+                'vectorizer': self.tfidf_vectorizer
+            })
+            for shard, partition in zip(self.shards, partitions)
+        ]
+        counts = [future.result()['result'] for future in futures]
+
+        digest = hashlib.blake2b(digest_size=16)
+        for doc in documents:
+            fields = [doc.get('id'), doc['text'], doc.get('source'), doc.get('doc_type')]
+            digest.update(json.dumps(fields, default=str).encode('utf-8'))
+        self.index_version = digest.hexdigest()
+
+        print(f"✅ Indexed {sum(counts)} documents (per shard: {counts})")
+
+    def scatter_gather(self, query: str, top_k: int = 5, alpha: float = 0.7,
+                       timeout: float = None) -> Dict:
+        """
+        Query every shard in parallel and merge whatever returns in time
+
+        Args:
+            query: Search query
+            top_k: Number of results to return
+            alpha: Weight for dense search (0.0 = only sparse, 1.0 = only dense)
+            timeout: Overrides the default shard timeout for this query
+        """
+        if not self.is_fitted:
+            return {'results': [], 'shards_ok': [], 'shards_failed': {}, 'partial': False}
+
+        timeout = self.timeout if timeout is None else timeout
+        start_time = time.perf_counter()
+        deadline = time.monotonic() + timeout
+
+        futures = [
+            self.pool.submit(shard.call, {'op': 'search', 'query': query, 'top_k': self.candidate_k},
+                             timeout)
+            for shard in self.shards
+        ]
+
+        dense_results, sparse_results = [], []
+        shards_ok, shards_failed, shard_times = [], {}, {}
+
+        for shard_id, future in enumerate(futures):
+            try:
+                # One deadline for the whole query, however many shards are slow
+                reply = future.result(timeout=max(deadline - time.monotonic(), 0.0))
+            except FutureTimeoutError:
+                future.cancel()
+                shards_failed[shard_id] = f"TimeoutError: no reply within {timeout}s"
+                continue
+            except Exception as e:
+                shards_failed[shard_id] = f"{type(e).__name__}: {e}"
+                continue
+
+            shards_ok.append(shard_id)
+            shard_times[shard_id] = reply['search_time']
+            dense_results.extend(reply['result']['dense'])
+            sparse_results.extend(reply['result']['sparse'])
+
+        # Global top candidates per side; identical to a single-node index (ties broken by id)
+        dense_results.sort(key=lambda x: (-x[1], str(x[0]['id'])))
+        sparse_results.sort(key=lambda x: (-x[1], str(x[0]['id'])))
+
+        results = self._fuse(dense_results[:self.candidate_k], sparse_results[:self.candidate_k],
+                             top_k, alpha)
+
+        return {
+            'results': results,
+            'shards_ok': shards_ok,
+            'shards_failed': shards_failed,
+            'partial': bool(shards_failed),
+            'shard_times': shard_times,
+            'total_time': time.perf_counter() - start_time
+        }
+
+    def hybrid_search(self, query: str, top_k: int = 5, alpha: float = 0.7) -> List[Dict]:
+        """Drop-in replacement for HybridRetrievalRAG.hybrid_search"""
+        return self.scatter_gather(query, top_k=top_k, alpha=alpha)['results']
+
+    def _fuse(self, dense_results: List[Tuple[Dict, float]], sparse_results: List[Tuple[Dict, float]],
+              top_k: int, alpha: float) -> List[Dict]:
+        """Weighted dense/sparse combination, same as HybridRetrievalRAG.hybrid_search"""
+        combined_scores = {}
+
+        for doc, score in dense_results:
+            combined_scores[doc['id']] = {
+                'doc': doc,
+                'dense_score': score,
+                'sparse_score': 0.0,
+                'combined_score': alpha * score
+            }
+
+        for doc, score in sparse_results:
+            doc_id = doc['id']
+            if doc_id in combined_scores:
+                combined_scores[doc_id]['sparse_score'] = score
+                combined_scores[doc_id]['combined_score'] += (1 - alpha) * score
+            else:
+                combined_scores[doc_id] = {
+                    'doc': doc,
+                    'dense_score': 0.0,
+                    'sparse_score': score,
+                    'combined_score': (1 - alpha) * score
+                }
+
+        # Ties broken by id, as in HybridRetrievalRAG, so both rank equal scores alike
+        sorted_results = sorted(
+            combined_scores.values(),
+            key=lambda x: (-x['combined_score'], str(x['doc']['id']))
+        )
+
+        final_results = []
+        for result in sorted_results[:top_k]:
+            final_results.append({
+                'id': result['doc']['id'],
+                'text': result['doc']['text'],
+                'source': result['doc']['source'],
+                'doc_type': result['doc']['doc_type'],
+                'dense_score': float(result['dense_score']),
+                'sparse_score': float(result['sparse_score']),
+                'combined_score': float(result['combined_score'])
+            })
+
+        return final_results
+
+    def close(self):
+        """Shut down shard workers this coordinator started and drop connections"""
+        for shard in self.shards:
+            if self.processes:
+                try:
+                    shard.call({'op': 'shutdown'}, timeout=self.timeout)
+                except Exception:
+                    pass
+            shard.close()
+
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        self.processes = []
+        self.pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    # Run a shard worker on another host:
+    #   SHARD_AUTHKEY=secret python sharded_retrieval.py --host 0.0.0.0 --port 6001
+    parser = argparse.ArgumentParser(description="Hybrid retrieval shard worker")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6001)
+    parser.add_argument('--model', default="all-MiniLM-L6-v2")
+    args = parser.parse_args()
+
+    serve_shard((args.host, args.port), embedding_model_name=args.model)
@@ -0,0 +1,192 @@
+# synonym_matcher.py
+import json
+import re
+import time
+from typing import List, Dict, Tuple, Optional
+
+# Trie key holding a phrase's expansions; tokens are never empty so it cannot clash
+_TERMINAL = ''
+
+
+class SynonymMatcher:
+    """
+    Token trie over a synonym lexicon
+
+    Triggers may span several words ("time off") and are matched
+    case-insensitively on whole tokens, so "pto" never fires inside
+    "laptop". Matching walks the query tokens once, taking the longest
+    trigger at each position; the cost depends on the query length and the
+    longest trigger, not on the lexicon size.
+    """
+
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, synonyms: Dict[str, List] = None, default_weight: float = 0.8):
+        """
+        Args:
+            synonyms: {trigger: [expansion, ...]}; an expansion may also be an
+                (expansion, weight) pair
+            default_weight: Weight of expansions given without one
+        """
+        self.default_weight = default_weight
+        self.root = {}
+        self.num_entries = 0
+        self.max_trigger_tokens = 0
+
+        for trigger, expansions in (synonyms or {}).items():
+            self.add(trigger, expansions)
+
+    def tokenize(self, text: str) -> List[Tuple[str, int, int]]:
+        """Lowercased tokens with their character spans"""
+        return [(m.group().lower(), m.start(), m.end()) for m in self.TOKEN_PATTERN.finditer(text)]
+
+    def add(self, trigger: str, expansions: List):
+        """Add expansions for a trigger phrase, merging with any already present"""
+        tokens = [token for token, _, _ in self.tokenize(trigger)]
+        if not tokens:
+            return
+
+        node = self.root
+        for token in tokens:
+            node = node.setdefault(token, {})
+
+        if _TERMINAL not in node:
+            node[_TERMINAL] = {}
+            self.num_entries += 1
+        self.max_trigger_tokens = max(self.max_trigger_tokens, len(tokens))
+
+        for expansion in expansions:
+            text, weight = expansion if isinstance(expansion, (list, tuple)) else (expansion, self.default_weight)
+            # Keep the strongest weight when an expansion is listed twice
+            node[_TERMINAL][text] = max(weight, node[_TERMINAL].get(text, 0.0))
+
+    @classmethod
+    def from_file(cls, path: str, default_weight: float = 0.8) -> 'SynonymMatcher':
+        """
+        Load a lexicon file
+
+        JSON files hold {trigger: [expansion, ...]}. Any other file is read as
+        one entry per line: "trigger<TAB>expansion, expansion|0.6, ...", where
+        an optional "|weight" suffix overrides the default weight and lines
+        starting with '#' are comments.
+        """
+        matcher = cls(default_weight=default_weight)
+
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.json'):
+                for trigger, expansions in json.load(f).items():
+                    matcher.add(trigger, expansions)
+                return matcher
+
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '\t' not in line:
+                    continue
+
+                trigger, expansion_list = line.split('\t', 1)
+                expansions = []
+                for item in expansion_list.split(','):
+                    text, _, weight = item.strip().partition('|')
+                    if text:
+                        expansions.append((text, float(weight) if weight else default_weight))
+                matcher.add(trigger, expansions)
+
+        return matcher
+
+    def find(self, query: str) -> List[Dict]:
+        """Non-overlapping longest trigger matches, left to right"""
+        tokens = self.tokenize(query)
+        matches = []
+        i = 0
+
+        while i < len(tokens):
+            node = self.root
+            longest = None
+
+            for j in range(i, min(i + self.max_trigger_tokens, len(tokens))):
+                node = node.get(tokens[j][0])
+                if node is None:
+                    break
+                if _TERMINAL in node:
+                    longest = (j, node[_TERMINAL])
+
+            if longest is None:
+                i += 1
+                continue
+
+            end, expansions = longest
+            matches.append({
+                'start': tokens[i][1],
+                'end': tokens[end][2],
+                'trigger': query[tokens[i][1]:tokens[end][2]],
+                'expansions': expansions
+            })
+            i = end + 1
+
+        return matches
+
+    def expand(self, query: str, max_expansions: int = 20) -> List[Tuple[str, float]]:
+        """
+        Weighted query variants, original first
+
+        Each variant swaps exactly one matched trigger for one of its
+        expansions, so the number of variants grows with the number of
+        synonyms rather than their product. The strongest max_expansions
+        variants are kept.
+        """
+        variants = {}
+
+        for match in self.find(query):
+            prefix, suffix = query[:match['start']], query[match['end']:]
+            for expansion, weight in match['expansions'].items():
+                variant = prefix + expansion + suffix
+                if variant != query and weight > variants.get(variant, 0.0):
+                    variants[variant] = weight
+
+        ranked = sorted(variants.items(), key=lambda item: item[1], reverse=True)
+        return [(query, 1.0)] + ranked[:max_expansions]
+
+    def __len__(self):
+        return self.num_entries
+
+
+def benchmark_lexicon_sizes(sizes=(100, 10000, 100000), queries: Optional[List[str]] = None,
+                            repeats: int = 1000) -> Dict[int, float]:
+    """Queries per second against synthetic lexicons of increasing size"""
+    queries = queries or [
+        "How much time off do I get for vacation?",
+        "How do I reset my VPN password on the laptop?",
+        "What is the remote access policy for new employees?"
+    ]
+    throughput = {}
+
+    for size in sizes:
+        synonyms = {f"term{i} phrase{i % 97}": [f"alt{i}", f"other{i}"] for i in range(size)}
+        synonyms.update({'time off': ['vacation'], 'vpn': ['remote access'], 'password': ['credentials']})
+        matcher = SynonymMatcher(synonyms)
+
+        start = time.time()
+        for _ in range(repeats):
+            for query in queries:
+                matcher.expand(query)
+        elapsed = time.time() - start
+
+        throughput[size] = repeats * len(queries) / elapsed
+        print(f"📚 {len(matcher):>7} entries | {throughput[size]:,.0f} queries/sec")
+
+    return throughput
+
+
+if __name__ == "__main__":
+    matcher = SynonymMatcher({
+        'time off': ['vacation', 'PTO'],
+        'VPN': ['virtual private network', ('remote access', 0.9)],
+        'pto': ['paid time off']
+    })
+    for query in ["How much time off do I get?", "Laptop VPN setup", "Is PTO carried over?"]:
+        print(f"\n🔍 '{query}'")
+        for variant, weight in matcher.expand(query):
+            print(f"   {weight:.2f}  {variant}")
+
+    print()
+    benchmark_lexicon_sizes()
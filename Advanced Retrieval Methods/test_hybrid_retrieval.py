@@ -1,6 +1,12 @@
 # test_hybrid_retrieval_fixed.py
+import numpy as np
+import pytest
+
 from hybrid_retrieval_system import HybridRetrievalRAG
 from query_expansion import QueryExpansionRAG
+from benchmark_retrieval import sweep_alpha
+from synonym_matcher import SynonymMatcher
+from chunk_store import ChunkStore, CompressedTextStore
 
 
 def test_retrieval_methods():
@@ -184,20 +190,250 @@ def test_alpha_tuning():
     # Test query
     query = "PTO portal advance notice"
 
-    # Test different alpha values
+    # Test different alpha values (one retrieval pass for all of them)
     alpha_values = [0.0, 0.3, 0.5, 0.7, 1.0]
+    rankings = hybrid_rag.multi_alpha_search(query, alphas=alpha_values, top_k=2)
 
     for alpha in alpha_values:
         print(
             f"\n🎯 Alpha = {alpha} ({'Pure Sparse' if alpha == 0 else 'Pure Dense' if alpha == 1 else f'{int(alpha * 100)}% Dense, {int((1 - alpha) * 100)}% Sparse'})")
-        results = hybrid_rag.hybrid_search(query, top_k=2, alpha=alpha)
+        results = rankings['weighted'][alpha]
+
+        # One pass for every alpha ranks the same as a hybrid_search per alpha
+        expected = hybrid_rag.hybrid_search(query, top_k=2, alpha=alpha)
+        assert [r['id'] for r in results] == [r['id'] for r in expected]
+        assert [r['combined_score'] for r in results] == pytest.approx(
+            [r['combined_score'] for r in expected])
 
         for i, result in enumerate(results, 1):
             print(f"   {i}. Combined: {result['combined_score']:.3f} "
                   f"(D: {result['dense_score']:.3f}, S: {result['sparse_score']:.3f})")
             print(f"      Text: {result['text'][:60]}...")
 
+    # Sweep alpha over a small labeled set
+    print(f"\n📊 ALPHA SWEEP (labeled queries)")
+    labeled_queries = [
+        {'query': 'PTO portal advance notice', 'relevance_scores': {'hr_002': 2}},
+        {'query': 'How many vacation days do I get?', 'relevance_scores': {'hr_001': 2}}
+    ]
+    sweep_alpha(hybrid_rag, labeled_queries, top_k=2, fusions=('weighted', 'minmax', 'rrf'))
+
+
+def test_synonym_matching():
+    """Multi-word triggers, case and whole-token matching"""
+
+    print(f"\n{'=' * 80}")
+    print("🧪 TESTING SYNONYM MATCHER")
+    print("=" * 80)
+
+    matcher = SynonymMatcher({
+        'time off': ['vacation'],
+        'VPN': ['remote access'],
+        'pto': ['paid time off']
+    })
+
+    checks = [
+        ("How much time off do I get?", "How much vacation do I get?"),
+        ("Set up the vpn", "Set up the remote access"),
+        ("My laptop is slow", None)
+    ]
+
+    for query, expected in checks:
+        variants = [variant for variant, _ in matcher.expand(query)][1:]
+        print(f"'{query}' -> {variants}")
+        assert variants == ([expected] if expected else [])
+
+    # Synonyms lead back to their head term only when asked to
+    assert QueryExpansionRAG(None).expand_query("Request access to the system") == ["Request access to the system"]
+    assert "vacation" in " ".join(QueryExpansionRAG(None, bidirectional=True).expand_query("time off"))
+
+
+def test_chunk_store_row_of_after_skipped_chunk():
+    """Chunk ids stay resolvable when a document's chunk_index has gaps"""
+    store = ChunkStore()
+    for chunk_index in (0, 2, 3):  # Chunk 1 failed to embed and was skipped
+        store.append(f"first document chunk {chunk_index}", 'Handbook', 'policy',
+                     document_id='handbook', chunk_index=chunk_index)
+    for chunk_index in (0, 1):
+        store.append(f"second document chunk {chunk_index}", 'FAQ', 'faq',
+                     document_id='faq', chunk_index=chunk_index)
+
+    for row in range(len(store)):
+        assert store.row_of(store.chunk_id(row)) == row
+    assert store.row_of('handbook_chunk_1') is None
+    assert store[2]['text'] == 'first document chunk 3'
+    # Contiguous documents still derive their ids instead of storing them
+    assert set(store.explicit_ids) == {1, 2}
+
+
+def test_reindexing_closes_replaced_chunk_store():
+    """add_documents closes the text file of the store it replaces"""
+    hybrid_rag = HybridRetrievalRAG()
+    initial_store = hybrid_rag.knowledge_base
+
+    documents = [{'id': 'hr_001', 'text': 'New employees get 15 vacation days.', 'source': 'HR', 'doc_type': 'policy'}]
+    hybrid_rag.add_documents(documents)
+    indexed_store = hybrid_rag.knowledge_base
+    hybrid_rag.add_documents(documents)
+
+    assert initial_store.texts.file.closed
+    assert indexed_store.texts.file.closed
+    assert not hybrid_rag.knowledge_base.texts.file.closed
+
+    with ChunkStore() as store:
+        store.append('text', 'HR', 'policy')
+    assert store.texts.file.closed
+    store.close()  # Closing twice is harmless
+
+
+FILTER_DOCUMENTS = [
+    {'id': 'hr_001', 'text': 'Employees receive 15 vacation days per year.', 'source': 'HR_Policy', 'doc_type': 'policy'},
+    {'id': 'hr_002', 'text': 'Vacation requests need two weeks notice.', 'source': 'HR_FAQ', 'doc_type': 'faq'},
+    {'id': 'it_001', 'text': 'Reset your password through the IT portal.', 'source': 'IT_FAQ', 'doc_type': 'faq'},
+    {'id': 'it_002', 'text': 'VPN access requires a company laptop.', 'source': 'IT_Policy', 'doc_type': 'policy'},
+    {'id': 'fin_001', 'text': 'Submit expense receipts within 30 days.', 'source': 'Finance_Guide', 'doc_type': 'guide'}
+]
+
+
+def test_metadata_filters_are_applied_before_scoring():
+    """Filtered searches only see matching rows, whichever scoring path the filter takes"""
+    hybrid_rag = HybridRetrievalRAG()
+    hybrid_rag.add_documents(FILTER_DOCUMENTS)
+    query = 'vacation days notice'
+
+    faq = hybrid_rag.hybrid_search(query, top_k=5, filter_by={'doc_type': 'faq'})
+    assert {r['id'] for r in faq} == {'hr_002', 'it_001'}
+
+    either = hybrid_rag.hybrid_search(query, top_k=5, filter_by={'doc_type': ['faq', 'guide']})
+    assert {r['doc_type'] for r in either} == {'faq', 'guide'}
+
+    both = hybrid_rag.hybrid_search(query, top_k=5, filter_by={'doc_type': 'policy', 'source': 'HR_Policy'})
+    assert [r['id'] for r in both] == ['hr_001']
+
+    assert hybrid_rag.hybrid_search(query, filter_by={'doc_type': 'memo'}) == []
+    assert [doc['id'] for doc, _ in hybrid_rag.sparse_search(query, filter_by={'doc_type': 'faq'})] == ['hr_002']
+
+    # Scoring only the matching rows ranks the same as scoring all rows and selecting
+    hybrid_rag.selective_filter_ratio = 1.0
+    selective = hybrid_rag.hybrid_search(query, top_k=5, filter_by={'doc_type': 'faq'})
+    hybrid_rag.selective_filter_ratio = 0.0
+    broad = hybrid_rag.hybrid_search(query, top_k=5, filter_by={'doc_type': 'faq'})
+    assert [r['id'] for r in selective] == [r['id'] for r in broad]
+    assert [r['combined_score'] for r in selective] == pytest.approx([r['combined_score'] for r in broad])
+
+
+def test_adaptive_depth_decisions():
+    """Adaptive search stops early, skips the sparse pass or widens, and logs why"""
+    hybrid_rag = HybridRetrievalRAG()
+    hybrid_rag.add_documents(FILTER_DOCUMENTS)
+    hybrid_rag.candidate_config.update({'adaptive': True, 'max_k': 4})
+
+    # No query term is in the TF-IDF vocabulary
+    assert hybrid_rag.hybrid_search('zebra quartz', top_k=2)
+    # Any dense lead counts as decisive
+    hybrid_rag.candidate_config['winner_gap'] = 0.0
+    hybrid_rag.hybrid_search('vacation days notice', top_k=2)
+    # Lists never overlap enough, so depth doubles up to max_k
+    hybrid_rag.candidate_config.update({'winner_gap': 10.0, 'min_overlap': 1.1})
+    widened = hybrid_rag.hybrid_search('vacation days notice', top_k=1, dense_k=1, sparse_k=1)
+    # Explicitly fixed depth
+    hybrid_rag.hybrid_search('vacation days notice', top_k=2, adaptive=False)
+
+    log = list(hybrid_rag.depth_log)
+    assert [entry['decision'] for entry in log] == ['no_sparse_terms', 'early_stop', 'widened', 'fixed']
+    assert log[0]['sparse_k'] == 0
+    assert (log[1]['dense_k'], log[1]['sparse_k']) == (2, 0)
+    assert (log[2]['dense_k'], log[2]['sparse_k']) == (4, 4)
+    assert log[2]['candidates'] >= 4
+    assert len(widened) == 1
+    assert hybrid_rag.get_depth_stats()['decisions'] == {
+        'no_sparse_terms': 1, 'early_stop': 1, 'widened': 1, 'fixed': 1
+    }
+
+
+def test_chunk_store_round_trip():
+    """Chunks read back exactly as added, with derived ids, interned metadata and embeddings"""
+    chunks = [
+        {'id': 'handbook_chunk_0', 'document_id': 'handbook', 'chunk_index': 0, 'text': 'Vacation policy.',
+         'source': 'Handbook', 'doc_type': 'policy', 'embedding': [1.0, 0.0]},
+        {'id': 'handbook_chunk_1', 'document_id': 'handbook', 'chunk_index': 1, 'text': 'Sick leave policy.',
+         'source': 'Handbook', 'doc_type': 'policy', 'embedding': [0.0, 1.0], 'page': 4},
+        {'id': 'faq_7', 'text': 'How do I reset my password?', 'source': 'IT_FAQ', 'doc_type': 'faq',
+         'embedding': [0.5, 0.5, 0.5]}  # Wrong dimension: kept, but marked invalid
+    ]
+
+    with ChunkStore() as store:
+        assert store.extend(chunks) == [0, 1, 2]
+
+        expected = [{k: v for k, v in chunk.items() if k != 'embedding'} for chunk in chunks]
+        assert list(store) == expected
+        assert [store.row_of(chunk['id']) for chunk in chunks] == [0, 1, 2]
+        # Only the id that doesn't follow <document_id>_chunk_<i> is stored
+        assert store.explicit_ids == {2: 'faq_7'}
+        assert len(store.sources) == 2
+
+        np.testing.assert_array_equal(store.embedding_matrix(), [[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]])
+        assert store.valid_embedding_rows().tolist() == [0, 1]
+        assert store.postings('doc_type')['policy'].tolist() == [0, 1]
+        assert store.postings('page')[4].tolist() == [1]
+        # Chunks without a page are only excluded by filters on fields they have
+        assert store.filter_rows({'source': 'Handbook', 'page': 4}).tolist() == [0, 1]
+        assert store.filter_rows({'page': 5}).tolist() == [0, 2]
+
+
+def test_compressed_text_store_reopens_saved_texts(tmp_path):
+    """Texts spanning several compressed blocks read back the same, before and after reopening"""
+    texts = [f"Chunk {i}: employees receive {i} days of leave — ünïcode kept intact." for i in range(200)]
+    path = str(tmp_path / 'texts.bin')
+
+    with CompressedTextStore(path, block_size=1024, cache_blocks=2, codec='zlib') as store:
+        for text in texts:
+            store.append(text)
+        assert [store[row] for row in range(len(store))] == texts
+        assert len(store.block_offsets) > 2
+        usage = store.memory_usage()
+        assert usage['file_bytes'] < sum(len(text.encode('utf-8')) for text in texts)
+
+    reopened = CompressedTextStore.open(path, cache_blocks=2)
+    try:
+        assert len(reopened) == len(texts)
+        assert reopened[0] == texts[0] and reopened[199] == texts[199]
+        reopened[1]  # Same block as row 0
+        assert reopened.stats == {'block_reads': 2, 'cache_hits': 1}
+        assert [reopened[row] for row in range(len(reopened))] == texts
+        assert len(reopened.cache) <= 2
+    finally:
+        reopened.close()
+
+
+def test_expanded_search_batches_query_variants():
+    """One variant ranks like hybrid_search; more variants widen recall in the same pass"""
+    hybrid_rag = HybridRetrievalRAG()
+    hybrid_rag.add_documents(FILTER_DOCUMENTS)
+
+    query = 'vacation notice'
+    single = hybrid_rag.expanded_search([query], top_k=3)
+    expected = hybrid_rag.hybrid_search(query, top_k=3)
+    assert [r['id'] for r in single] == [r['id'] for r in expected]
+    assert [r['combined_score'] for r in single] == pytest.approx([r['combined_score'] for r in expected], abs=1e-6)
+
+    # Only the expansion shares a term with the expense document
+    expanded = hybrid_rag.expanded_search(['travel costs', 'expense receipts'], weights=[1.0, 0.8], top_k=1)
+    assert expanded[0]['id'] == 'fin_001'
+    centroid = hybrid_rag.expanded_search(['travel costs', 'expense receipts'], weights=[1.0, 0.8],
+                                          top_k=1, dense_mode='centroid')
+    assert centroid[0]['id'] == 'fin_001'
+
+    with pytest.raises(ValueError):
+        hybrid_rag.expanded_search([query], dense_mode='mean')
+
+    expansion_rag = QueryExpansionRAG(hybrid_rag)
+    response = expansion_rag.search_with_expansion(query, top_k=2)
+    assert response['results'] == hybrid_rag.expanded_search(
+        response['expanded_queries'], weights=[w for _, w in expansion_rag.expand_query_weighted(query)], top_k=2)
+
 
 if __name__ == "__main__":
     test_retrieval_methods()
     test_alpha_tuning()
+    test_synonym_matching()
@@ -0,0 +1,178 @@
+# test_sharded_retrieval.py
+import os
+import signal
+import time
+
+import pytest
+from hybrid_retrieval_system import HybridRetrievalRAG
+from sharded_retrieval import ShardIndex, ShardedHybridRetrievalRAG, _handle_connection, serve_shard
+
+
+def get_documents():
+    return [
+        {
+            'id': 'hr_001',
+            'text': 'Employees receive 15-25 vacation days based on years of service. New employees get 15 days.',
+            'source': 'HR_Policy',
+            'doc_type': 'policy'
+        },
+        {
+            'id': 'hr_002',
+            'text': 'PTO requests must be submitted through the HR portal 14 days in advance.',
+            'source': 'HR_Policy',
+            'doc_type': 'policy'
+        },
+        {
+            'id': 'it_001',
+            'text': 'Password reset: Visit company portal, enter employee ID, follow email instructions.',
+            'source': 'IT_FAQ',
+            'doc_type': 'faq'
+        },
+        {
+            'id': 'it_002',
+            'text': 'VPN connection: Download Cisco AnyConnect, use network credentials.',
+            'source': 'IT_FAQ',
+            'doc_type': 'faq'
+        },
+        {
+            'id': 'finance_001',
+            'text': 'Expense reporting: Submit receipts within 30 days via expense portal.',
+            'source': 'Finance_Policies',
+            'doc_type': 'policy'
+        },
+        {
+            'id': 'safety_001',
+            'text': 'Emergency evacuation: exit via nearest stairwell and gather at the meeting point.',
+            'source': 'Safety_Manual',
+            'doc_type': 'procedure'
+        }
+    ]
+
+
+def test_sharded_matches_single_node():
+    """Sharded scatter-gather should rank exactly like one HybridRetrievalRAG"""
+
+    print("🧪 TESTING SHARDED RETRIEVAL (3 local shards)")
+    print("=" * 80)
+
+    single_rag = HybridRetrievalRAG()
+    single_rag.add_documents(get_documents())
+
+    test_queries = [
+        "How many vacation days do employees get?",
+        "PTO portal submission",
+        "Cisco AnyConnect VPN",
+        "fire evacuation"
+    ]
+
+    with ShardedHybridRetrievalRAG.start_local(3) as sharded_rag:
+        sharded_rag.add_documents(get_documents())
+
+        for query in test_queries:
+            expected = single_rag.hybrid_search(query, top_k=3)
+            response = sharded_rag.scatter_gather(query, top_k=3)
+
+            print(f"\n🔍 Query: '{query}' ({response['total_time'] * 1000:.1f}ms, "
+                  f"shards ok: {response['shards_ok']})")
+            for i, result in enumerate(response['results'], 1):
+                print(f"   {i}. Combined: {result['combined_score']:.3f} | {result['text'][:60]}...")
+
+            same_order = [r['text'] for r in expected] == [r['text'] for r in response['results']]
+            print(f"{'✅' if same_order else '❌'} Matches single-node ranking")
+
+            assert not response['partial']
+            assert [r['id'] for r in response['results']] == [r['id'] for r in expected]
+            for sharded, single in zip(response['results'], expected):
+                assert sharded['combined_score'] == pytest.approx(single['combined_score'], abs=1e-5)
+
+
+def test_partial_results():
+    """A dead shard should not fail the query"""
+
+    print(f"\n{'=' * 80}")
+    print("🧪 TESTING PARTIAL RESULTS WITH A FAILED SHARD")
+    print("=" * 80)
+
+    with ShardedHybridRetrievalRAG.start_local(3, timeout=1.0) as sharded_rag:
+        sharded_rag.add_documents(get_documents())
+
+        # Kill one worker to simulate a lost node
+        sharded_rag.processes[0].terminate()
+        sharded_rag.processes[0].join()
+
+        response = sharded_rag.scatter_gather("vacation days portal", top_k=3)
+
+        print(f"Partial: {response['partial']}")
+        print(f"Shards ok: {response['shards_ok']}")
+        print(f"Shards failed: {response['shards_failed']}")
+        for i, result in enumerate(response['results'], 1):
+            print(f"   {i}. Combined: {result['combined_score']:.3f} | {result['text'][:60]}...")
+
+        if response['partial'] and response['shards_ok']:
+            print("✅ Returned partial results from surviving shards")
+        else:
+            print("❌ Expected partial results")
+
+        assert response['partial']
+        assert 0 in response['shards_failed']
+        assert response['shards_ok'] == [1, 2]
+        assert response['results']
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGSTOP'), reason="needs POSIX signals")
+def test_stalled_shard_times_out():
+    """A shard that stops answering is reported as failed once the deadline passes"""
+
+    with ShardedHybridRetrievalRAG.start_local(3, timeout=0.5) as sharded_rag:
+        sharded_rag.add_documents(get_documents())
+
+        stalled = sharded_rag.processes[1]
+        os.kill(stalled.pid, signal.SIGSTOP)
+        try:
+            start_time = time.perf_counter()
+            response = sharded_rag.scatter_gather("vacation days portal", top_k=3)
+            elapsed = time.perf_counter() - start_time
+        finally:
+            os.kill(stalled.pid, signal.SIGCONT)
+
+        assert response['partial']
+        assert 'TimeoutError' in response['shards_failed'][1]
+        assert response['shards_ok'] == [0, 2]
+        assert elapsed < 2.0  # Bounded by the 0.5s deadline, not by the stalled shard
+
+
+def test_shard_refuses_to_listen_without_authkey(monkeypatch):
+    """Shard workers unpickle what they receive, so they never run without a secret"""
+    monkeypatch.setattr('sharded_retrieval.ENV_AUTHKEY', None)
+    with pytest.raises(ValueError):
+        serve_shard(('0.0.0.0', 0))
+
+
+class HungUpConnection:
+    """Coordinator connection that timed out: requests are readable, replies hit a closed pipe"""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    def recv(self):
+        if not self.messages:
+            raise EOFError
+        return self.messages.pop(0)
+
+    def send(self, reply):
+        raise BrokenPipeError(32, 'Broken pipe')
+
+
+def test_reply_to_closed_connection_keeps_shard_alive():
+    """A coordinator that hung up before the reply never kills the shard worker"""
+    shard = ShardIndex()
+
+    assert _handle_connection(shard, HungUpConnection([{'op': 'ping', 'request_id': 0}])) is True
+    assert _handle_connection(shard, HungUpConnection([{'op': 'bogus', 'request_id': 1}])) is True
+    # A shutdown request still shuts down even if its acknowledgement is lost
+    assert _handle_connection(shard, HungUpConnection([{'op': 'shutdown', 'request_id': 2}])) is False
+
+
+if __name__ == "__main__":
+    test_sharded_matches_single_node()
+    test_partial_results()
@@ -0,0 +1,379 @@
+# tracing.py
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Dict, Optional
+
+import numpy as np
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_capture = contextvars.ContextVar('trace_capture', default=None)
+
+# perf_counter_ns is monotonic but has no epoch; this maps it to wall-clock time for export
+_EPOCH_OFFSET_NS = time.time_ns() - time.perf_counter_ns()
+
+
+class Span:
+    """One timed pipeline stage with its attributes (candidate counts, model, ...)"""
+
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns',
+                 'attributes', 'status', '_token')
+
+    def __init__(self, tracer: 'Tracer', name: str, attributes: Dict, parent: Optional['Span']):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.status = 'ok'
+        self.start_ns = self.end_ns = 0
+        self._token = None
+
+    def set(self, **attributes) -> 'Span':
+        """Add attributes, e.g. result counts known only at the end of the stage"""
+        self.attributes.update(attributes)
+        return self
+
+    def __enter__(self) -> 'Span':
+        self._token = _current_span.set(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.end_ns = time.perf_counter_ns()
+        if exc_type is GeneratorExit:
+            self.attributes['closed_early'] = True  # Consumer stopped iterating a streaming stage
+        elif exc_type is not None:
+            self.status = 'error'
+            self.attributes['error'] = repr(exc)
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            pass  # A generator closed in another context than it started in; that context never saw the span
+        self.tracer._emit(self)
+        return False
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_unix_ns': _EPOCH_OFFSET_NS + self.start_ns,
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+
+class _NoopSpan:
+    """Returned while tracing is off; every operation does nothing"""
+
+    __slots__ = ()
+
+    def set(self, **attributes) -> '_NoopSpan':
+        return self
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    Creates spans and hands finished ones to sinks
+
+    While disabled (the default unless RAG_TRACING=1), span() returns a
+    shared no-op object after two attribute checks, so instrumented code
+    pays almost nothing. Spans nest through a context variable, which also
+    carries them across await points; code run in an executor should be
+    called through contextvars.copy_context().run to keep its parent.
+    """
+
+    def __init__(self, sinks: List = None, enabled: bool = None):
+        self.sinks = list(sinks or [])
+        self.enabled = bool(os.environ.get('RAG_TRACING')) if enabled is None else enabled
+        self._captures = 0  # Active capture() blocks; they trace their own context only
+
+    def span(self, name: str, **attributes):
+        """Context manager timing one stage; attributes are recorded with it"""
+        if not self.enabled and (not self._captures or _capture.get() is None):
+            return NOOP_SPAN
+        return Span(self, name, attributes, _current_span.get())
+
+    def enable(self, *sinks):
+        """Turn tracing on, adding sinks (a RingBufferSink if there are none yet)"""
+        self.sinks.extend(sinks)
+        if not self.sinks:
+            self.sinks.append(RingBufferSink())
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def capture(self, enabled: bool = True):
+        """
+        Collect the spans finished in this context into a list, even while tracing is off
+
+        Used for per-call output such as explain=True; yields None when not enabled.
+        """
+        if not enabled:
+            yield None
+            return
+
+        spans = []
+        token = _capture.set(spans)
+        self._captures += 1
+        try:
+            yield spans
+        finally:
+            self._captures -= 1
+            _capture.reset(token)
+
+    def _emit(self, span: Span):
+        captured = _capture.get()
+        if captured is not None:
+            captured.append(span)
+        if self.enabled:
+            for sink in self.sinks:
+                sink.export(span)
+
+    def flush(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'flush'):
+                sink.flush()
+
+
+class RingBufferSink:
+    """Keeps the most recent spans in memory for inspection and aggregate stats"""
+
+    def __init__(self, max_spans: int = 10000):
+        self.buffer = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self.lock:
+            self.buffer.append(span)
+
+    def spans(self, name: str = None) -> List[Span]:
+        with self.lock:
+            return [span for span in self.buffer if name is None or span.name == name]
+
+    def summary(self) -> Dict[str, Dict]:
+        """Count and latency percentiles (ms) per span name"""
+        durations = {}
+        for span in self.spans():
+            durations.setdefault(span.name, []).append(span.duration_ms)
+
+        return {
+            name: {
+                'count': len(values),
+                'mean_ms': float(np.mean(values)),
+                'p50_ms': float(np.percentile(values, 50)),
+                'p95_ms': float(np.percentile(values, 95)),
+                'max_ms': float(np.max(values))
+            }
+            for name, values in durations.items()
+        }
+
+    def clear(self):
+        with self.lock:
+            self.buffer.clear()
+
+
+class JsonlSink:
+    """Appends one JSON object per finished span to a file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class OTLPJsonSink:
+    """
+    Batches spans as OpenTelemetry OTLP/JSON trace requests
+
+    Each batch is POSTed to endpoint (an OTLP/HTTP collector, e.g.
+    http://localhost:4318/v1/traces) and/or appended to path as one JSON
+    line, so any OpenTelemetry backend can ingest it without the SDK.
+    Batches are written by a background thread: export() only queues, so a
+    slow collector never blocks the stage (or event loop) that ended a span.
+    """
+
+    def __init__(self, endpoint: str = None, path: str = None, service_name: str = 'rag-practice',
+                 batch_size: int = 512, max_queued_batches: int = 64):
+        self.endpoint = endpoint
+        self.path = path
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+        self.dropped_batches = 0
+        self.batches = queue.Queue(maxsize=max_queued_batches)
+        self.worker = threading.Thread(target=self._run, name='otlp-export', daemon=True)
+        self.worker.start()
+
+    def export(self, span: Span):
+        with self.lock:
+            self.pending.append(span)
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, []
+        self._enqueue(batch)
+
+    def flush(self):
+        """Queue the partial batch and wait until every queued batch is written"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self._enqueue(batch)
+        self.batches.join()
+
+    def close(self):
+        """Flush and stop the export thread"""
+        if self.worker.is_alive():
+            self.flush()
+            self.batches.put(None)
+            self.worker.join()
+
+    def _enqueue(self, batch: List[Span]):
+        try:
+            self.batches.put_nowait(batch)
+        except queue.Full:
+            # Collector can't keep up; drop rather than stall the pipeline
+            self.dropped_batches += 1
+
+    def _run(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+                self._send(batch)
+            except Exception as e:
+                print(f"⚠️ Trace export failed: {e}")
+            finally:
+                self.batches.task_done()
+
+    def to_otlp(self, spans: List[Span]) -> Dict:
+        """ExportTraceServiceRequest in OTLP/JSON encoding"""
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', self.service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': 'rag-practice.tracing'},
+                    'spans': [{
+                        'traceId': span.trace_id,
+                        'spanId': span.span_id,
+                        'parentSpanId': span.parent_id or '',
+                        'name': span.name,
+                        'kind': 1,  # SPAN_KIND_INTERNAL
+                        'startTimeUnixNano': str(_EPOCH_OFFSET_NS + span.start_ns),
+                        'endTimeUnixNano': str(_EPOCH_OFFSET_NS + span.end_ns),
+                        'attributes': [_otlp_attribute(k, v) for k, v in span.attributes.items()],
+                        'status': {'code': 2 if span.status == 'error' else 1}
+                    } for span in spans]
+                }]
+            }]
+        }
+
+    def _send(self, batch: List[Span]):
+        payload = json.dumps(self.to_otlp(batch))
+        if self.path:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(payload + '\n')
+        if self.endpoint:
+            request = urllib.request.Request(self.endpoint, data=payload.encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except Exception as e:
+                print(f"⚠️ Trace export failed: {e}")
+
+
+def _otlp_attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, (int, np.integer)):
+        return {'key': key, 'value': {'intValue': str(int(value))}}
+    if isinstance(value, (float, np.floating)):
+        return {'key': key, 'value': {'doubleValue': float(value)}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def format_trace(spans: List[Span]) -> str:
+    """Indented span tree with durations and attributes, parents before children"""
+    children = {}
+    ids = {span.span_id for span in spans}
+    for span in sorted(spans, key=lambda s: s.start_ns):
+        parent = span.parent_id if span.parent_id in ids else None
+        children.setdefault(parent, []).append(span)
+
+    lines = []
+
+    def walk(parent, depth):
+        for span in children.get(parent, []):
+            attributes = ' '.join(f"{k}={v}" for k, v in span.attributes.items())
+            lines.append(f"{'   ' * depth}⏱️ {span.name}: {span.duration_ms:.2f}ms {attributes}".rstrip())
+            walk(span.span_id, depth + 1)
+
+    walk(None, 0)
+    return '\n'.join(lines)
+
+
+def span_seconds(spans: List[Span], name: str) -> float:
+    """Total seconds spent in spans called name"""
+    return sum(span.end_ns - span.start_ns for span in spans if span.name == name) / 1e9
+
+
+def benchmark_overhead(iterations: int = 100000) -> Dict[str, float]:
+    """Nanoseconds per span with tracing off and on (ring buffer sink)"""
+    report = {}
+    for label, enabled in (('disabled', False), ('enabled', True)):
+        bench_tracer = Tracer([RingBufferSink(1000)], enabled=enabled)
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            with bench_tracer.span('stage', candidates=20):
+                pass
+        report[f'{label}_ns_per_span'] = (time.perf_counter_ns() - start) / iterations
+    return report
+
+
+# Process-wide tracer used by the instrumented pipeline
+tracer = Tracer()
+
+
+if __name__ == "__main__":
+    for key, value in benchmark_overhead().items():
+        print(f"{key}: {value:,.0f}")
@@ -1,27 +1,40 @@
 # advanced_reranking_system.py
-from sentence_transformers import CrossEncoder
 import torch
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
 from typing import List, Dict, Tuple
 import numpy as np
+from scipy.stats import kendalltau
+from model_registry import get_cross_encoder
+from tracing import tracer, format_trace, span_seconds
 
 
 class AdvancedRerankedRAG:
-    def __init__(self, base_hybrid_rag, reranker_models=None):
+    def __init__(self, base_hybrid_rag, reranker_models=None, backend: str = None):
+        """
+        Args:
+            base_hybrid_rag: Retrieval system providing hybrid_search
+            reranker_models: {name: model} to use instead of the defaults
+            backend: 'torch', 'onnx' or 'onnx-int8' for the default models
+                (default: RERANKER_BACKEND env var, else torch)
+        """
         self.base_rag = base_hybrid_rag
 
-        # Default to multiple reranker models for different use cases
+        # Default to multiple reranker models for different use cases; each is
+        # loaded on first use and shared with other rerankers in the process
         if reranker_models is None:
             self.rerankers = {
-                'general': CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2'),
-                'qa': CrossEncoder('cross-encoder/qnli-electra-base'),
-                'semantic': CrossEncoder('cross-encoder/stsb-distilroberta-base')
+                'general': get_cross_encoder('cross-encoder/ms-marco-MiniLM-L-6-v2', backend=backend),
+                'qa': get_cross_encoder('cross-encoder/qnli-electra-base', backend=backend),
+                'semantic': get_cross_encoder('cross-encoder/stsb-distilroberta-base', backend=backend)
             }
         else:
             self.rerankers = reranker_models
 
         self.default_reranker = 'general'
-        print(f"✅ Loaded {len(self.rerankers)} reranker models")
+        print(f"✅ Registered {len(self.rerankers)} reranker models (loaded on first use)")
 
     def search_with_reranking(self, query: str, top_k: int = 5, retrieve_k: int = 20,
                               reranker_type: str = None, explain: bool = False) -> List[Dict]:
@@ -33,52 +46,80 @@ class AdvancedRerankedRAG:
             top_k: Final number of results to return
             retrieve_k: Number of candidates to retrieve for reranking
             reranker_type: Which reranker model to use ('general', 'qa', 'semantic')
-            explain: Whether to include detailed scoring explanations
+            explain: Whether to print the stage timings and score changes of this call
         """
 
         # Choose reranker
         reranker_type = reranker_type or self.default_reranker
-        reranker = self.rerankers[reranker_type]
-
-        if explain:
-            print(f"\n🔍 RERANKING PIPELINE EXPLANATION")
-            print(f"{'=' * 60}")
-            print(f"Query: '{query}'")
-            print(f"Reranker: {reranker_type}")
-            print(f"Retrieve K: {retrieve_k} → Rerank to Top K: {top_k}")
+        reranked_results = []
 
-        # Stage 1: Broad retrieval
-        start_time = time.time()
-        candidates = self.base_rag.hybrid_search(query, top_k=retrieve_k)
-        retrieval_time = time.time() - start_time
+        # explain collects this call's spans even while tracing is off
+        with tracer.capture(explain) as spans:
+            with tracer.span('search_with_reranking', reranker=reranker_type, retrieve_k=retrieve_k, top_k=top_k):
+                # Stage 1: Broad retrieval
+                with tracer.span('retrieval') as span:
+                    candidates = self.base_rag.hybrid_search(query, top_k=retrieve_k)
+                    span.set(candidates=len(candidates))
 
-        if not candidates:
-            return []
+                # Stage 2: Precise reranking
+                if candidates:
+                    reranked_results, _ = self._rerank_candidates(query, candidates, reranker_type)
 
         if explain:
-            print(f"\n📊 STAGE 1: RETRIEVAL ({retrieval_time:.3f}s)")
-            print("Top 3 candidates from hybrid search:")
-            for i, candidate in enumerate(candidates[:3], 1):
-                score = self._extract_score(candidate, 'combined_score')
-                text = self._extract_text(candidate)
-                print(f"   {i}. Score: {score:.3f} | {text[:60]}...")
+            self._print_explanation(query, reranker_type, retrieve_k, top_k, candidates, reranked_results, spans)
 
-        # Stage 2: Precise reranking
-        start_time = time.time()
+        return reranked_results[:top_k]
 
-        # Prepare query-document pairs
-        query_doc_pairs = []
-        for candidate in candidates:
+    def _print_explanation(self, query: str, reranker_type: str, retrieve_k: int, top_k: int,
+                           candidates: List, reranked_results: List[Dict], spans: List):
+        """Print one search's stages from its captured spans"""
+        print(f"\n🔍 RERANKING PIPELINE EXPLANATION")
+        print(f"{'=' * 60}")
+        print(f"Query: '{query}'")
+        print(f"Reranker: {reranker_type}")
+        print(f"Retrieve K: {retrieve_k} → Rerank to Top K: {top_k}")
+
+        print(f"\n📊 STAGE 1: RETRIEVAL ({span_seconds(spans, 'retrieval'):.3f}s)")
+        print("Top 3 candidates from hybrid search:")
+        for i, candidate in enumerate(candidates[:3], 1):
+            score = self._extract_score(candidate, 'combined_score')
             text = self._extract_text(candidate)
-            query_doc_pairs.append([query, text])
+            print(f"   {i}. Score: {score:.3f} | {text[:60]}...")
+
+        if reranked_results:
+            print(f"\n🎯 STAGE 2: RERANKING ({span_seconds(spans, 'rerank'):.3f}s)")
+            print("Top 3 after reranking:")
+            for i, result in enumerate(reranked_results[:3], 1):
+                improvement = result['score_improvement']
+                improvement_str = f"(+{improvement:.3f})" if improvement > 0 else f"({improvement:.3f})"
+                print(f"   {i}. Score: {result['rerank_score']:.3f} {improvement_str}")
+                print(f"      Text: {result['text'][:60]}...")
+
+            # Show position changes
+            self._show_position_changes(candidates, reranked_results, top_k)
+
+        print(f"\n⏱️ TRACE:")
+        print(format_trace(spans))
+
+    def _rerank_candidates(self, query: str, candidates: List, reranker_type: str) -> Tuple[List[Dict], float]:
+        """Score candidates with one reranker; returns (results sorted by rerank score, seconds)"""
+        reranker = self.rerankers[reranker_type]
+        start_time = time.perf_counter()
+
+        with tracer.span('rerank', model=reranker_type, pairs=len(candidates)):
+            # Prepare query-document pairs
+            query_doc_pairs = []
+            for candidate in candidates:
+                text = self._extract_text(candidate)
+                query_doc_pairs.append([query, text])
 
-        # Get reranking scores
-        rerank_scores = reranker.predict(query_doc_pairs)
-        reranking_time = time.time() - start_time
+            # Get reranking scores
+            rerank_scores = reranker.predict(query_doc_pairs)
+        reranking_time = time.perf_counter() - start_time
 
         # Combine results with scores
         reranked_results = []
-        for candidate, rerank_score in zip(candidates, rerank_scores):
+        for position, (candidate, rerank_score) in enumerate(zip(candidates, rerank_scores)):
             original_score = self._extract_score(candidate, 'combined_score')
 
             result = {
@@ -89,7 +130,8 @@ class AdvancedRerankedRAG:
                 'original_score': float(original_score),
                 'rerank_score': float(rerank_score),
                 'score_improvement': float(rerank_score) - float(original_score),
-                'reranker_used': reranker_type
+                'reranker_used': reranker_type,
+                'candidate_position': position
             }
 
             reranked_results.append(result)
@@ -97,19 +139,7 @@ class AdvancedRerankedRAG:
         # Sort by rerank score
         reranked_results.sort(key=lambda x: x['rerank_score'], reverse=True)
 
-        if explain:
-            print(f"\n🎯 STAGE 2: RERANKING ({reranking_time:.3f}s)")
-            print("Top 3 after reranking:")
-            for i, result in enumerate(reranked_results[:3], 1):
-                improvement = result['score_improvement']
-                improvement_str = f"(+{improvement:.3f})" if improvement > 0 else f"({improvement:.3f})"
-                print(f"   {i}. Score: {result['rerank_score']:.3f} {improvement_str}")
-                print(f"      Text: {result['text'][:60]}...")
-
-            # Show position changes
-            self._show_position_changes(candidates, reranked_results, top_k)
-
-        return reranked_results[:top_k]
+        return reranked_results, reranking_time
 
     def _extract_text(self, candidate) -> str:
         """Extract text from different candidate formats"""
@@ -162,30 +192,82 @@ class AdvancedRerankedRAG:
 
             print(f"   {change} | Score: {result['rerank_score']:.3f} | {result['text'][:50]}...")
 
-    def compare_rerankers(self, query: str, top_k: int = 3) -> Dict:
-        """Compare different reranker models on the same query"""
+    def compare_rerankers(self, query: str, top_k: int = 3, retrieve_k: int = 20,
+                          max_workers: int = None) -> Dict:
+        """
+        Compare different reranker models on the same query
+
+        Candidates are retrieved once and scored by every reranker, in
+        parallel threads (model inference releases the GIL).
+
+        Returns:
+            {'rankings': {name: top_k results}, 'latency': {name: seconds},
+             'rank_correlation': {'a vs b': Kendall tau over all candidates},
+             'retrieval_time': seconds, 'total_time': seconds}
+        """
 
         print(f"\n{'=' * 80}")
         print(f"🧪 COMPARING RERANKER MODELS")
         print(f"Query: '{query}'")
         print(f"{'=' * 80}")
 
-        results = {}
-
-        for reranker_name in self.rerankers.keys():
-            print(f"\n🔧 Testing {reranker_name.upper()} reranker:")
+        start_time = time.time()
+        candidates = self.base_rag.hybrid_search(query, top_k=retrieve_k)
+        retrieval_time = time.time() - start_time
 
-            reranked_results = self.search_with_reranking(
-                query, top_k=top_k, reranker_type=reranker_name
-            )
+        names = list(self.rerankers.keys())
+        if not candidates:
+            print("⚠️ No candidates retrieved; nothing to compare")
+            return {
+                'query': query,
+                'rankings': {name: [] for name in names},
+                'latency': {name: 0.0 for name in names},
+                'rank_correlation': {},
+                'retrieval_time': retrieval_time,
+                'total_time': time.time() - start_time
+            }
 
-            results[reranker_name] = reranked_results
+        max_workers = max_workers or min(len(names), os.cpu_count() or 1)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(self._rerank_candidates, query, candidates, name)
+                       for name in names}
+            scored = {name: future.result() for name, future in futures.items()}
+
+        # Scores in candidate order, so models are compared on the same list
+        candidate_scores = {}
+        for name, (reranked_results, _) in scored.items():
+            scores = np.zeros(len(candidates))
+            for result in reranked_results:
+                scores[result['candidate_position']] = result['rerank_score']
+            candidate_scores[name] = scores
+
+        rank_correlation = {}
+        for a, b in combinations(names, 2):
+            tau = kendalltau(candidate_scores[a], candidate_scores[b])[0] if len(candidates) > 1 else 1.0
+            rank_correlation[f"{a} vs {b}"] = float(tau)
+
+        report = {
+            'query': query,
+            'rankings': {name: scored[name][0][:top_k] for name in names},
+            'latency': {name: scored[name][1] for name in names},
+            'rank_correlation': rank_correlation,
+            'retrieval_time': retrieval_time,
+            'total_time': time.time() - start_time
+        }
 
-            for i, result in enumerate(reranked_results, 1):
+        for name in names:
+            print(f"\n🔧 {name.upper()} reranker ({report['latency'][name]:.3f}s):")
+            for i, result in enumerate(report['rankings'][name], 1):
                 print(f"   {i}. Score: {result['rerank_score']:.3f}")
                 print(f"      Text: {result['text'][:70]}...")
 
-        return results
+        print(f"\n📈 Rank correlation (Kendall tau over {len(candidates)} candidates):")
+        for pair, tau in rank_correlation.items():
+            print(f"   {pair}: {tau:+.3f}")
+        print(f"⏱️ Retrieval: {retrieval_time:.3f}s | Total: {report['total_time']:.3f}s")
+
+        return report
 
     def benchmark_reranking_impact(self, test_queries: List[str]) -> Dict:
         """Benchmark the impact of reranking across multiple queries"""
@@ -207,15 +289,13 @@ class AdvancedRerankedRAG:
             print(f"\n🔍 Testing: '{query}'")
 
             # Get hybrid results (baseline)
-            start_time = time.time()
             hybrid_results = self.base_rag.hybrid_search(query, top_k=5)
-            retrieval_time = time.time() - start_time
 
-            # Get reranked results
-            start_time = time.time()
-            reranked_results = self.search_with_reranking(query, top_k=5)
-            total_time = time.time() - start_time
-            reranking_time = total_time - retrieval_time
+            # Get reranked results; stage times come from the spans of this call
+            with tracer.capture() as spans:
+                reranked_results = self.search_with_reranking(query, top_k=5)
+            retrieval_time = span_seconds(spans, 'retrieval')
+            reranking_time = span_seconds(spans, 'rerank')
 
             # Calculate improvements
             if hybrid_results and reranked_results:
@@ -0,0 +1,170 @@
+# async_pipeline.py
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+
+import numpy as np
+from complete_answer_system import AnswerResult, cancel_requested
+
+
+class AsyncRAGPipeline:
+    """
+    Async query pipeline: retrieval → reranking → generation on one event loop
+
+    Every request carries a deadline covering its wait for admission and all
+    stages. Blocking CPU stages (retrieval, reranking) share one bounded
+    thread pool, LLM calls are awaited natively, and at most max_in_flight
+    requests run at once while the rest wait on the loop. Thread count stays
+    at cpu_workers however many requests are open. Cancelling a request's
+    task (e.g. when its client disconnects) cancels its stage in flight.
+    """
+
+    def __init__(self, answer_generator, cpu_workers: int = None, max_in_flight: int = 256,
+                 default_timeout: float = 10.0):
+        """
+        Args:
+            answer_generator: ProductionAnswerGenerator (or anything with agenerate_answer)
+            cpu_workers: Threads for retrieval and reranking (default: CPU count)
+            max_in_flight: Requests processed at once; later ones queue without holding a thread
+            default_timeout: Seconds per request when query() gets no timeout
+        """
+        self.answer_generator = answer_generator
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.cpu_executor = ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix='rag-cpu')
+        self.max_in_flight = max_in_flight
+        self.default_timeout = default_timeout
+
+        self._admission = None
+        self._admission_loop = None
+        self.in_flight = 0
+
+        self.latencies = deque(maxlen=10000)
+        self.stats = {'requests': 0, 'completed': 0, 'timeouts': 0, 'errors': 0, 'cancelled': 0}
+
+    async def query(self, query: str, options: Dict = None, timeout: float = None) -> AnswerResult:
+        """Answer one query within timeout seconds (a 'timeout' result once it runs out)"""
+        timeout = self.default_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        start_time = time.time()
+        self.stats['requests'] += 1
+
+        admission = self._get_admission()
+        try:
+            if admission.locked():
+                # Waiting for a slot counts against the deadline too
+                await asyncio.wait_for(admission.acquire(), timeout)
+            else:
+                await admission.acquire()  # Free slot: taken without suspending
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            return self.answer_generator._create_timeout_response(query, timeout, start_time)
+        except asyncio.CancelledError:
+            self.stats['cancelled'] += 1
+            raise
+
+        self.in_flight += 1
+        try:
+            if cancel_requested():
+                # Cancelled in the same step the slot was granted; wait_for kept the slot
+                raise asyncio.CancelledError()
+            result = await self.answer_generator.agenerate_answer(
+                query, options, timeout=max(deadline - time.monotonic(), 0.0), executor=self.cpu_executor
+            )
+        except asyncio.CancelledError:
+            self.stats['cancelled'] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            admission.release()
+
+        if result.answer_type == 'timeout':
+            self.stats['timeouts'] += 1
+        elif result.answer_type == 'error':
+            self.stats['errors'] += 1
+        else:
+            self.stats['completed'] += 1
+        self.latencies.append(time.time() - start_time)
+        return result
+
+    async def query_many(self, queries: List[str], timeout: float = None) -> List[AnswerResult]:
+        """Answer queries concurrently; results are in query order"""
+        return await asyncio.gather(*(self.query(q, timeout=timeout) for q in queries))
+
+    def _get_admission(self) -> asyncio.Semaphore:
+        """Admission semaphore for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._admission is None or self._admission_loop is not loop:
+            self._admission = asyncio.Semaphore(self.max_in_flight)
+            self._admission_loop = loop
+        return self._admission
+
+    def get_stats(self) -> Dict:
+        """Outcome counts, latency percentiles and thread usage"""
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            **self.stats,
+            'in_flight': self.in_flight,
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p95': float(np.percentile(latencies, 95)),
+            'latency_p99': float(np.percentile(latencies, 99)),
+            'cpu_workers': self.cpu_workers,
+            'threads': threading.active_count()
+        }
+
+    def close(self):
+        """Stop the CPU pool, dropping stages that have not started"""
+        self.cpu_executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_load_test(pipeline: AsyncRAGPipeline, queries: List[str], num_requests: int = 1000,
+                        timeout: float = 5.0, disconnect_fraction: float = 0.1,
+                        disconnect_after: float = 0.01) -> Dict:
+    """
+    Open num_requests requests at once and cancel a fraction of them early
+
+    The cancelled ones stand in for clients that disconnect mid-request.
+    """
+    start_time = time.time()
+    tasks = [asyncio.ensure_future(pipeline.query(queries[i % len(queries)], timeout=timeout))
+             for i in range(num_requests)]
+
+    await asyncio.sleep(disconnect_after)
+    for task in tasks[:int(num_requests * disconnect_fraction)]:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.time() - start_time
+
+    stats = pipeline.get_stats()
+    stats['total_time'] = elapsed
+    stats['requests_per_sec'] = num_requests / elapsed
+
+    print(f"\n📊 {num_requests} concurrent requests in {elapsed:.2f}s ({stats['requests_per_sec']:.0f} req/s)")
+    print(f"   Completed: {stats['completed']} | Timeouts: {stats['timeouts']} | "
+          f"Cancelled: {stats['cancelled']} | Errors: {stats['errors']}")
+    print(f"   Latency p50: {stats['latency_p50']:.3f}s | p95: {stats['latency_p95']:.3f}s | "
+          f"p99: {stats['latency_p99']:.3f}s")
+    print(f"   Threads: {stats['threads']} ({stats['cpu_workers']} CPU workers)")
+    return stats
+
+
+if __name__ == "__main__":
+    from complete_answer_system import TestLLMClient
+    from test_complete_answer_system import setup_complete_system
+
+    answer_generator = setup_complete_system()
+    answer_generator.llm_client = TestLLMClient(latency=0.05)  # Simulated LLM network time
+
+    pipeline = AsyncRAGPipeline(answer_generator, max_in_flight=256)
+    queries = [
+        "How many sick days do new employees get?",
+        "How many vacation days do senior employees get?",
+        "How do I reset my password?",
+        "How do I submit expense receipts?"
+    ]
+    asyncio.run(run_load_test(pipeline, queries, num_requests=1000))
+    pipeline.close()
@@ -1,11 +1,37 @@
 # complete_answer_system.py
+import asyncio
+import contextvars
+import copy
 import re
 import json
 import time
+from functools import partial
 from datetime import datetime
-from typing import List, Dict, Optional, Union
-from dataclasses import dataclass
+from typing import List, Dict, Iterator, Optional, Union
+from dataclasses import dataclass, replace
 import hashlib
+from semantic_cache import SemanticAnswerCache
+from tracing import tracer
+
+
+async def wait_until(awaitable, timeout: Optional[float]):
+    """
+    asyncio.wait_for that never drops a cancellation
+
+    On Python 3.11 wait_for returns the result when the awaitable finishes
+    in the same loop step as a cancel request, so the cancel is lost. Here
+    that case still raises CancelledError.
+    """
+    result = await asyncio.wait_for(awaitable, timeout)
+    if cancel_requested():
+        raise asyncio.CancelledError()
+    return result
+
+
+def cancel_requested() -> bool:
+    """Whether the current task has a pending cancel request (Python 3.11+)"""
+    task = asyncio.current_task()
+    return hasattr(task, 'cancelling') and task.cancelling() > 0
 
 
 @dataclass
@@ -21,12 +47,62 @@ class AnswerResult:
     metadata: Dict
 
 
+class StreamingCitationParser:
+    """
+    Finds [Source N] citations in streamed text as soon as each marker is complete
+
+    A marker may be split across deltas, so only text from an unclosed '['
+    onward is kept for the next delta; each delta costs O(len(delta)).
+    Each source is reported once.
+    """
+
+    pattern = re.compile(r'\[Source (\d+)\]')
+    max_marker_length = 20
+
+    def __init__(self, resolve):
+        """
+        Args:
+            resolve: Source number → citation dict, or None for numbers without a source
+        """
+        self.resolve = resolve
+        self.pending = ""  # Possible start of a marker cut off at the end of the last delta
+        self.seen = set()
+        self.citations = []  # Every citation reported so far, in order
+
+    def feed(self, delta: str) -> List[Dict]:
+        """New citations completed by delta"""
+        text = self.pending + delta
+        citations = []
+        scanned_to = 0
+
+        for match in self.pattern.finditer(text):
+            scanned_to = match.end()
+            source_num = int(match.group(1))
+            if source_num in self.seen:
+                continue
+            citation = self.resolve(source_num)
+            if citation is not None:
+                self.seen.add(source_num)
+                citations.append(citation)
+                self.citations.append(citation)
+
+        # Keep a trailing partial marker for the next delta
+        open_bracket = text.rfind('[', scanned_to)
+        if open_bracket != -1 and len(text) - open_bracket < self.max_marker_length:
+            self.pending = text[open_bracket:]
+        else:
+            self.pending = ""
+        return citations
+
+
 class ProductionAnswerGenerator:
     """Production-ready answer generation system"""
 
-    def __init__(self, retrieval_system, llm_client=None):
+    def __init__(self, retrieval_system, llm_client=None, semantic_cache: SemanticAnswerCache = None):
         self.retrieval_system = retrieval_system
         self.llm_client = llm_client
+        # Reuses answers across paraphrased queries (see enable_semantic_cache)
+        self.semantic_cache = semantic_cache
 
         # Configuration
         self.config = {
@@ -35,7 +111,8 @@ class ProductionAnswerGenerator:
             'confidence_threshold': 0.6,
             'citation_required': True,
             'max_sources': 3,
-            'temperature': 0.1  # Low for factual accuracy
+            'temperature': 0.1,  # Low for factual accuracy
+            'use_cache': True  # Per-request switch for the semantic cache
         }
 
         # Initialize prompt templates
@@ -46,6 +123,15 @@ class ProductionAnswerGenerator:
 
         print("✅ Production Answer Generator initialized")
 
+    def enable_semantic_cache(self, similarity_threshold: float = 0.9, max_entries: int = 1000,
+                              ttl: float = 3600) -> SemanticAnswerCache:
+        """Cache answers keyed on query embeddings from the retrieval system's embedding model"""
+        self.semantic_cache = SemanticAnswerCache(
+            self._base_rag()._encode_query, similarity_threshold=similarity_threshold,
+            max_entries=max_entries, ttl=ttl
+        )
+        return self.semantic_cache
+
     def generate_answer(self, query: str, options: Dict = None) -> AnswerResult:
         """Generate complete answer with full pipeline"""
 
@@ -55,62 +141,288 @@ class ProductionAnswerGenerator:
         # Override config with options
         config = {**self.config, **options}
 
-        try:
-            # Step 1: Validate query
-            if not query or len(query.strip()) < 3:
-                return self._create_error_response(query, "Query too short", start_time)
-
-            # Step 2: Retrieve and rerank documents
-            search_results = self.retrieval_system.search_with_reranking(
-                query,
-                top_k=config['max_sources'] * 2
-            )
+        with tracer.span('generate_answer'):
+            try:
+                # Step 1: Validate query
+                if not query or len(query.strip()) < 3:
+                    return self._create_error_response(query, "Query too short", start_time)
+
+                # Paraphrases of an answered query reuse its answer
+                embedding = None
+                if self.semantic_cache is not None and config['use_cache']:
+                    embedding = self.semantic_cache.embed(query)
+                    cached = self._from_cache(query, embedding, config, start_time)
+                    if cached is not None:
+                        return cached
+
+                # Step 2: Retrieve and rerank documents
+                search_results = self.retrieval_system.search_with_reranking(
+                    query,
+                    top_k=config['max_sources'] * 2
+                )
+
+                if not search_results:
+                    return self._create_no_results_response(query, start_time)
+
+                # Steps 3-4: Select context, classify query and build the prompt
+                with tracer.span('prompt_build', results=len(search_results)) as span:
+                    context_info = self._prepare_context(query, search_results, config)
+                    answer_type = self._classify_query_type(query)
+                    prompt = self._build_prompt(query, context_info, answer_type)
+                    span.set(sources=len(context_info['sources']), prompt_chars=len(prompt))
+
+                # Step 5: Generate raw answer
+                with tracer.span('llm_call') as span:
+                    raw_answer = self._generate_with_llm(prompt, config)
+                    span.set(answer_chars=len(raw_answer))
+
+                # Steps 6-8: Post-process, score and build the final result
+                result = self._finalize_answer(query, prompt, raw_answer, context_info, answer_type, start_time)
+                self._to_cache(query, embedding, config, result)
+                return result
 
-            if not search_results:
-                return self._create_no_results_response(query, start_time)
+            except Exception as e:
+                return self._create_error_response(query, str(e), start_time)
+
+    async def agenerate_answer(self, query: str, options: Dict = None, timeout: float = None,
+                               executor=None) -> AnswerResult:
+        """
+        Async version of generate_answer for serving many requests on one event loop
+
+        Retrieval and reranking run on executor (a bounded thread pool owned by
+        the caller) and generation uses the LLM client's agenerate when it has
+        one. Cancelling the calling task (e.g. on client disconnect) cancels
+        the stage in flight: queued executor work is dropped and the LLM
+        request is aborted.
+
+        Args:
+            timeout: Seconds for the whole request; stages still running at the
+                deadline are cancelled and a 'timeout' result is returned
+            executor: Thread pool for the blocking stages (default: the loop's default executor);
+                work sent there runs in a copy of the caller's context, so its spans nest under this request
+        """
+        start_time = time.time()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        options = options or {}
+        config = {**self.config, **options}
+        loop = asyncio.get_running_loop()
 
-            # Step 3: Select and prepare context
-            context_info = self._prepare_context(query, search_results, config)
+        def remaining():
+            return None if deadline is None else max(deadline - time.monotonic(), 0.0)
 
-            # Step 4: Classify query and select prompt
-            answer_type = self._classify_query_type(query)
-            prompt = self._build_prompt(query, context_info, answer_type)
+        with tracer.span('generate_answer', timeout=timeout):
+            try:
+                if not query or len(query.strip()) < 3:
+                    return self._create_error_response(query, "Query too short", start_time)
+
+                embedding = None
+                if self.semantic_cache is not None and config['use_cache']:
+                    embedding = await wait_until(
+                        loop.run_in_executor(executor, self.semantic_cache.embed, query), remaining()
+                    )
+                    cached = self._from_cache(query, embedding, config, start_time)
+                    if cached is not None:
+                        return cached
+
+                search = partial(self.retrieval_system.search_with_reranking, query, top_k=config['max_sources'] * 2)
+                search_results = await wait_until(
+                    loop.run_in_executor(executor, contextvars.copy_context().run, search), remaining()
+                )
+
+                if not search_results:
+                    return self._create_no_results_response(query, start_time)
+
+                with tracer.span('prompt_build', results=len(search_results)) as span:
+                    context_info = self._prepare_context(query, search_results, config)
+                    answer_type = self._classify_query_type(query)
+                    prompt = self._build_prompt(query, context_info, answer_type)
+                    span.set(sources=len(context_info['sources']), prompt_chars=len(prompt))
+
+                with tracer.span('llm_call') as span:
+                    raw_answer = await wait_until(self._agenerate_with_llm(prompt, config, executor), remaining())
+                    span.set(answer_chars=len(raw_answer))
+
+                result = self._finalize_answer(query, prompt, raw_answer, context_info, answer_type, start_time)
+                self._to_cache(query, embedding, config, result)
+                return result
+
+            except asyncio.TimeoutError:
+                return self._create_timeout_response(query, timeout, start_time)
+            except Exception as e:
+                return self._create_error_response(query, str(e), start_time)
+
+    def generate_answer_stream(self, query: str, options: Dict = None) -> Iterator[Dict]:
+        """
+        Streaming version of generate_answer
+
+        Yields events as the LLM produces the answer:
+            {'type': 'delta', 'text': ...}        answer text as it arrives
+            {'type': 'citation', 'citation': ...} each [Source N] as soon as its marker is complete
+            {'type': 'final', 'result': AnswerResult}  the post-processed answer, last
+
+        The final result's citations are the ones streamed, in the same order;
+        a citation added during post-processing is streamed before 'final'.
+        The final result's metadata adds time_to_first_token (seconds from the
+        request to the first delta) and total_latency. Answers that are not
+        generated (errors, no results, cache hits) arrive as one delta.
+        """
+        start_time = time.time()
+        options = options or {}
+        config = {**self.config, **options}
 
-            # Step 5: Generate raw answer
-            raw_answer = self._generate_with_llm(prompt, config)
+        # Spans stay open across yields; a consumer that stops early closes them through GeneratorExit
+        with tracer.span('generate_answer', streamed=True):
+            try:
+                if not query or len(query.strip()) < 3:
+                    yield from self._replay(self._create_error_response(query, "Query too short", start_time))
+                    return
+
+                embedding = None
+                if self.semantic_cache is not None and config['use_cache']:
+                    embedding = self.semantic_cache.embed(query)
+                    cached = self._from_cache(query, embedding, config, start_time)
+                    if cached is not None:
+                        yield from self._replay(cached)
+                        return
+
+                search_results = self.retrieval_system.search_with_reranking(query, top_k=config['max_sources'] * 2)
+                if not search_results:
+                    yield from self._replay(self._create_no_results_response(query, start_time))
+                    return
+
+                with tracer.span('prompt_build', results=len(search_results)) as span:
+                    context_info = self._prepare_context(query, search_results, config)
+                    answer_type = self._classify_query_type(query)
+                    prompt = self._build_prompt(query, context_info, answer_type)
+                    span.set(sources=len(context_info['sources']), prompt_chars=len(prompt))
+
+                parser = StreamingCitationParser(lambda num: self._citation_for(num, context_info))
+                deltas = []
+                first_token_time = None
+
+                with tracer.span('llm_call', streamed=True) as span:
+                    llm_start = time.time()
+                    for delta in self._stream_with_llm(prompt, config):
+                        if not delta:
+                            continue
+                        if first_token_time is None:
+                            first_token_time = time.time() - start_time
+                            span.set(time_to_first_token_ms=(time.time() - llm_start) * 1000)
+                        deltas.append(delta)
+                        yield {'type': 'delta', 'text': delta}
+                        for citation in parser.feed(delta):
+                            yield {'type': 'citation', 'citation': citation}
+                    span.set(deltas=len(deltas))
+
+                raw_answer = ''.join(deltas).strip() or "Unable to generate answer."
+                result = self._finalize_answer(query, prompt, raw_answer, context_info, answer_type,
+                                               start_time, citations=parser.citations)
+                for citation in result.citations[len(parser.citations):]:
+                    yield {'type': 'citation', 'citation': citation}
+                result.metadata.update({
+                    'streamed': True,
+                    'time_to_first_token': first_token_time,
+                    'total_latency': time.time() - start_time
+                })
+                self._to_cache(query, embedding, config, result)
 
-            # Step 6: Post-process and extract citations
+            except Exception as e:
+                result = self._create_error_response(query, str(e), start_time)
+
+            yield {'type': 'final', 'result': result}
+
+    def _replay(self, result: AnswerResult) -> Iterator[Dict]:
+        """Stream events for an answer that was not generated token by token"""
+        yield {'type': 'delta', 'text': result.answer}
+        for citation in result.citations:
+            yield {'type': 'citation', 'citation': citation}
+        result.metadata.update({'streamed': False, 'time_to_first_token': result.generation_time,
+                                'total_latency': result.generation_time})
+        yield {'type': 'final', 'result': result}
+
+    def _finalize_answer(self, query: str, prompt: str, raw_answer: str, context_info: Dict,
+                         answer_type: str, start_time: float, citations: List[Dict] = None) -> AnswerResult:
+        """
+        Post-process the raw answer, score it and build the final result
+
+        citations, when given, are the ones already found while streaming and
+        replace the ones extracted from raw_answer.
+        """
+
+        with tracer.span('post_process') as span:
+            # Post-process and extract citations
             processed_answer = self._post_process_answer(raw_answer, context_info)
+            if citations is not None:
+                processed_answer['citations'] = list(citations)
 
-            # Step 7: Calculate confidence and apply quality rules
+            # Calculate confidence and apply quality rules
             confidence = self._calculate_confidence(query, processed_answer, context_info)
             enhanced_answer = self._enhance_answer_quality(
                 processed_answer, query, context_info, answer_type
             )
+            span.set(citations=len(enhanced_answer['citations']))
+
+        # Build final result
+        generation_time = time.time() - start_time
+
+        return AnswerResult(
+            query=query,
+            answer=enhanced_answer['text'],
+            confidence_score=confidence,
+            sources=context_info['sources'],
+            citations=enhanced_answer['citations'],
+            answer_type=answer_type,
+            generation_time=generation_time,
+            metadata={
+                'context_length': context_info['total_length'],
+                'sources_used': len(context_info['sources']),
+                'prompt_length': len(prompt),
+                'raw_answer_length': len(raw_answer),
+                'enhancement_applied': enhanced_answer.get('enhancements', []),
+                'timestamp': datetime.now().isoformat()
+            }
+        )
 
-            # Step 8: Build final result
-            generation_time = time.time() - start_time
-
-            return AnswerResult(
-                query=query,
-                answer=enhanced_answer['text'],
-                confidence_score=confidence,
-                sources=context_info['sources'],
-                citations=enhanced_answer['citations'],
-                answer_type=answer_type,
-                generation_time=generation_time,
-                metadata={
-                    'context_length': context_info['total_length'],
-                    'sources_used': len(context_info['sources']),
-                    'prompt_length': len(prompt),
-                    'raw_answer_length': len(raw_answer),
-                    'enhancement_applied': enhanced_answer.get('enhancements', []),
-                    'timestamp': datetime.now().isoformat()
-                }
+    def _base_rag(self):
+        """Underlying HybridRetrievalRAG (the retrieval system itself if it is not a reranking wrapper)"""
+        return getattr(self.retrieval_system, 'base_rag', self.retrieval_system)
+
+    def _cache_params(self, config: Dict) -> Dict:
+        """Settings that change the answer; cached answers only match requests with the same ones"""
+        keys = ('max_context_length', 'max_answer_length', 'max_sources', 'temperature')
+        return {key: config[key] for key in keys}
+
+    def _from_cache(self, query: str, embedding, config: Dict, start_time: float) -> Optional[AnswerResult]:
+        """Cached answer of the nearest paraphrase, with cache provenance in metadata"""
+        with tracer.span('semantic_cache') as span:
+            hit = self.semantic_cache.lookup(
+                query, getattr(self._base_rag(), 'source_versions', None), embedding=embedding,
+                **self._cache_params(config)
             )
+            span.set(hit=hit is not None)
 
-        except Exception as e:
-            return self._create_error_response(query, str(e), start_time)
+        if hit is None:
+            return None
+
+        # A deep copy, so a caller mutating sources, citations or metadata never alters later hits
+        result, provenance = copy.deepcopy(hit[0]), hit[1]
+        return replace(
+            result,
+            query=query,
+            generation_time=time.time() - start_time,
+            metadata={**result.metadata, 'cache': {'hit': True, **provenance}}
+        )
+
+    def _to_cache(self, query: str, embedding, config: Dict, result: AnswerResult):
+        """Cache an answer unless caching is off or its confidence is below the threshold"""
+        if embedding is None or result.confidence_score < config['confidence_threshold']:
+            return
+
+        self.semantic_cache.store(
+            query, result, [source['source'] for source in result.sources],
+            getattr(self._base_rag(), 'source_versions', None), embedding=embedding,
+            **self._cache_params(config)
+        )
 
     def _init_prompt_templates(self) -> Dict[str, str]:
         """Initialize all prompt templates"""
@@ -284,6 +596,52 @@ ANSWER:"""
             print(f"⚠️ LLM generation error: {e}")
             return f"Error generating answer: {str(e)}"
 
+    def _stream_with_llm(self, prompt: str, config: Dict) -> Iterator[str]:
+        """Answer text deltas; clients without generate_stream yield their whole answer at once"""
+
+        if self.llm_client is None:
+            yield self._generate_fallback_answer(prompt)
+            return
+
+        if not hasattr(self.llm_client, 'generate_stream'):
+            yield self._generate_with_llm(prompt, config)
+            return
+
+        try:
+            yield from self.llm_client.generate_stream(
+                prompt,
+                max_tokens=config['max_answer_length'],
+                temperature=config['temperature']
+            )
+        except Exception as e:
+            print(f"⚠️ LLM generation error: {e}")
+            yield f"Error generating answer: {str(e)}"
+
+    async def _agenerate_with_llm(self, prompt: str, config: Dict, executor=None) -> str:
+        """Async LLM generation; clients without agenerate run generate on executor"""
+
+        if self.llm_client is None:
+            return self._generate_fallback_answer(prompt)
+
+        try:
+            if hasattr(self.llm_client, 'agenerate'):
+                response = await self.llm_client.agenerate(
+                    prompt,
+                    max_tokens=config['max_answer_length'],
+                    temperature=config['temperature']
+                )
+            else:
+                generate = partial(self.llm_client.generate, prompt,
+                                   max_tokens=config['max_answer_length'], temperature=config['temperature'])
+                response = await asyncio.get_running_loop().run_in_executor(
+                    executor, contextvars.copy_context().run, generate
+                )
+            return response.strip() if response else "Unable to generate answer."
+
+        except Exception as e:
+            print(f"⚠️ LLM generation error: {e}")
+            return f"Error generating answer: {str(e)}"
+
     def _generate_fallback_answer(self, prompt: str) -> str:
         """Generate a basic answer for testing without LLM"""
 
@@ -307,15 +665,9 @@ ANSWER:"""
         found_citations = []
 
         for match in re.finditer(citation_pattern, raw_answer):
-            source_num = int(match.group(1))
-            if 1 <= source_num <= len(context_info['sources']):
-                source = context_info['sources'][source_num - 1]
-                found_citations.append({
-                    'source_id': source_num,
-                    'source_name': source['source'],
-                    'doc_type': source['doc_type'],
-                    'score': source['score']
-                })
+            citation = self._citation_for(int(match.group(1)), context_info)
+            if citation is not None:
+                found_citations.append(citation)
 
         # Remove duplicate citations
         unique_citations = []
@@ -340,6 +692,19 @@ ANSWER:"""
             'raw_text': raw_answer
         }
 
+    def _citation_for(self, source_num: int, context_info: Dict) -> Optional[Dict]:
+        """Citation for [Source source_num], or None if there is no such source"""
+        if not 1 <= source_num <= len(context_info['sources']):
+            return None
+
+        source = context_info['sources'][source_num - 1]
+        return {
+            'source_id': source_num,
+            'source_name': source['source'],
+            'doc_type': source['doc_type'],
+            'score': source['score']
+        }
+
     def _calculate_confidence(self, query: str, processed_answer: Dict, context_info: Dict) -> float:
         """Calculate confidence score for the generated answer"""
 
@@ -491,6 +856,19 @@ ANSWER:"""
             metadata={'error': error_msg, 'timestamp': datetime.now().isoformat()}
         )
 
+    def _create_timeout_response(self, query: str, timeout: float, start_time: float) -> AnswerResult:
+        """Create response for a request that ran past its deadline"""
+        return AnswerResult(
+            query=query,
+            answer="I'm sorry, this question took too long to answer. Please try again.",
+            confidence_score=0.0,
+            sources=[],
+            citations=[],
+            answer_type='timeout',
+            generation_time=time.time() - start_time,
+            metadata={'error': f'Deadline of {timeout}s exceeded', 'timestamp': datetime.now().isoformat()}
+        )
+
     def _create_no_results_response(self, query: str, start_time: float) -> AnswerResult:
         """Create response when no relevant documents found"""
         return AnswerResult(
@@ -519,6 +897,12 @@ class OpenAIClient:
         # For demo purposes, return placeholder
         return "OpenAI response would go here based on the prompt"
 
+    async def agenerate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        return self.generate(prompt, max_tokens, temperature)
+
+    def generate_stream(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> Iterator[str]:
+        yield self.generate(prompt, max_tokens, temperature)
+
 
 class OllamaClient:
     """Ollama local LLM client wrapper"""
@@ -532,10 +916,33 @@ class OllamaClient:
         # For demo purposes, return placeholder
         return "Ollama response would go here based on the prompt"
 
+    async def agenerate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        return self.generate(prompt, max_tokens, temperature)
+
+    def generate_stream(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> Iterator[str]:
+        yield self.generate(prompt, max_tokens, temperature)
+
 
 class TestLLMClient:
     """Test LLM client that generates realistic responses for demo"""
 
+    def __init__(self, latency: float = 0.0, token_latency: float = 0.0):
+        self.latency = latency  # Simulated network time for agenerate and the first streamed token, in seconds
+        self.token_latency = token_latency  # Simulated time per further streamed token
+
+    async def agenerate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.generate(prompt, max_tokens, temperature)
+
+    def generate_stream(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> Iterator[str]:
+        """generate's answer a word at a time, so citation markers arrive split across deltas"""
+        time.sleep(self.latency)
+        for i, token in enumerate(re.findall(r'\S+\s*', self.generate(prompt, max_tokens, temperature))):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            yield token
+
     def generate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
         # Parse the query from prompt
         query_match = re.search(r'USER QUESTION: (.+)', prompt)
@@ -0,0 +1,329 @@
+# model_registry.py
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+from score_cache import PairScoreCache
+from token_cache import TokenCache
+from onnx_backend import OnnxCrossEncoder
+
+# Inference backend used when a reranker does not ask for one: torch, onnx or onnx-int8
+DEFAULT_BACKEND = os.environ.get('RERANKER_BACKEND', 'torch')
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of cross-encoder models
+
+    Rerankers ask for a model by name and get a SharedCrossEncoder proxy.
+    The model itself is loaded on the first predict call and shared by every
+    proxy for the same name. It stays resident when its proxies are released
+    or garbage-collected, so short-lived rerankers never force a reload; it
+    is only unloaded by evict() or (when idle_timeout is set) after going
+    unused for that many seconds. The next predict reloads it.
+    """
+
+    def __init__(self, idle_timeout: Optional[float] = None, loader=None,
+                 score_cache: Optional[PairScoreCache] = None, onnx_threads: int = None):
+        """
+        Args:
+            idle_timeout: Seconds without a predict before a model is unloaded (None = never)
+            loader: Callable building a model from its name (the 'torch' backend)
+            score_cache: Pair-score cache shared by all proxies (None = no caching)
+            onnx_threads: Intra-op threads for ONNX backends (default: all cores)
+        """
+        loader = loader or _load_cross_encoder
+        self.idle_timeout = idle_timeout
+        self.loader = loader
+        self.backends = {
+            'torch': loader,
+            'onnx': lambda name: OnnxCrossEncoder.from_pretrained(
+                name, quantized=False, intra_op_threads=onnx_threads),
+            'onnx-int8': lambda name: OnnxCrossEncoder.from_pretrained(
+                name, quantized=True, intra_op_threads=onnx_threads)
+        }
+        self.score_cache = score_cache
+        self.entries = {}
+        self.lock = threading.Lock()
+        self._reaper = None
+
+    def acquire(self, model_name: str, max_length: int = None, backend: str = None) -> 'SharedCrossEncoder':
+        """Reference-counted proxy for model_name on a backend; nothing is loaded yet"""
+        backend = backend or DEFAULT_BACKEND
+        if backend not in self.backends:
+            raise ValueError(f"Unknown reranker backend: {backend}")
+
+        # Each backend is its own registry entry (and score-cache model id)
+        key = model_name if backend == 'torch' else f"{model_name}[{backend}]"
+        with self.lock:
+            entry = self._entry(key, model_name, self.backends[backend])
+            entry['refcount'] += 1
+        self._start_reaper()
+        return SharedCrossEncoder(self, key, max_length)
+
+    def release(self, model_name: str):
+        """Drop one reference; the model stays loaded for the next acquire"""
+        with self.lock:
+            entry = self.entries.get(model_name)
+            if entry is not None and entry['refcount'] > 0:
+                entry['refcount'] -= 1
+
+    def evict(self, model_name: str) -> bool:
+        """Unload model_name now, referenced or not; returns whether it was loaded"""
+        with self.lock:
+            entry = self.entries.get(model_name)
+            if entry is None or entry['model'] is None:
+                return False
+            self._unload(entry)
+            return True
+
+    def get_model(self, model_name: str):
+        """Loaded model for model_name, loading it on first use"""
+        with self.lock:
+            entry = self._entry(model_name)
+
+        # Per-model lock: loading one model never blocks users of another
+        with entry['lock']:
+            if entry['model'] is None:
+                start_time = time.time()
+                entry['model'] = entry['loader'](entry['model_name'])
+                entry['load_time'] = time.time() - start_time
+                entry['loads'] += 1
+                entry['param_bytes'] = self._param_bytes(entry['model'])
+                print(f"📦 Loaded {model_name} in {entry['load_time']:.2f}s")
+            entry['last_used'] = time.time()
+            return entry['model']
+
+    def model_lock(self, model_name: str) -> threading.RLock:
+        """Lock held while a proxy temporarily changes shared model settings"""
+        with self.lock:
+            return self._entry(model_name)['lock']
+
+    def unload_idle(self) -> int:
+        """Unload models unused for idle_timeout seconds; returns how many"""
+        if self.idle_timeout is None:
+            return 0
+
+        now = time.time()
+        unloaded = 0
+        with self.lock:
+            for entry in self.entries.values():
+                if entry['model'] is not None and now - entry['last_used'] >= self.idle_timeout:
+                    self._unload(entry)
+                    unloaded += 1
+        return unloaded
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Load state, references, load time and parameter memory per model"""
+        with self.lock:
+            return {
+                name: {
+                    'loaded': entry['model'] is not None,
+                    'refcount': entry['refcount'],
+                    'loads': entry['loads'],
+                    'load_time': entry['load_time'],
+                    'param_bytes': entry['param_bytes'] if entry['model'] is not None else 0,
+                    'idle_seconds': time.time() - entry['last_used'] if entry['last_used'] else None
+                }
+                for name, entry in self.entries.items()
+            }
+
+    def print_stats(self):
+        """Print a one-line summary per registered model"""
+        print(f"\n📦 MODEL REGISTRY")
+        for name, stats in self.get_stats().items():
+            state = "loaded" if stats['loaded'] else "not loaded"
+            print(f"   {name}: {state} | refs: {stats['refcount']} | loads: {stats['loads']} | "
+                  f"load time: {stats['load_time']:.2f}s | memory: {stats['param_bytes'] / 1024 ** 2:.1f} MB")
+
+        if self.score_cache is not None:
+            cache_stats = self.score_cache.get_stats()
+            print(f"   score cache: {cache_stats['entries']} entries | hit ratio: {cache_stats['hit_ratio']:.1%} | "
+                  f"saved: {cache_stats['saved_time']:.2f}s")
+
+    def _entry(self, key: str, model_name: str = None, loader=None) -> Dict:
+        if key not in self.entries:
+            self.entries[key] = {
+                'model_name': model_name or key,
+                'loader': loader or self.loader,
+                'model': None,
+                'refcount': 0,
+                'loads': 0,
+                'load_time': 0.0,
+                'param_bytes': 0,
+                'last_used': None,
+                'lock': threading.RLock()
+            }
+        return self.entries[key]
+
+    def _unload(self, entry: Dict):
+        # Wait for an in-flight predict on this model to finish
+        with entry['lock']:
+            entry['model'] = None
+
+    def _param_bytes(self, model) -> int:
+        """Bytes held by the model's parameters and buffers"""
+        module = getattr(model, 'model', model)
+        total = 0
+        for tensors in ('parameters', 'buffers'):
+            if hasattr(module, tensors):
+                total += sum(t.numel() * t.element_size() for t in getattr(module, tensors)())
+        return total
+
+    def _start_reaper(self):
+        """Background thread unloading idle models, started on first acquire"""
+        if self.idle_timeout is None or self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(max(self.idle_timeout / 2, 1.0))
+                self.unload_idle()
+
+        self._reaper = threading.Thread(target=reap, daemon=True)
+        self._reaper.start()
+
+
+class SharedCrossEncoder:
+    """
+    Handle to a registry model that behaves like a CrossEncoder
+
+    max_length is kept per proxy, so one reranker truncating to 256 tokens
+    does not change the model other rerankers see. When the registry has a
+    score cache, predict only sends uncached pairs to the model. With a
+    token cache enabled, model inputs are built from pre-tokenized chunk ids
+    instead of re-tokenizing the text on every call.
+    """
+
+    # predict() arguments that do not change the scores, so cached scores still apply
+    CACHE_SAFE_KWARGS = {'batch_size', 'show_progress_bar'}
+
+    def __init__(self, registry: ModelRegistry, model_name: str, max_length: int = None):
+        self.__dict__['registry'] = registry
+        self.__dict__['model_name'] = model_name
+        self.__dict__['max_length'] = max_length
+        self.__dict__['released'] = False
+        self.__dict__['token_cache'] = None
+
+    def enable_token_cache(self, **kwargs) -> TokenCache:
+        """Score from cached chunk token ids; kwargs go to TokenCache"""
+        if self.token_cache is None:
+            self.__dict__['token_cache'] = TokenCache(
+                lambda: getattr(self.registry.get_model(self.model_name), 'tokenizer', None), **kwargs
+            )
+        return self.token_cache
+
+    def predict(self, sentences, **kwargs):
+        if len(sentences) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        cache = self.registry.score_cache
+        if cache is None or not set(kwargs) <= self.CACHE_SAFE_KWARGS:
+            return self.predict_uncached(sentences, **kwargs)
+
+        # Truncation changes scores, so max_length is part of the model id
+        scores, keys = cache.lookup(f"{self.model_name}@{self.max_length}", sentences)
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        if missing:
+            start_time = time.time()
+            missing_scores = self.predict_uncached([sentences[i] for i in missing], **kwargs)
+            cache.store([keys[i] for i in missing], missing_scores, time.time() - start_time)
+
+            for i, score in zip(missing, missing_scores):
+                scores[i] = score
+
+        return np.asarray(scores, dtype=np.float32)
+
+    def predict_uncached(self, sentences, **kwargs):
+        """Score with the shared model, bypassing the score cache"""
+        if len(sentences) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        model = self.registry.get_model(self.model_name)
+
+        if (self.token_cache is not None and set(kwargs) <= self.CACHE_SAFE_KWARGS
+                and self.token_cache.available()):
+            return self._predict_from_ids(model, sentences, kwargs.get('batch_size', 32))
+
+        # Every path holds the model lock: an unlocked predict could run while another
+        # proxy has the shared model's max_length swapped, and cache a wrongly truncated score
+        with self.registry.model_lock(self.model_name):
+            if self.max_length is None:
+                return model.predict(sentences, **kwargs)
+
+            default_length = model.max_length
+            model.max_length = self.max_length
+            try:
+                return model.predict(sentences, **kwargs)
+            finally:
+                model.max_length = default_length
+
+    def _predict_from_ids(self, model, sentences, batch_size: int) -> np.ndarray:
+        """Run the model on inputs assembled from cached token ids"""
+        import torch
+
+        max_length = self.max_length or model.max_length or 512
+
+        if hasattr(model, 'predict_features'):  # ONNX backends take numpy inputs
+            return np.concatenate([
+                model.predict_features(self.token_cache.build_features(sentences[start:start + batch_size], max_length))
+                for start in range(0, len(sentences), batch_size)
+            ])
+
+        network = model.model
+        device = next(network.parameters()).device
+        # Same activation CrossEncoder.predict applies (attribute name varies by version)
+        activation = getattr(model, 'activation_fn', None) or getattr(model, 'default_activation_function', None)
+
+        scores = []
+        with torch.no_grad():
+            for start in range(0, len(sentences), batch_size):
+                features = self.token_cache.build_features(sentences[start:start + batch_size], max_length)
+                inputs = {name: torch.from_numpy(array).to(device) for name, array in features.items()}
+                logits = network(**inputs).logits
+                if activation is not None:
+                    logits = activation(logits)
+                scores.append(logits.float().cpu().numpy())
+
+        scores = np.concatenate(scores)
+        return scores[:, 0] if scores.shape[1] == 1 else scores
+
+    def release(self):
+        """Give this proxy's reference back to the registry"""
+        if not self.released:
+            self.__dict__['released'] = True
+            self.registry.release(self.model_name)
+
+    def __getattr__(self, name):
+        # Anything else (tokenizer, config, ...) comes from the shared model
+        return getattr(self.registry.get_model(self.model_name), name)
+
+    def __setattr__(self, name, value):
+        if name == 'max_length':
+            self.__dict__['max_length'] = value
+        else:
+            setattr(self.registry.get_model(self.model_name), name, value)
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+def _load_cross_encoder(model_name: str):
+    """The 'torch' backend; imported on first load so the registry works without torch"""
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name)
+
+
+# Shared by every reranker in the process
+default_registry = ModelRegistry(score_cache=PairScoreCache())
+
+
+def get_cross_encoder(model_name: str, max_length: int = None, backend: str = None) -> SharedCrossEncoder:
+    """Shared, lazily loaded cross-encoder from the default registry"""
+    return default_registry.acquire(model_name, max_length, backend)
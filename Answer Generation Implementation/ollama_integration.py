@@ -1,7 +1,14 @@
 # ollama_integration.py
+import asyncio
+import json
 import requests
 from complete_answer_system import ProductionAnswerGenerator
 
+try:
+    import aiohttp
+except ImportError:  # Only needed for agenerate
+    aiohttp = None
+
 
 class OllamaAnswerSystem:
     def __init__(self, retrieval_system, model: str = "llama2", host: str = "http://localhost:11434"):
@@ -13,11 +20,21 @@ class OllamaAnswerSystem:
     def generate_answer(self, query: str, **options):
         return self.answer_generator.generate_answer(query, options)
 
+    async def agenerate_answer(self, query: str, timeout: float = None, executor=None, **options):
+        return await self.answer_generator.agenerate_answer(query, options, timeout=timeout, executor=executor)
+
+    def generate_answer_stream(self, query: str, **options):
+        return self.answer_generator.generate_answer_stream(query, options)
+
 
 class OllamaLLMClient:
-    def __init__(self, model: str, host: str):
+    def __init__(self, model: str, host: str, max_connections: int = 32):
         self.model = model
         self.host = host
+        # agenerate shares one connection pool; requests beyond max_connections wait for a free slot
+        self.max_connections = max_connections
+        self._session = None
+        self._session_loop = None
 
     def generate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
         try:
@@ -39,6 +56,84 @@ class OllamaLLMClient:
         except Exception as e:
             raise Exception(f"Ollama connection error: {str(e)}")
 
+    def generate_stream(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1):
+        """Yield answer text as Ollama produces it (one JSON object per line)"""
+        try:
+            response = requests.post(f"{self.host}/api/generate", json={
+                "model": self.model,
+                "prompt": prompt,
+                "options": {
+                    "temperature": temperature,
+                    "num_predict": max_tokens
+                },
+                "stream": True
+            }, stream=True)
+
+            # Inside the with so an error status still releases the connection
+            with response:
+                if response.status_code != 200:
+                    raise Exception(f"Ollama API error: {response.status_code}")
+
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    yield chunk.get("response", "")
+                    if chunk.get("done"):
+                        break
+
+        except Exception as e:
+            raise Exception(f"Ollama connection error: {str(e)}")
+
+    async def agenerate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        """Non-blocking generate; cancelling the awaiting task aborts the HTTP request"""
+        session = self._get_session()
+        try:
+            async with session.post(f"{self.host}/api/generate", json={
+                "model": self.model,
+                "prompt": prompt,
+                "options": {
+                    "temperature": temperature,
+                    "num_predict": max_tokens
+                },
+                "stream": False
+            }) as response:
+                if response.status == 200:
+                    return (await response.json())["response"].strip()
+                else:
+                    raise Exception(f"Ollama API error: {response.status}")
+
+        except Exception as e:
+            raise Exception(f"Ollama connection error: {str(e)}")
+
+    def _get_session(self):
+        """
+        Connection pool for the running event loop
+
+        The pool can only be closed from the loop that opened it, so a client
+        serves one event loop at a time: call aclose() there before using the
+        client from another loop.
+        """
+        if aiohttp is None:
+            raise ImportError("agenerate needs aiohttp: pip install aiohttp")
+
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed:
+            if self._session_loop is not loop:
+                raise RuntimeError("OllamaLLMClient session is open on another event loop; "
+                                   "await aclose() in that loop before switching")
+            return self._session
+
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        self._session_loop = loop
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
 # Usage example:
 # ollama_system = OllamaAnswerSystem(your_retrieval_system, "llama2")
 # result = ollama_system.generate_answer("How many sick days do new employees get?")
\ No newline at end of file
@@ -0,0 +1,225 @@
+# onnx_backend.py
+import argparse
+import inspect
+import json
+import os
+import time
+from typing import List, Dict
+
+import numpy as np
+from scipy.stats import kendalltau
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:  # Only needed for the 'onnx' and 'onnx-int8' backends
+    ort = None
+
+DEFAULT_CACHE_DIR = os.environ.get('ONNX_CACHE_DIR', 'onnx_models')
+
+
+def export_cross_encoder(model_name: str, cache_dir: str = DEFAULT_CACHE_DIR, quantize: bool = True) -> str:
+    """
+    Export a CrossEncoder to ONNX (and a dynamic int8 copy); returns the model directory
+
+    Exports are reused: a directory that already holds model.onnx is left as is.
+    """
+    if ort is None:
+        raise ImportError("The ONNX backend needs onnxruntime: pip install onnxruntime")
+
+    model_dir = os.path.join(cache_dir, model_name.replace('/', '__'))
+    fp32_path = os.path.join(model_dir, 'model.onnx')
+    int8_path = os.path.join(model_dir, 'model.int8.onnx')
+
+    if not os.path.exists(fp32_path):
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        print(f"📦 Exporting {model_name} to ONNX...")
+        model = CrossEncoder(model_name)
+        network = model.model.eval()
+        os.makedirs(model_dir, exist_ok=True)
+
+        features = dict(model.tokenizer(["example query"], ["example document text"], return_tensors='pt'))
+        input_names, args = forward_inputs(network, features)
+        with torch.no_grad():
+            torch.onnx.export(
+                network, args, fp32_path,
+                input_names=input_names,
+                output_names=['logits'],
+                dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names}, 'logits': {0: 'batch'}},
+                opset_version=14
+            )
+
+        model.tokenizer.save_pretrained(model_dir)
+        with open(os.path.join(model_dir, 'reranker_config.json'), 'w') as f:
+            json.dump({
+                'model_name': model_name,
+                'input_names': input_names,
+                'max_length': model.max_length or 512,
+                # CrossEncoder.predict applies a sigmoid to single-logit models
+                'activation': 'sigmoid' if network.config.num_labels == 1 else 'identity'
+            }, f, indent=2)
+
+    if quantize and not os.path.exists(int8_path):
+        print(f"📦 Quantizing {model_name} to int8...")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    return model_dir
+
+
+def forward_inputs(network, features: Dict):
+    """
+    Tokenizer outputs as positional arguments of network.forward, with their graph input names
+
+    The exporter names graph inputs by position, and tokenizers return
+    token_type_ids before attention_mask while BERT's forward takes them the
+    other way round, so names and tensors both follow forward's parameter
+    order. Parameters before the last tokenizer output that it does not
+    provide are passed as None.
+    """
+    parameters = [name for name in inspect.signature(network.forward).parameters if name != 'self']
+    input_names = [name for name in parameters if name in features]
+    missing = set(features) - set(input_names)
+    if missing:
+        raise ValueError(f"{type(network).__name__}.forward has no parameters for {sorted(missing)}")
+
+    last = parameters.index(input_names[-1])
+    args = tuple(features.get(name) for name in parameters[:last + 1])
+    return input_names, args
+
+
+class OnnxCrossEncoder:
+    """CrossEncoder-compatible reranker running an exported model on ONNX Runtime (CPU)"""
+
+    def __init__(self, model_dir: str, quantized: bool = True, intra_op_threads: int = None):
+        """
+        Args:
+            model_dir: Directory written by export_cross_encoder
+            quantized: Use the dynamic int8 model instead of fp32
+            intra_op_threads: Threads per forward pass (default: all CPU cores)
+        """
+        if ort is None:
+            raise ImportError("The ONNX backend needs onnxruntime: pip install onnxruntime")
+
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, 'reranker_config.json')) as f:
+            self.config = json.load(f)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads or os.cpu_count() or 1
+        options.inter_op_num_threads = 1  # One graph at a time; parallelism is inside ops
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        path = os.path.join(model_dir, 'model.int8.onnx' if quantized else 'model.onnx')
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = self.config['max_length']
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @classmethod
+    def from_pretrained(cls, model_name: str, quantized: bool = True, intra_op_threads: int = None,
+                        cache_dir: str = DEFAULT_CACHE_DIR) -> 'OnnxCrossEncoder':
+        """Export model_name if needed, then load it"""
+        model_dir = export_cross_encoder(model_name, cache_dir, quantize=quantized)
+        return cls(model_dir, quantized=quantized, intra_op_threads=intra_op_threads)
+
+    def predict(self, sentences, batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        """Scores for [query, text] pairs, like CrossEncoder.predict"""
+        scores = []
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            features = self.tokenizer([q for q, _ in batch], [t for _, t in batch], padding=True,
+                                      truncation='longest_first', max_length=self.max_length,
+                                      return_tensors='np')
+            scores.append(self.predict_features(features))
+        return np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+
+    def predict_features(self, features: Dict[str, np.ndarray]) -> np.ndarray:
+        """Scores for already tokenized, padded inputs"""
+        inputs = {name: np.asarray(array, dtype=np.int64) for name, array in features.items()
+                  if name in self.input_names}
+        logits = self.session.run(['logits'], inputs)[0].astype(np.float32)
+
+        if self.config['activation'] == 'sigmoid':
+            logits = 1.0 / (1.0 + np.exp(-logits))
+        return logits[:, 0] if logits.shape[1] == 1 else logits
+
+
+def benchmark_backends(model_name: str, queries: List[str], candidate_texts: List[List[str]],
+                       backends=('torch', 'onnx', 'onnx-int8'), top_k: int = 10,
+                       repeats: int = 3) -> Dict[str, Dict]:
+    """
+    Pairs/sec and ranking agreement with the PyTorch model for each backend
+
+    Agreement is measured per query against the 'torch' scores: Kendall tau
+    over all candidates and NDCG@top_k, with the PyTorch top_k as graded
+    relevance (top_k for rank 1 down to 1 for rank top_k).
+    """
+    from model_registry import ModelRegistry
+
+    # A private registry without a score cache, so every run is real inference
+    registry = ModelRegistry()
+    pairs = [[[query, text] for text in texts] for query, texts in zip(queries, candidate_texts)]
+    num_pairs = sum(len(query_pairs) for query_pairs in pairs)
+
+    scores, report = {}, {}
+    for backend in ('torch',) + tuple(b for b in backends if b != 'torch'):
+        reranker = registry.acquire(model_name, backend=backend)
+        reranker.predict([pairs[0][0]])  # Load and warm up outside the timing
+
+        start_time = time.time()
+        for _ in range(repeats):
+            scores[backend] = [np.asarray(reranker.predict(query_pairs)) for query_pairs in pairs]
+        elapsed = time.time() - start_time
+
+        taus, ndcgs = [], []
+        for reference, candidate in zip(scores['torch'], scores[backend]):
+            taus.append(kendalltau(reference, candidate)[0] if len(reference) > 1 else 1.0)
+            ndcgs.append(_ndcg_against(reference, candidate, top_k))
+
+        report[backend] = {
+            'pairs_per_sec': repeats * num_pairs / elapsed,
+            'kendall_tau': float(np.nanmean(taus)),
+            f'ndcg@{top_k}': float(np.mean(ndcgs))
+        }
+        print(f"{backend:<10} | {report[backend]['pairs_per_sec']:>8,.0f} pairs/sec | "
+              f"Kendall tau: {report[backend]['kendall_tau']:.3f} | "
+              f"NDCG@{top_k}: {report[backend][f'ndcg@{top_k}']:.3f}")
+
+    return report
+
+
+def _ndcg_against(reference: np.ndarray, candidate: np.ndarray, top_k: int) -> float:
+    """NDCG@top_k of candidate's ranking, with reference's top_k as graded relevance"""
+    relevance = np.zeros(len(reference))
+    reference_top = np.argsort(-reference, kind='stable')[:top_k]
+    relevance[reference_top] = np.arange(len(reference_top), 0, -1)
+
+    discounts = 1.0 / np.log2(np.arange(2, top_k + 2))
+    ranked = np.argsort(-candidate, kind='stable')[:top_k]
+    dcg = float((relevance[ranked] * discounts[:len(ranked)]).sum())
+    idcg = float((relevance[reference_top] * discounts[:len(reference_top)]).sum())
+    return dcg / idcg if idcg > 0 else 1.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and benchmark ONNX cross-encoder backends")
+    parser.add_argument('model', nargs='?', default='cross-encoder/ms-marco-MiniLM-L-6-v2')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--export-only', action='store_true')
+    args = parser.parse_args()
+
+    export_cross_encoder(args.model, args.cache_dir)
+    if not args.export_only:
+        texts = [
+            'Employees receive 15-25 vacation days based on years of service. New employees get 15 days.',
+            'PTO requests must be submitted through the HR portal 14 days in advance.',
+            'Password reset: Visit company portal, enter employee ID, follow email instructions.',
+            'VPN connection: Download Cisco AnyConnect, use network credentials.',
+            'Expense reporting: Submit receipts within 30 days via expense portal.',
+            'Emergency evacuation: exit via nearest stairwell and gather at the meeting point.'
+        ] * 4
+        queries = ["How many vacation days?", "How do I reset my password?", "VPN setup", "expense receipts"]
+        benchmark_backends(args.model, queries, [texts] * len(queries), top_k=5)
@@ -15,6 +15,12 @@ class OpenAIAnswerSystem:
     def generate_answer(self, query: str, **options):
         return self.answer_generator.generate_answer(query, options)
 
+    async def agenerate_answer(self, query: str, timeout: float = None, executor=None, **options):
+        return await self.answer_generator.agenerate_answer(query, options, timeout=timeout, executor=executor)
+
+    def generate_answer_stream(self, query: str, **options):
+        return self.answer_generator.generate_answer_stream(query, options)
+
 
 class OpenAILLMClient:
     def __init__(self, model: str):
@@ -32,6 +38,34 @@ class OpenAILLMClient:
         except Exception as e:
             raise Exception(f"OpenAI API error: {str(e)}")
 
+    def generate_stream(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1):
+        """Yield answer text as the model produces it"""
+        try:
+            response = openai.ChatCompletion.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            )
+            for chunk in response:
+                yield chunk.choices[0].delta.get("content", "")
+        except Exception as e:
+            raise Exception(f"OpenAI API error: {str(e)}")
+
+    async def agenerate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        """Non-blocking generate; cancelling the awaiting task aborts the request"""
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=temperature
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            raise Exception(f"OpenAI API error: {str(e)}")
+
 # Usage example:
 # openai_system = OpenAIAnswerSystem(your_retrieval_system, "your-api-key")
 # result = openai_system.generate_answer("How many sick days do new employees get?")
\ No newline at end of file
@@ -0,0 +1,126 @@
+# score_cache.py
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a query"""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+def content_hash(text: str) -> str:
+    """Stable hash of a chunk's text"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class PairScoreCache:
+    """
+    Bounded LRU/TTL cache of cross-encoder scores
+
+    Keys are (model id, normalized query, chunk content hash), so a chunk
+    whose text changes gets a new key automatically; invalidate_chunk also
+    drops the old entries right away instead of waiting for eviction.
+    """
+
+    def __init__(self, max_entries: int = 100000, ttl: Optional[float] = 3600):
+        """
+        Args:
+            max_entries: Entries kept before the least recently used are evicted
+            ttl: Seconds an entry stays valid (None = no expiry)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys_by_chunk = {}
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'inference_time': 0.0,  # Spent scoring misses
+            'inferred_pairs': 0
+        }
+
+    def lookup(self, model_id: str, pairs: List) -> Tuple[List[Optional[float]], List[Tuple]]:
+        """Cached score (or None) and cache key for every (query, text) pair"""
+        now = time.time()
+        scores, keys = [], []
+
+        with self.lock:
+            for query, text in pairs:
+                key = (model_id, normalize_query(query), content_hash(text))
+                keys.append(key)
+
+                entry = self.entries.get(key)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self.entries.move_to_end(key)
+                    scores.append(entry[0])
+                    self.stats['hits'] += 1
+                else:
+                    if entry is not None:
+                        self._remove(key)
+                    scores.append(None)
+                    self.stats['misses'] += 1
+
+        return scores, keys
+
+    def store(self, keys: List[Tuple], scores, inference_time: float = 0.0):
+        """Cache freshly computed scores and record how long they took"""
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            for key, score in zip(keys, scores):
+                self.entries[key] = (float(score), expires_at)
+                self.entries.move_to_end(key)
+                self.keys_by_chunk.setdefault(key[2], set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+
+            self.stats['inference_time'] += inference_time
+            self.stats['inferred_pairs'] += len(keys)
+
+    def invalidate_chunk(self, text: str = None, chunk_hash: str = None) -> int:
+        """Drop every cached score for a chunk, by its old text or content hash"""
+        chunk_hash = chunk_hash or content_hash(text)
+
+        with self.lock:
+            keys = self.keys_by_chunk.pop(chunk_hash, set())
+            for key in keys:
+                self.entries.pop(key, None)
+            self.stats['invalidations'] += len(keys)
+
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_chunk.clear()
+
+    def get_stats(self) -> Dict:
+        """Hit ratio and the inference time the hits saved"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+
+        lookups = stats['hits'] + stats['misses']
+        per_pair = stats['inference_time'] / stats['inferred_pairs'] if stats['inferred_pairs'] else 0.0
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['saved_time'] = stats['hits'] * per_pair
+        return stats
+
+    def _remove(self, key: Tuple):
+        self.entries.pop(key, None)
+        chunk_keys = self.keys_by_chunk.get(key[2])
+        if chunk_keys is not None:
+            chunk_keys.discard(key)
+            if not chunk_keys:
+                del self.keys_by_chunk[key[2]]
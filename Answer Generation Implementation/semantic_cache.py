@@ -0,0 +1,164 @@
+# semantic_cache.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache matched on query meaning rather than exact text
+
+    Queries are embedded with the retrieval system's embedding model and a
+    lookup returns the answer of the most similar cached query whose cosine
+    similarity reaches similarity_threshold, so paraphrases ("how many sick
+    days for new hires" / "new employee sick leave") share one answer.
+    Embeddings live in one preallocated matrix, so the nearest-neighbour
+    search is a single matrix-vector product. Entries expire after ttl,
+    the least recently used are evicted beyond max_entries, and an entry is
+    dropped as soon as any source document it was answered from changes.
+    """
+
+    def __init__(self, encode: Callable[[str], np.ndarray], similarity_threshold: float = 0.9,
+                 max_entries: int = 1000, ttl: Optional[float] = 3600):
+        """
+        Args:
+            encode: Query → embedding, e.g. HybridRetrievalRAG._encode_query
+            similarity_threshold: Cosine similarity a cached query needs to be reused
+            max_entries: Entries kept before the least recently used are evicted
+            ttl: Seconds an entry stays valid (None = until its sources change)
+        """
+        self.encode = encode
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.embeddings = None  # (max_entries, dim), allocated on the first store
+        self.active = np.zeros(max_entries, dtype=bool)
+        self.entries = OrderedDict()  # slot -> entry, least recently used first
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.lock = threading.Lock()
+
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'stale': 0, 'evictions': 0}
+
+    def embed(self, query: str) -> np.ndarray:
+        """Unit-normalized query embedding"""
+        embedding = np.asarray(self.encode(query), dtype=np.float32).ravel()
+        return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+    def lookup(self, query: str, source_versions: Dict[str, str] = None, embedding: np.ndarray = None,
+               **params) -> Optional[Tuple[Any, Dict]]:
+        """
+        Cached value for the nearest matching query, with its provenance
+
+        Args:
+            source_versions: Current fingerprint per source; entries answered
+                from a source whose fingerprint differs are dropped
+            embedding: Precomputed embed(query), to avoid encoding twice
+            params: Request parameters that change the answer; only entries
+                stored with the same parameters match
+
+        Returns:
+            (value, provenance) on a hit, None on a miss
+        """
+        embedding = self.embed(query) if embedding is None else embedding
+        params_key = tuple(sorted(params.items()))
+        now = time.time()
+
+        with self.lock:
+            if self.embeddings is None or not self.entries:
+                self.stats['misses'] += 1
+                return None
+
+            similarities = self.embeddings @ embedding
+            candidates = np.flatnonzero(self.active & (similarities >= self.similarity_threshold))
+
+            for slot in candidates[np.argsort(-similarities[candidates])]:
+                entry = self.entries[slot]
+                if entry['params'] != params_key:
+                    continue
+                if entry['expires_at'] is not None and entry['expires_at'] <= now:
+                    self._remove(slot)
+                    self.stats['expired'] += 1
+                    continue
+                if source_versions is not None and any(
+                        source_versions.get(source) != version for source, version in entry['sources'].items()):
+                    self._remove(slot)
+                    self.stats['stale'] += 1
+                    continue
+
+                self.entries.move_to_end(slot)
+                self.stats['hits'] += 1
+                return entry['value'], {
+                    'cached_query': entry['query'],
+                    'similarity': float(similarities[slot]),
+                    'age': now - entry['created_at']
+                }
+
+            self.stats['misses'] += 1
+            return None
+
+    def store(self, query: str, value: Any, sources: Iterable[str], source_versions: Dict[str, str] = None,
+              embedding: np.ndarray = None, **params):
+        """
+        Cache value for query
+
+        Args:
+            sources: Source documents the value was built from
+            source_versions: Current fingerprint per source, checked again on lookup
+            embedding: Precomputed embed(query)
+            params: Request parameters, as passed to lookup
+        """
+        embedding = self.embed(query) if embedding is None else embedding
+        source_versions = source_versions or {}
+        now = time.time()
+
+        with self.lock:
+            if self.embeddings is None:
+                self.embeddings = np.zeros((self.max_entries, len(embedding)), dtype=np.float32)
+            if not self.free_slots:
+                self._remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+            slot = self.free_slots.pop()
+            self.embeddings[slot] = embedding
+            self.active[slot] = True
+            self.entries[slot] = {
+                'query': query,
+                'value': value,
+                'params': tuple(sorted(params.items())),
+                'sources': {source: source_versions.get(source) for source in set(sources)},
+                'created_at': now,
+                'expires_at': now + self.ttl if self.ttl is not None else None
+            }
+            self.stats['stores'] += 1
+
+    def invalidate_sources(self, sources: Iterable[str]) -> int:
+        """Drop every entry built from any of sources; returns how many were dropped"""
+        sources = set(sources)
+        with self.lock:
+            stale = [slot for slot, entry in self.entries.items() if sources & entry['sources'].keys()]
+            for slot in stale:
+                self._remove(slot)
+            self.stats['stale'] += len(stale)
+        return len(stale)
+
+    def _remove(self, slot: int):
+        del self.entries[slot]
+        self.active[slot] = False
+        self.free_slots.append(slot)
+
+    def clear(self):
+        with self.lock:
+            for slot in list(self.entries):
+                self._remove(slot)
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -1,11 +1,15 @@
 # test_complete_answer_system.py
-from complete_answer_system import ProductionAnswerGenerator, TestLLMClient
+import asyncio
+
+import pytest
+
+from complete_answer_system import ProductionAnswerGenerator, StreamingCitationParser, TestLLMClient
 from hybrid_retrieval_system import HybridRetrievalRAG
 from advanced_reranking_system import AdvancedRerankedRAG
 from typing import List, Dict
 
 
-def setup_complete_system():
+def setup_complete_system(llm_client=None):
     """Setup the complete RAG pipeline for testing"""
 
     print("🔄 Setting up complete RAG system...")
@@ -71,7 +75,7 @@ def setup_complete_system():
     reranked_rag = AdvancedRerankedRAG(hybrid_rag)
 
     # Initialize answer generation with test LLM
-    test_llm = TestLLMClient()
+    test_llm = llm_client or TestLLMClient()
     answer_generator = ProductionAnswerGenerator(reranked_rag, test_llm)
 
     print("✅ Complete RAG system ready!")
@@ -295,6 +299,148 @@ def test_edge_cases():
             print(f"❌ Error: {str(e)}")
 
 
+
+class CancellationRecordingLLMClient(TestLLMClient):
+    """Slow test client that records whether its request was cancelled"""
+
+    def __init__(self, latency: float):
+        super().__init__(latency=latency)
+        self.cancelled = False
+
+    async def agenerate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        try:
+            return await super().agenerate(prompt, max_tokens, temperature)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def test_deadline_returns_timeout_result():
+    answer_generator = setup_complete_system(TestLLMClient(latency=2.0))
+
+    result = asyncio.run(answer_generator.agenerate_answer('How many sick days do new employees get?', timeout=0.3))
+
+    assert result.answer_type == 'timeout'
+    assert result.confidence_score == 0.0
+    assert result.generation_time < 2.0
+
+
+def test_cancel_propagates_to_llm_call():
+    llm_client = CancellationRecordingLLMClient(latency=2.0)
+    answer_generator = setup_complete_system(llm_client)
+
+    async def cancel_mid_generation():
+        task = asyncio.create_task(answer_generator.agenerate_answer('How many sick days do new employees get?'))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel_mid_generation())
+    assert llm_client.cancelled
+
+
+def test_paraphrase_hits_semantic_cache():
+    answer_generator = setup_complete_system()
+    # Below the 0.9 default so the check also holds for bag-of-words test embeddings
+    cache = answer_generator.enable_semantic_cache(similarity_threshold=0.85)
+
+    first = answer_generator.generate_answer('How many sick days do new employees get?')
+    paraphrase = answer_generator.generate_answer('How many sick days do new employees get per year?')
+    unrelated = answer_generator.generate_answer('How do I set up VPN access?')
+
+    assert 'cache' not in first.metadata
+    assert paraphrase.metadata['cache']['hit']
+    assert paraphrase.metadata['cache']['cached_query'] == first.query
+    assert paraphrase.answer == first.answer
+    assert paraphrase.query == 'How many sick days do new employees get per year?'
+    assert 'cache' not in unrelated.metadata
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_changed_source_fingerprint_invalidates_cached_answer():
+    answer_generator = setup_complete_system()
+    cache = answer_generator.enable_semantic_cache()
+    query = 'How many sick days do new employees get?'
+
+    first = answer_generator.generate_answer(query)
+    assert answer_generator.generate_answer(query).metadata['cache']['hit']
+
+    # Re-indexing an edited document changes its source's fingerprint
+    base_rag = answer_generator._base_rag()
+    edited_source = first.sources[0]['source']
+    base_rag.source_versions = {**base_rag.source_versions, edited_source: 'edited'}
+
+    refreshed = answer_generator.generate_answer(query)
+    assert 'cache' not in refreshed.metadata
+    assert cache.get_stats()['stale'] == 1
+
+
+def test_split_citation_marker_parsed_once():
+    parser = StreamingCitationParser(lambda source_num: {'source_num': source_num} if source_num <= 2 else None)
+
+    citations = []
+    for delta in ['5 days [Sou', 'rce 1', '] and again [', 'Source 1][Source 2', '] not [Source 9]']:
+        citations.extend(parser.feed(delta))
+
+    assert citations == [{'source_num': 1}, {'source_num': 2}]
+    assert parser.pending == ''
+
+
+def test_stream_reports_each_citation_once():
+    answer_generator = setup_complete_system()
+
+    events = list(answer_generator.generate_answer_stream('How many sick days do new employees get?'))
+    citations = [event['citation'] for event in events if event['type'] == 'citation']
+    final = events[-1]['result']
+
+    assert events[-1]['type'] == 'final'
+    assert '[Source 1]' in ''.join(event['text'] for event in events if event['type'] == 'delta')
+    assert len(citations) == 1
+    assert citations[0]['source_id'] == 1
+    assert final.citations == citations
+    assert final.metadata['streamed']
+    assert final.metadata['time_to_first_token'] is not None
+
+
+class UncitedStreamLLMClient(TestLLMClient):
+    """Streams an answer without any [Source N] marker"""
+
+    def generate(self, prompt: str, max_tokens: int = 500, temperature: float = 0.1) -> str:
+        return "New employees receive five sick days per year."
+
+
+def test_stream_citations_match_final_result():
+    """Citations added by post-processing are streamed too, so events and result agree"""
+    answer_generator = setup_complete_system(UncitedStreamLLMClient())
+
+    events = list(answer_generator.generate_answer_stream('How many sick days do new employees get?'))
+    citations = [event['citation'] for event in events if event['type'] == 'citation']
+    final = events[-1]['result']
+
+    assert final.citations  # _ensure_citation_quality added [Source 1]
+    assert citations == final.citations
+    assert [event['type'] for event in events[-2:]] == ['citation', 'final']
+
+
+def test_semantic_cache_hits_are_isolated_copies():
+    answer_generator = setup_complete_system()
+    answer_generator.enable_semantic_cache()
+    query = 'How many sick days do new employees get?'
+
+    first = answer_generator.generate_answer(query)
+    hit = answer_generator.generate_answer(query)
+    hit.sources.clear()
+    hit.citations.append({'source_id': 99})
+    hit.metadata['injected'] = True
+
+    again = answer_generator.generate_answer(query)
+    assert again.metadata['cache']['hit']
+    assert again.sources == first.sources
+    assert again.citations == first.citations
+    assert 'injected' not in again.metadata
+
+
 if __name__ == "__main__":
     import time
 
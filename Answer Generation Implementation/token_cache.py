@@ -0,0 +1,142 @@
+# token_cache.py
+from typing import List, Dict, Callable
+
+import numpy as np
+from score_cache import content_hash
+
+
+class TokenCache:
+    """
+    Chunk token ids for one reranker tokenizer, computed once
+
+    Chunks are tokenized without special tokens (normally at index time via
+    add_texts) and looked up by content hash. build_features truncates in
+    token space and assembles padded model inputs straight from the cached
+    ids, so requests never re-tokenize chunk text; only the short query is
+    tokenized per request.
+    """
+
+    def __init__(self, tokenizer_fn: Callable, max_entries: int = 200000, max_doc_tokens: int = 512):
+        """
+        Args:
+            tokenizer_fn: Returns the tokenizer (or None); called on first use
+            max_entries: Chunks kept before the oldest are dropped
+            max_doc_tokens: Tokens stored per chunk, enough for any max_length
+        """
+        self.tokenizer_fn = tokenizer_fn
+        self.max_entries = max_entries
+        self.max_doc_tokens = max_doc_tokens
+        self._tokenizer = None
+        self._resolved = False
+
+        self.ids = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @property
+    def tokenizer(self):
+        if not self._resolved:
+            self._tokenizer = self.tokenizer_fn()
+            self._resolved = True
+        return self._tokenizer
+
+    def available(self) -> bool:
+        """Whether a tokenizer that can build pair inputs is present"""
+        return self.tokenizer is not None and hasattr(self.tokenizer, 'build_inputs_with_special_tokens')
+
+    def add_texts(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """Tokenize chunks not cached yet in one batch; returns the new ids by content hash"""
+        missing = {}
+        for text in texts:
+            key = content_hash(text)
+            if key not in self.ids:
+                missing[key] = text
+
+        if not missing:
+            return {}
+
+        encoded = self.tokenizer(list(missing.values()), add_special_tokens=False)['input_ids']
+        added = {key: np.asarray(token_ids[:self.max_doc_tokens], dtype=np.int32)
+                 for key, token_ids in zip(missing, encoded)}
+        self.ids.update(added)
+
+        while len(self.ids) > self.max_entries:
+            del self.ids[next(iter(self.ids))]
+
+        return added
+
+    def get_ids(self, texts: List[str]) -> List[np.ndarray]:
+        """Cached token ids per text, tokenizing any misses together"""
+        keys = [content_hash(text) for text in texts]
+        # Hold on to hits before adding misses, which may evict from a full cache
+        found = {key: self.ids[key] for key in keys if key in self.ids}
+        missing = [text for text, key in zip(texts, keys) if key not in found]
+
+        self.stats['misses'] += len(missing)
+        self.stats['hits'] += len(texts) - len(missing)
+        if missing:
+            found.update(self.add_texts(missing))
+
+        return [found[key] for key in keys]
+
+    def pair_lengths(self, pairs: List, max_length: int) -> np.ndarray:
+        """Model input length of each (query, text) pair, from cached ids"""
+        special = self.tokenizer.num_special_tokens_to_add(pair=True)
+        query_lengths = {query: len(ids) for query, ids in self._query_ids(pairs).items()}
+        doc_ids = self.get_ids([text for _, text in pairs])
+
+        lengths = [query_lengths[query] + len(ids) + special for (query, _), ids in zip(pairs, doc_ids)]
+        return np.minimum(np.array(lengths), max_length)
+
+    def build_features(self, pairs: List, max_length: int) -> Dict[str, np.ndarray]:
+        """
+        Padded input arrays for (query, text) pairs
+
+        The chunk is cut to whatever max_length leaves after the query and
+        special tokens; a query longer than half of max_length is cut to half.
+        """
+        tokenizer = self.tokenizer
+        special = tokenizer.num_special_tokens_to_add(pair=True)
+        query_ids = self._query_ids(pairs)
+        doc_ids = self.get_ids([text for _, text in pairs])
+
+        input_ids, token_type_ids = [], []
+        for (query, _), ids in zip(pairs, doc_ids):
+            q_ids = query_ids[query]
+            if len(q_ids) + special > max_length // 2:
+                q_ids = q_ids[:max(max_length // 2 - special, 1)]
+            d_ids = ids[:max(max_length - special - len(q_ids), 0)].tolist()
+
+            input_ids.append(tokenizer.build_inputs_with_special_tokens(q_ids, d_ids))
+            token_type_ids.append(tokenizer.create_token_type_ids_from_sequences(q_ids, d_ids))
+
+        longest = max(len(ids) for ids in input_ids)
+        pad_id = tokenizer.pad_token_id or 0
+
+        features = {
+            'input_ids': np.full((len(pairs), longest), pad_id, dtype=np.int64),
+            'attention_mask': np.zeros((len(pairs), longest), dtype=np.int64),
+            'token_type_ids': np.zeros((len(pairs), longest), dtype=np.int64)
+        }
+        for i, (ids, types) in enumerate(zip(input_ids, token_type_ids)):
+            features['input_ids'][i, :len(ids)] = ids
+            features['attention_mask'][i, :len(ids)] = 1
+            features['token_type_ids'][i, :len(types)] = types
+
+        # Only pass the inputs this model accepts (e.g. DistilBERT has no token types)
+        accepted = getattr(tokenizer, 'model_input_names', list(features))
+        return {name: array for name, array in features.items() if name in accepted}
+
+    def _query_ids(self, pairs: List) -> Dict[str, List[int]]:
+        """Token ids of each distinct query in pairs"""
+        queries = list(dict.fromkeys(query for query, _ in pairs))
+        encoded = self.tokenizer(queries, add_special_tokens=False)['input_ids']
+        return dict(zip(queries, encoded))
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {
+            **self.stats,
+            'entries': len(self.ids),
+            'token_bytes': sum(ids.nbytes for ids in self.ids.values()),
+            'hit_ratio': self.stats['hits'] / lookups if lookups else 0.0
+        }
@@ -4,6 +4,7 @@ from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 from datetime import datetime
 from typing import List, Dict, Any
+from chunk_store import ChunkStore
 
 
 class LocalRAGSystem:
@@ -19,7 +20,7 @@ class LocalRAGSystem:
         """
         print(f"🔄 Loading embedding model: {model_name}")
         self.embedding_model = SentenceTransformer(model_name)
-        self.knowledge_base = []
+        self.knowledge_base = ChunkStore()
         self.document_metadata = {}
         print(f"✅ Model loaded! Embedding dimensions: {self.embedding_model.get_sentence_embedding_dimension()}")
 
@@ -44,19 +45,14 @@ class LocalRAGSystem:
         chunk_texts = [chunk for chunk in chunks]
         embeddings = self.embedding_model.encode(chunk_texts, show_progress_bar=True)
 
-        # Store chunks with embeddings
+        # Store chunks with embeddings (ids are derived from doc_id and index)
         for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            chunk_data = {
-                "id": f"{doc_id}_chunk_{i}",
-                "document_id": doc_id,
-                "text": chunk,
-                "embedding": embedding.tolist(),  # Convert numpy to list
-                "chunk_index": i,
-                "source": source,
-                "doc_type": doc_type
-            }
-
-            self.knowledge_base.append(chunk_data)
+            self.knowledge_base.append(
+                chunk, source, doc_type,
+                document_id=doc_id,
+                chunk_index=i,
+                embedding=embedding
+            )
             self.document_metadata[doc_id]["chunk_count"] += 1
 
         print(f"✅ Added document '{source}' with {len(chunks)} chunks")
@@ -157,52 +153,38 @@ class LocalRAGSystem:
             return []
 
         # Apply filters
-        candidates = self.knowledge_base
+        rows = np.arange(len(self.knowledge_base))
         if filter_by:
-            candidates = self._apply_filters(candidates, filter_by)
+            rows = self._apply_filters(filter_by)
 
-        if not candidates:
+        if len(rows) == 0:
             return []
 
-        print(f"🔍 Searching through {len(candidates)} chunks...")
+        print(f"🔍 Searching through {len(rows)} chunks...")
 
         # Create query embedding
         query_embedding = self.embedding_model.encode([query])[0]
 
-        # Calculate similarities
-        similarities = []
-        for chunk in candidates:
-            chunk_embedding = np.array(chunk["embedding"])
-            similarity = cosine_similarity([query_embedding], [chunk_embedding])[0][0]
-            similarities.append((chunk, similarity))
-
-        # Sort and return top results
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        # Calculate similarities for all candidate rows at once
+        similarities = cosine_similarity([query_embedding], self.knowledge_base.embedding_matrix()[rows])[0]
 
+        # Build result dicts only for the top results
         results = []
-        for chunk, score in similarities[:top_k]:
+        for i in np.argsort(-similarities, kind='stable')[:top_k]:
+            row = rows[i]
             results.append({
-                "text": chunk["text"],
-                "source": chunk["source"],
-                "doc_type": chunk["doc_type"],
-                "similarity_score": float(score),
-                "document_id": chunk["document_id"]
+                "text": self.knowledge_base.text(row),
+                "source": self.knowledge_base.source(row),
+                "doc_type": self.knowledge_base.doc_type(row),
+                "similarity_score": float(similarities[i]),
+                "document_id": self.knowledge_base.document_id(row)
             })
 
         return results
 
-    def _apply_filters(self, candidates: List[Dict], filters: Dict) -> List[Dict]:
-        """Apply metadata filters"""
-        filtered = []
-        for chunk in candidates:
-            include = True
-            for key, value in filters.items():
-                if key in chunk and chunk[key] != value:
-                    include = False
-                    break
-            if include:
-                filtered.append(chunk)
-        return filtered
+    def _apply_filters(self, filters: Dict) -> np.ndarray:
+        """Apply metadata filters, returning matching row ids"""
+        return self.knowledge_base.filter_rows(filters)
 
     def get_model_info(self) -> Dict:
         """Get information about the embedding model"""
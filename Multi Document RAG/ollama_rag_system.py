@@ -1,12 +1,21 @@
 # ollama_rag_system.py
+import asyncio
+import os
 import requests
 import json
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics.pairwise import cosine_similarity
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from chunk_store import ChunkStore
 import time
 
+try:
+    import aiohttp
+except ImportError:  # Only needed for aquery_with_generation
+    aiohttp = None
+
 
 class OllamaRAGSystem:
     def __init__(self, model_name: str = "llama2", embedding_model: str = "nomic-embed-text"):
@@ -20,9 +29,15 @@ class OllamaRAGSystem:
         self.model_name = model_name
         self.embedding_model = embedding_model
         self.ollama_url = "http://localhost:11434"
-        self.knowledge_base = []
+        self.knowledge_base = ChunkStore()
         self.document_metadata = {}
 
+        # Async path: one HTTP connection pool and a bounded pool for similarity scoring
+        self.max_connections = 32
+        self.cpu_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self._session = None
+        self._session_loop = None
+
         # Test connection and models
         self._check_ollama_connection()
         self._ensure_models_available()
@@ -83,8 +98,8 @@ class OllamaRAGSystem:
         except Exception as e:
             print(f"❌ Error pulling {model_name}: {e}")
 
-    def _create_embedding(self, text: str) -> List[float]:
-        """Create embedding using Ollama"""
+    def _create_embedding(self, text: str) -> Optional[List[float]]:
+        """Create embedding using Ollama; None if Ollama could not embed the text"""
         try:
             response = requests.post(
                 f"{self.ollama_url}/api/embeddings",
@@ -100,12 +115,11 @@ class OllamaRAGSystem:
                 return embedding
             else:
                 print(f"❌ Embedding failed: {response.text}")
-                # Return random embedding as fallback
-                return np.random.randn(384).tolist()  # Default embedding size
+                return None
 
         except Exception as e:
             print(f"❌ Embedding request failed: {e}")
-            return np.random.randn(384).tolist()
+            return None
 
     def add_document(self, content: str, doc_type: str, source: str, metadata: Dict = None):
         """Add document with Ollama embeddings"""
@@ -126,28 +140,30 @@ class OllamaRAGSystem:
         # Create embeddings for each chunk
         print(f"🔄 Creating embeddings for {len(chunks)} chunks using {self.embedding_model}...")
 
+        skipped = 0
         for i, chunk in enumerate(chunks):
             print(f"   Processing chunk {i + 1}/{len(chunks)}...", end='\r')
 
             embedding = self._create_embedding(chunk)
+            if embedding is None:
+                # Never index a made-up vector; the chunk is left out instead
+                skipped += 1
+                continue
 
-            chunk_data = {
-                "id": f"{doc_id}_chunk_{i}",
-                "document_id": doc_id,
-                "text": chunk,
-                "embedding": embedding,
-                "chunk_index": i,
-                "source": source,
-                "doc_type": doc_type
-            }
-
-            self.knowledge_base.append(chunk_data)
+            self.knowledge_base.append(
+                chunk, source, doc_type,
+                document_id=doc_id,
+                chunk_index=i,
+                embedding=embedding
+            )
             self.document_metadata[doc_id]["chunk_count"] += 1
 
             # Small delay to avoid overwhelming Ollama
             time.sleep(0.1)
 
-        print(f"\n✅ Added document '{source}' with {len(chunks)} chunks")
+        if skipped:
+            print(f"\n⚠️ Skipped {skipped} chunks of '{source}' that could not be embedded")
+        print(f"\n✅ Added document '{source}' with {len(chunks) - skipped} chunks")
 
     def _chunk_document(self, content: str, doc_type: str) -> List[str]:
         """Smart chunking based on document type"""
@@ -240,70 +256,76 @@ class OllamaRAGSystem:
     def search(self, query: str, top_k: int = 5, filter_by: Dict = None) -> List[Dict]:
         """Search using Ollama embeddings"""
 
-        if not self.knowledge_base:
+        rows = self._candidate_rows(filter_by)
+        if len(rows) == 0:
+            return []
+
+        print(f"🔍 Searching through {len(rows)} chunks...")
+
+        # Create query embedding
+        query_embedding = self._create_embedding(query)
+        if query_embedding is None:
             return []
+        return self._rank_rows(query_embedding, rows, top_k)
+
+    def _candidate_rows(self, filter_by: Dict = None) -> np.ndarray:
+        """Rows to search, after metadata filters"""
+        if not self.knowledge_base:
+            return np.zeros(0, dtype=np.int64)
 
         # Apply filters
-        candidates = self.knowledge_base
+        rows = np.arange(len(self.knowledge_base))
         if filter_by:
-            candidates = self._apply_filters(candidates, filter_by)
+            rows = self._apply_filters(filter_by)
+        return rows
 
-        if not candidates:
+    def _rank_rows(self, query_embedding: List[float], rows: np.ndarray, top_k: int) -> List[Dict]:
+        """Top chunks among rows by cosine similarity to the query embedding"""
+        query_embedding_np = np.array(query_embedding)
+
+        # Ensure same dimensions (chunks whose embedding failed are skipped)
+        if len(query_embedding_np) != self.knowledge_base.embedding_dim:
+            print(f"⚠️ Dimension mismatch: query={len(query_embedding_np)}, "
+                  f"chunks={self.knowledge_base.embedding_dim}")
             return []
 
-        print(f"🔍 Searching through {len(candidates)} chunks...")
+        skipped = len(rows)
+        rows = np.intersect1d(rows, self.knowledge_base.valid_embedding_rows())
+        skipped -= len(rows)
+        if skipped:
+            print(f"⚠️ Skipped {skipped} chunks with mismatched embeddings")
 
-        # Create query embedding
-        query_embedding = self._create_embedding(query)
-
-        # Calculate similarities
-        similarities = []
-        for chunk in candidates:
-            try:
-                chunk_embedding = np.array(chunk["embedding"])
-                query_embedding_np = np.array(query_embedding)
-
-                # Ensure same dimensions
-                if len(chunk_embedding) == len(query_embedding_np):
-                    similarity = cosine_similarity([query_embedding_np], [chunk_embedding])[0][0]
-                    similarities.append((chunk, similarity))
-                else:
-                    print(f"⚠️ Dimension mismatch: query={len(query_embedding_np)}, chunk={len(chunk_embedding)}")
-
-            except Exception as e:
-                print(f"❌ Similarity calculation failed: {e}")
-                continue
+        if len(rows) == 0:
+            return []
 
-        # Sort and return top results
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        # Calculate similarities for all candidate rows at once
+        try:
+            similarities = cosine_similarity([query_embedding_np],
+                                             self.knowledge_base.embedding_matrix()[rows])[0]
+        except Exception as e:
+            print(f"❌ Similarity calculation failed: {e}")
+            return []
 
+        # Build result dicts only for the top results
         results = []
-        for chunk, score in similarities[:top_k]:
+        for i in np.argsort(-similarities, kind='stable')[:top_k]:
+            row = rows[i]
             results.append({
-                "text": chunk["text"],
-                "source": chunk["source"],
-                "doc_type": chunk["doc_type"],
-                "similarity_score": float(score),
-                "document_id": chunk["document_id"]
+                "text": self.knowledge_base.text(row),
+                "source": self.knowledge_base.source(row),
+                "doc_type": self.knowledge_base.doc_type(row),
+                "similarity_score": float(similarities[i]),
+                "document_id": self.knowledge_base.document_id(row)
             })
 
         return results
 
-    def _apply_filters(self, candidates: List[Dict], filters: Dict) -> List[Dict]:
-        """Apply metadata filters"""
-        filtered = []
-        for chunk in candidates:
-            include = True
-            for key, value in filters.items():
-                if key in chunk and chunk[key] != value:
-                    include = False
-                    break
-            if include:
-                filtered.append(chunk)
-        return filtered
+    def _apply_filters(self, filters: Dict) -> np.ndarray:
+        """Apply metadata filters, returning matching row ids"""
+        return self.knowledge_base.filter_rows(filters)
 
-    def generate_response(self, query: str, context_chunks: List[Dict]) -> str:
-        """Generate response using Ollama LLM"""
+    def _build_generation_prompt(self, query: str, context_chunks: List[Dict]) -> str:
+        """Prompt with the retrieved chunks as context"""
 
         # Build context from retrieved chunks
         context = "\n\n".join([
@@ -311,7 +333,7 @@ class OllamaRAGSystem:
             for chunk in context_chunks
         ])
 
-        prompt = f"""Based on the following company documents, answer the user's question accurately and concisely.
+        return f"""Based on the following company documents, answer the user's question accurately and concisely.
 
 Context:
 {context}
@@ -322,6 +344,11 @@ Answer based only on the provided context. If the answer is not in the context,
 
 Answer:"""
 
+    def generate_response(self, query: str, context_chunks: List[Dict]) -> str:
+        """Generate response using Ollama LLM"""
+
+        prompt = self._build_generation_prompt(query, context_chunks)
+
         try:
             response = requests.post(
                 f"{self.ollama_url}/api/generate",
@@ -366,6 +393,127 @@ Answer:"""
             "search_results": search_results
         }
 
+    async def aquery_with_generation(self, query: str, top_k: int = 3, timeout: float = None) -> Dict:
+        """
+        Non-blocking query_with_generation for serving many requests on one event loop
+
+        Ollama calls share one aiohttp connection pool and similarity scoring
+        runs on a bounded thread pool. Cancelling the calling task (e.g. on
+        client disconnect) aborts the request in flight.
+
+        Args:
+            timeout: Seconds for the whole request; past it an error answer is returned
+        """
+        try:
+            return await asyncio.wait_for(self._aquery_with_generation(query, top_k), timeout)
+        except asyncio.TimeoutError:
+            return {
+                "query": query,
+                "answer": f"Error: Could not generate response within {timeout}s",
+                "sources": [],
+                "search_results": []
+            }
+
+    async def _aquery_with_generation(self, query: str, top_k: int) -> Dict:
+        search_results = []
+        rows = self._candidate_rows()
+        if len(rows):
+            query_embedding = await self._acreate_embedding(query)
+            if query_embedding is not None:
+                search_results = await asyncio.get_running_loop().run_in_executor(
+                    self.cpu_executor, self._rank_rows, query_embedding, rows, top_k
+                )
+
+        if not search_results:
+            return {
+                "query": query,
+                "answer": "I don't have any relevant information to answer your question.",
+                "sources": [],
+                "search_results": []
+            }
+
+        answer = await self.agenerate_response(query, search_results)
+
+        return {
+            "query": query,
+            "answer": answer,
+            "sources": [result["source"] for result in search_results],
+            "search_results": search_results
+        }
+
+    async def _acreate_embedding(self, text: str) -> Optional[List[float]]:
+        """Create embedding using Ollama without blocking the event loop; None on failure"""
+        session = self._get_session()
+        try:
+            async with session.post(
+                f"{self.ollama_url}/api/embeddings",
+                json={
+                    "model": self.embedding_model,
+                    "prompt": text
+                },
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                if response.status == 200:
+                    return (await response.json())["embedding"]
+                print(f"❌ Embedding failed: {await response.text()}")
+                return None
+
+        except Exception as e:
+            print(f"❌ Embedding request failed: {e}")
+            return None
+
+    async def agenerate_response(self, query: str, context_chunks: List[Dict]) -> str:
+        """Generate response using Ollama LLM without blocking the event loop"""
+
+        prompt = self._build_generation_prompt(query, context_chunks)
+
+        session = self._get_session()
+        try:
+            async with session.post(
+                f"{self.ollama_url}/api/generate",
+                json={
+                    "model": self.model_name,
+                    "prompt": prompt,
+                    "stream": False
+                },
+                timeout=aiohttp.ClientTimeout(total=60)
+            ) as response:
+                if response.status == 200:
+                    return (await response.json())["response"]
+                return f"Error generating response: {await response.text()}"
+
+        except Exception as e:
+            return f"Error: Could not generate response - {e}"
+
+    def _get_session(self):
+        """
+        HTTP connection pool for the running event loop
+
+        The pool can only be closed from the loop that opened it, so the
+        async API serves one event loop at a time: call aclose() there before
+        using it from another loop.
+        """
+        if aiohttp is None:
+            raise ImportError("The async API needs aiohttp: pip install aiohttp")
+
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed:
+            if self._session_loop is not loop:
+                raise RuntimeError("OllamaRAGSystem session is open on another event loop; "
+                                   "await aclose() in that loop before switching")
+            return self._session
+
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        self._session_loop = loop
+        return self._session
+
+    async def aclose(self):
+        """Close the async HTTP connection pool"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
     def get_model_info(self) -> Dict:
         """Get model information"""
         try:
@@ -0,0 +1,149 @@
+# batching_server.py
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable
+
+import numpy as np
+
+
+class MicroBatchScheduler:
+    """
+    Dynamic micro-batching for cross-encoder scoring
+
+    Concurrent callers await score(pairs). Their pairs are queued and
+    flushed as one predict call once max_batch_size pairs are waiting or
+    the oldest request has waited max_wait seconds, then each caller gets
+    back the scores for its own pairs. Requests are not split, so a batch
+    holds at most max_batch_size pairs unless one request alone is larger.
+    Only one forward pass runs at a time; requests arriving meanwhile form
+    the next batch.
+    """
+
+    def __init__(self, predict_fn: Callable, max_batch_size: int = 64, max_wait: float = 0.005,
+                 executor: ThreadPoolExecutor = None):
+        """
+        Args:
+            predict_fn: Scores a list of [query, text] pairs (e.g. CrossEncoder.predict)
+            max_batch_size: Pairs that trigger an immediate flush
+            max_wait: Seconds the oldest queued request may wait before a flush
+            executor: Thread pool for the blocking predict call (default: one thread)
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+
+        self.queue = None
+        self.worker = None
+        self.loop = None
+        self.carry_over = None  # Request that did not fit the previous batch
+
+        self.batch_sizes = deque(maxlen=10000)
+        self.queue_delays = deque(maxlen=10000)
+        self.stats = {'requests': 0, 'pairs': 0, 'batches': 0, 'inference_time': 0.0}
+
+    async def score(self, pairs: List) -> np.ndarray:
+        """Scores for pairs, computed in a shared batch"""
+        if not pairs:
+            return np.zeros(0, dtype=np.float32)
+
+        self._ensure_worker()
+        future = self.loop.create_future()
+        await self.queue.put((pairs, future, time.perf_counter()))
+        return await future
+
+    def _ensure_worker(self):
+        """Start the batching task on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self.worker is not None and self.loop is loop and not self.worker.done():
+            return
+
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.worker = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            first, self.carry_over = self.carry_over or await self.queue.get(), None
+            batch = [first]
+            batch_pairs = len(first[0])
+            deadline = first[2] + self.max_wait
+
+            # Collect until the batch is full or the oldest request's wait is up;
+            # requests already queued are always taken without waiting
+            while batch_pairs < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if self.queue.empty() and timeout <= 0:
+                    break
+                if not self.queue.empty():
+                    item = self.queue.get_nowait()
+                else:
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if batch_pairs + len(item[0]) > self.max_batch_size:
+                    # Requests are never split; this one opens the next batch
+                    self.carry_over = item
+                    break
+                batch.append(item)
+                batch_pairs += len(item[0])
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List):
+        flush_time = time.perf_counter()
+        all_pairs = [pair for pairs, _, _ in batch for pair in pairs]
+
+        try:
+            scores = await self.loop.run_in_executor(self.executor, self.predict_fn, all_pairs)
+            scores = np.asarray(scores, dtype=np.float32)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.stats['inference_time'] += time.perf_counter() - flush_time
+        self.stats['requests'] += len(batch)
+        self.stats['pairs'] += len(all_pairs)
+        self.stats['batches'] += 1
+        self.batch_sizes.append(len(all_pairs))
+
+        # Route each caller's slice of the scores back to it
+        offset = 0
+        for pairs, future, enqueued_at in batch:
+            self.queue_delays.append(flush_time - enqueued_at)
+            if not future.done():  # Caller may have been cancelled
+                future.set_result(scores[offset:offset + len(pairs)])
+            offset += len(pairs)
+
+    def get_stats(self) -> Dict:
+        """Batch-size histogram (power-of-two buckets) and queueing delay percentiles"""
+        histogram = {}
+        for size in self.batch_sizes:
+            bucket = 1 << (size - 1).bit_length()
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        delays = np.array(self.queue_delays) if self.queue_delays else np.zeros(1)
+
+        return {
+            **self.stats,
+            'avg_batch_size': self.stats['pairs'] / self.stats['batches'] if self.stats['batches'] else 0.0,
+            'batch_size_histogram': dict(sorted(histogram.items())),
+            'queue_delay_p50_ms': float(np.percentile(delays, 50) * 1000),
+            'queue_delay_p95_ms': float(np.percentile(delays, 95) * 1000),
+            'queue_delay_max_ms': float(delays.max() * 1000)
+        }
+
+    async def close(self):
+        """Stop the batching task"""
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
@@ -0,0 +1,240 @@
+# compiled_trees.py
+import os
+import time
+from typing import List, Dict
+
+import numpy as np
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+
+class CompiledTreeEnsemble:
+    """
+    Tree ensemble flattened into NumPy node arrays
+
+    All trees share one set of arrays (feature, threshold, left, right,
+    value) and each tree starts at its entry in roots. Leaves point to
+    themselves, so predict walks every sample through every tree at once
+    with max_depth vectorized steps and no per-tree Python calls.
+    """
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, left: np.ndarray, right: np.ndarray,
+                 value: np.ndarray, roots: np.ndarray, max_depth: int, base_score: float = 0.0,
+                 feature_names: List[str] = None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.base_score = base_score
+        self.feature_names = list(feature_names or [])  # Saved with the model, for the caller to check
+
+    @classmethod
+    def from_trees(cls, trees: List, scale: float = 1.0, base_score: float = 0.0,
+                   leaf_values: List[np.ndarray] = None) -> 'CompiledTreeEnsemble':
+        """
+        Compile fitted sklearn trees; the prediction is base_score + scale * sum of leaf values
+
+        Args:
+            trees: Fitted DecisionTreeRegressor objects (or their tree_ attributes)
+            scale: Learning rate for boosting, 1 / n_trees for a forest
+            base_score: Constant added to every prediction
+            leaf_values: Per-tree node values to use instead of the fitted ones
+        """
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset, max_depth = 0, 0
+
+        for i, tree in enumerate(trees):
+            tree = getattr(tree, 'tree_', tree)
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left < 0
+
+            # Leaves loop back to themselves and compare on feature 0 either way
+            features.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+            thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+            lefts.append((np.where(is_leaf, nodes, tree.children_left) + offset).astype(np.int32))
+            rights.append((np.where(is_leaf, nodes, tree.children_right) + offset).astype(np.int32))
+            node_values = leaf_values[i] if leaf_values is not None else tree.value[:, 0, 0]
+            values.append(np.asarray(node_values, dtype=np.float64) * scale)
+
+            roots.append(offset)
+            offset += tree.node_count
+            max_depth = max(max_depth, tree.max_depth)
+
+        return cls(
+            np.concatenate(features), np.concatenate(thresholds), np.concatenate(lefts),
+            np.concatenate(rights), np.concatenate(values), np.array(roots, dtype=np.int32),
+            max_depth, base_score
+        )
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'CompiledTreeEnsemble':
+        """Compile a fitted GradientBoostingRegressor, RandomForestRegressor or DecisionTreeRegressor"""
+        if isinstance(model, GradientBoostingRegressor):
+            n_features = model.n_features_in_
+            base_score = float(np.ravel(model._raw_predict_init(np.zeros((1, n_features))))[0])
+            return cls.from_trees(model.estimators_[:, 0], model.learning_rate, base_score)
+        if isinstance(model, RandomForestRegressor):
+            return cls.from_trees(model.estimators_, 1.0 / len(model.estimators_))
+        if isinstance(model, DecisionTreeRegressor):
+            return cls.from_trees([model])
+        raise TypeError(f"Cannot compile {type(model).__name__}")
+
+    @property
+    def n_trees(self) -> int:
+        return len(self.roots)
+
+    def predict(self, X) -> np.ndarray:
+        """Scores for all rows of X"""
+        # sklearn compares float32 inputs against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), self.n_trees))
+
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        return self.base_score + self.value[nodes].sum(axis=1)
+
+    def save(self, path: str):
+        """Write the node arrays to a compressed .npz file"""
+        np.savez_compressed(
+            path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+            value=self.value, roots=self.roots, max_depth=self.max_depth, base_score=self.base_score,
+            feature_names=np.array(self.feature_names, dtype=str)
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'CompiledTreeEnsemble':
+        with np.load(path) as data:
+            return cls(
+                data['feature'], data['threshold'], data['left'], data['right'], data['value'],
+                data['roots'], int(data['max_depth']), float(data['base_score']),
+                data['feature_names'].tolist()
+            )
+
+
+def train_lambdamart(X: np.ndarray, y: np.ndarray, groups: np.ndarray, n_estimators: int = 100,
+                     learning_rate: float = 0.1, max_depth: int = 4, min_samples_leaf: int = 1,
+                     random_state: int = 0) -> CompiledTreeEnsemble:
+    """
+    LambdaMART: boosted regression trees fit to NDCG-weighted pairwise lambdas
+
+    Each round fits a tree to the lambda gradients of every query group and
+    sets its leaf values with a Newton step, then compiles the ensemble.
+
+    Args:
+        X: Feature rows
+        y: Graded relevance label per row
+        groups: Query id per row; rows of a query must be contiguous
+        n_estimators: Boosting rounds
+        learning_rate: Shrinkage per round
+        max_depth: Depth of each tree
+    """
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y, dtype=float)
+    boundaries = np.flatnonzero(np.diff(groups)) + 1
+    spans = list(zip(np.r_[0, boundaries], np.r_[boundaries, len(groups)]))
+
+    scores = np.zeros(len(y))
+    trees, leaf_values = [], []
+    for round_ in range(n_estimators):
+        lambdas, hessians = np.zeros(len(y)), np.zeros(len(y))
+        for start, end in spans:
+            lambdas[start:end], hessians[start:end] = _lambda_gradients(scores[start:end], y[start:end])
+
+        tree = DecisionTreeRegressor(max_depth=max_depth, min_samples_leaf=min_samples_leaf,
+                                     random_state=random_state + round_)
+        tree.fit(X, lambdas)
+
+        # Newton step per leaf: sum of lambdas over sum of second derivatives
+        leaves = tree.apply(X)
+        gradient_sum = np.bincount(leaves, weights=lambdas, minlength=tree.tree_.node_count)
+        hessian_sum = np.bincount(leaves, weights=hessians, minlength=tree.tree_.node_count)
+        values = np.divide(gradient_sum, hessian_sum, out=np.zeros_like(gradient_sum), where=hessian_sum > 1e-12)
+
+        scores += learning_rate * values[leaves]
+        trees.append(tree)
+        leaf_values.append(values)
+
+    return CompiledTreeEnsemble.from_trees(trees, learning_rate, leaf_values=leaf_values)
+
+
+def _lambda_gradients(scores: np.ndarray, labels: np.ndarray):
+    """LambdaRank gradients and second derivatives for one query's candidates"""
+    gains = 2.0 ** labels - 1.0
+    ideal_discounts = 1.0 / np.log2(np.arange(2, len(labels) + 2))
+    ideal_dcg = float((np.sort(gains)[::-1] * ideal_discounts).sum())
+    if ideal_dcg == 0:
+        return np.zeros(len(labels)), np.zeros(len(labels))
+
+    ranks = np.empty(len(scores), dtype=int)
+    ranks[np.argsort(-scores, kind='stable')] = np.arange(len(scores))
+    discounts = 1.0 / np.log2(ranks + 2)
+
+    # Pairs (i, j) where i should rank above j, weighted by the NDCG change of swapping them
+    better = labels[:, None] > labels[None, :]
+    delta_ndcg = np.abs((gains[:, None] - gains[None, :]) * (discounts[:, None] - discounts[None, :])) / ideal_dcg
+    rho = 1.0 / (1.0 + np.exp(scores[:, None] - scores[None, :]))
+
+    pair_lambda = np.where(better, rho * delta_ndcg, 0.0)
+    pair_hessian = np.where(better, rho * (1.0 - rho) * delta_ndcg, 0.0)
+    lambdas = pair_lambda.sum(axis=1) - pair_lambda.sum(axis=0)
+    hessians = pair_hessian.sum(axis=1) + pair_hessian.sum(axis=0)
+    return lambdas, hessians
+
+
+def benchmark_scoring(model, compiled: CompiledTreeEnsemble, query_features: List[np.ndarray],
+                      repeats: int = 20) -> Dict:
+    """Per-query scoring time of sklearn predict versus the compiled ensemble"""
+    timings = {}
+    for name, predict in (('sklearn', model.predict), ('compiled', compiled.predict)):
+        predict(query_features[0])  # Warm up
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            for features in query_features:
+                predict(features)
+        timings[name] = (time.perf_counter() - start_time) / (repeats * len(query_features))
+
+    max_difference = max(float(np.abs(model.predict(f) - compiled.predict(f)).max()) for f in query_features)
+    report = {
+        'sklearn_ms_per_query': timings['sklearn'] * 1000,
+        'compiled_ms_per_query': timings['compiled'] * 1000,
+        'speedup': timings['sklearn'] / timings['compiled'],
+        'max_abs_difference': max_difference,
+        'n_trees': compiled.n_trees,
+        'n_nodes': len(compiled.feature)
+    }
+    print(f"sklearn:  {report['sklearn_ms_per_query']:.3f} ms/query")
+    print(f"compiled: {report['compiled_ms_per_query']:.3f} ms/query ({report['speedup']:.1f}x faster)")
+    print(f"Max score difference: {report['max_abs_difference']:.2e}")
+    return report
+
+
+if __name__ == "__main__":
+    # Synthetic LTR data: 200 queries x 20 candidates, 11 features
+    rng = np.random.default_rng(0)
+    n_queries, n_candidates, n_features = 200, 20, 11
+    X = rng.normal(size=(n_queries * n_candidates, n_features))
+    y = np.clip(np.round(X[:, 0] + 0.5 * X[:, 5] + rng.normal(scale=0.5, size=len(X))), 0, 3)
+    groups = np.repeat(np.arange(n_queries), n_candidates)
+    query_features = [X[groups == q] for q in range(50)]
+
+    for model in (RandomForestRegressor(n_estimators=100, random_state=0),
+                  GradientBoostingRegressor(n_estimators=100, max_depth=4, random_state=0)):
+        print(f"\n🌲 {type(model).__name__}")
+        model.fit(X, y)
+        compiled = CompiledTreeEnsemble.from_sklearn(model)
+        benchmark_scoring(model, compiled, query_features)
+
+        compiled.save('compiled_model.npz')
+        print(f"Serialized size: {os.path.getsize('compiled_model.npz') / 1024:.1f} KB")
+        os.remove('compiled_model.npz')
+
+    print("\n🌲 LambdaMART")
+    start_time = time.perf_counter()
+    lambdamart = train_lambdamart(X, y, groups)
+    print(f"Trained in {time.perf_counter() - start_time:.2f}s, {lambdamart.n_trees} trees")
@@ -1,45 +1,201 @@
 # domain_specific_reranking.py
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+
+import numpy as np
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+from model_registry import get_cross_encoder
+
+FALLBACK = 'fallback'
+
+
 class DomainSpecificReranker:
-    def __init__(self, base_rag):
+    def __init__(self, base_rag, fallback_model: str = 'cross-encoder/ms-marco-MiniLM-L-6-v2',
+                 max_workers: int = None, backend: str = None):
+        """
+        Args:
+            base_rag: Retrieval system providing hybrid_search
+            fallback_model: Reranker for doc_types without a domain reranker
+            max_workers: Domain groups scored at once (default: one per reranker, up to the CPU count)
+            backend: 'torch', 'onnx' or 'onnx-int8' (default: RERANKER_BACKEND env var, else torch)
+        """
         self.base_rag = base_rag
 
-        # Different rerankers for different document types
+        # Different rerankers for different document types, shared process-wide
         self.rerankers = {
-            'policy': CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2'),
-            'faq': CrossEncoder('cross-encoder/qnli-electra-base'),
-            'procedure': CrossEncoder('cross-encoder/stsb-distilroberta-base')
+            'policy': get_cross_encoder('cross-encoder/ms-marco-MiniLM-L-6-v2', backend=backend),
+            'faq': get_cross_encoder('cross-encoder/qnli-electra-base', backend=backend),
+            'procedure': get_cross_encoder('cross-encoder/stsb-distilroberta-base', backend=backend)
         }
+        self.fallback_reranker = get_cross_encoder(fallback_model, backend=backend)
+
+        # Per-reranker map from raw score to relevance probability, set by fit_calibration
+        self.calibrators = {}
+
+        # Model inference releases the GIL, so domain groups score in parallel
+        max_workers = max_workers or min(len(self.rerankers) + 1, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def domain_aware_search(self, query: str, top_k: int = 5, retrieve_k: int = 20) -> List[Dict]:
+        """
+        Use different rerankers based on document types in results
 
-    def domain_aware_search(self, query: str, top_k: int = 5):
-        """Use different rerankers based on document types in results"""
+        Returns the top_k results; see domain_aware_search_with_metadata for
+        per-domain latency, counts and the score scale used.
+        """
+        return self.domain_aware_search_with_metadata(query, top_k, retrieve_k)['results']
 
-        candidates = self.base_rag.hybrid_search(query, top_k=20)
+    def domain_aware_search_with_metadata(self, query: str, top_k: int = 5, retrieve_k: int = 20) -> Dict:
+        """
+        domain_aware_search plus how the merge was done
 
-        # Group candidates by document type
+        Each domain group is scored concurrently by its reranker (unmapped
+        doc_types by the fallback reranker). Groups are merged on one scale:
+        calibrated relevance probabilities when fit_calibration has fitted a
+        calibrator for every group in the merge, otherwise the raw
+        cross-encoder scores of all groups. Probabilities and raw scores are
+        never sorted together.
+
+        Returns:
+            {'results': top_k results, 'metadata': per-domain latency and counts, scale, timings}
+        """
+        start_time = time.perf_counter()
+        candidates = self.base_rag.hybrid_search(query, top_k=retrieve_k)
+        retrieval_time = time.perf_counter() - start_time
+
+        # Group candidates by the reranker that handles their document type
         grouped_candidates = {}
         for candidate in candidates:
-            doc_type = self._extract_field(candidate, 'doc_type')
-            if doc_type not in grouped_candidates:
-                grouped_candidates[doc_type] = []
-            grouped_candidates[doc_type].append(candidate)
+            grouped_candidates.setdefault(self._reranker_key(candidate), []).append(candidate)
+
+        # Rerank each group with appropriate reranker, all groups at once
+        scoring_start = time.perf_counter()
+        futures = {key: self.executor.submit(self._score_group, key, query, group)
+                   for key, group in grouped_candidates.items()}
+        scored = {key: future.result() for key, future in futures.items()}
+        scoring_time = time.perf_counter() - scoring_start
+
+        # Calibrated probabilities only when every group has them; a partial set would mix scales
+        use_calibration = all(key in self.calibrators for key in grouped_candidates)
 
-        # Rerank each group with appropriate reranker
         all_reranked = []
-        for doc_type, type_candidates in grouped_candidates.items():
-            if doc_type in self.rerankers:
-                reranker = self.rerankers[doc_type]
-                pairs = [[query, self._extract_text(c)] for c in type_candidates]
-                scores = reranker.predict(pairs)
-
-                for candidate, score in zip(type_candidates, scores):
-                    all_reranked.append({
-                        'text': self._extract_text(candidate),
-                        'source': self._extract_field(candidate, 'source'),
-                        'doc_type': doc_type,
-                        'rerank_score': float(score),
-                        'reranker_used': doc_type
-                    })
+        methods = {}
+        for key, group in grouped_candidates.items():
+            raw_scores, _ = scored[key]
+            if use_calibration:
+                scores, methods[key] = self._calibrate(key, raw_scores)
+            else:
+                scores, methods[key] = raw_scores, 'raw'
+
+            for candidate, raw_score, score in zip(group, raw_scores, scores):
+                all_reranked.append({
+                    'text': self._extract_text(candidate),
+                    'source': self._extract_field(candidate, 'source'),
+                    'doc_type': self._extract_field(candidate, 'doc_type'),
+                    'rerank_score': float(score),
+                    'raw_score': float(raw_score),
+                    'reranker_used': key
+                })
 
         # Sort all results together
         all_reranked.sort(key=lambda x: x['rerank_score'], reverse=True)
-        return all_reranked[:top_k]
\ No newline at end of file
+
+        return {
+            'results': all_reranked[:top_k],
+            'metadata': {
+                'domain_latency': {key: latency for key, (_, latency) in scored.items()},
+                'domain_counts': {key: len(group) for key, group in grouped_candidates.items()},
+                'calibrated': methods,  # 'platt' or 'isotonic' per group, or 'raw' for all
+                'retrieval_time': retrieval_time,
+                'scoring_time': scoring_time,  # Wall time of the parallel scoring
+                'total_time': time.perf_counter() - start_time
+            }
+        }
+
+    def fit_calibration(self, labeled_queries: List[Dict], method: str = 'platt', retrieve_k: int = 20) -> Dict:
+        """
+        Fit a score calibrator per reranker from labeled queries
+
+        Args:
+            labeled_queries: [{'query': ..., 'relevance_scores': {chunk_id: grade}}]; grade > 0 is relevant
+            method: 'platt' (logistic on the raw score) or 'isotonic'
+
+        Returns:
+            Number of labeled pairs used per reranker
+        """
+        if method not in ('platt', 'isotonic'):
+            raise ValueError(f"Unknown calibration method '{method}'")
+
+        scores, labels = {}, {}
+        for item in labeled_queries:
+            candidates = self.base_rag.hybrid_search(item['query'], top_k=retrieve_k)
+            grouped_candidates = {}
+            for candidate in candidates:
+                grouped_candidates.setdefault(self._reranker_key(candidate), []).append(candidate)
+
+            futures = {key: self.executor.submit(self._score_group, key, item['query'], group)
+                       for key, group in grouped_candidates.items()}
+            for key, group in grouped_candidates.items():
+                scores.setdefault(key, []).extend(futures[key].result()[0])
+                labels.setdefault(key, []).extend(
+                    int(item.get('relevance_scores', {}).get(self._extract_field(c, 'id'), 0) > 0)
+                    for c in group
+                )
+
+        pairs_used = {}
+        for key in scores:
+            x, y = np.array(scores[key]), np.array(labels[key])
+            if len(np.unique(y)) < 2:
+                print(f"⚠️ Not calibrating '{key}': needs both relevant and non-relevant examples")
+                continue
+
+            if method == 'platt':
+                # Weak regularization: Platt scaling is a plain logistic fit on the score
+                calibrator = LogisticRegression(C=1e4).fit(x.reshape(-1, 1), y)
+            else:
+                calibrator = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds='clip').fit(x, y)
+            self.calibrators[key] = (method, calibrator)
+            pairs_used[key] = len(y)
+
+        print(f"✅ Calibrated {len(pairs_used)} rerankers ({method})")
+        return pairs_used
+
+    def _reranker_key(self, candidate) -> str:
+        doc_type = self._extract_field(candidate, 'doc_type')
+        return doc_type if doc_type in self.rerankers else FALLBACK
+
+    def _score_group(self, key: str, query: str, candidates: List):
+        """Raw scores for one domain group and the time they took"""
+        start_time = time.perf_counter()
+        reranker = self.rerankers.get(key, self.fallback_reranker)
+        pairs = [[query, self._extract_text(c)] for c in candidates]
+        scores = np.asarray(reranker.predict(pairs), dtype=float)
+        return scores, time.perf_counter() - start_time
+
+    def _calibrate(self, key: str, scores: np.ndarray):
+        """One reranker's raw scores as relevance probabilities from its fitted calibrator, and the method"""
+        method, calibrator = self.calibrators[key]
+        if len(scores) == 0:
+            return scores, method
+        if method == 'platt':
+            return calibrator.predict_proba(scores.reshape(-1, 1))[:, 1], method
+        return calibrator.predict(scores), method
+
+    def _extract_text(self, candidate) -> str:
+        """Extract text from different candidate formats"""
+        if isinstance(candidate, dict):
+            if 'doc' in candidate:
+                return candidate['doc'].get('text', '')
+            return candidate.get('text', '')
+        return str(candidate)
+
+    def _extract_field(self, candidate, field: str):
+        """Extract field from different candidate formats"""
+        if isinstance(candidate, dict):
+            if 'doc' in candidate:
+                return candidate['doc'].get(field, 'unknown')
+            return candidate.get(field, 'unknown')
+        return 'unknown'
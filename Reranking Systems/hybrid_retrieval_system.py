@@ -1,9 +1,16 @@
 # hybrid_retrieval_system.py
 from sentence_transformers import SentenceTransformer
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from scipy.sparse import csr_matrix
 import numpy as np
-from typing import List, Dict, Tuple
+import hashlib
+import json
+import time
+from collections import deque
+from typing import List, Dict, Tuple, Optional
+from chunk_store import ChunkStore
+from tracing import tracer
 
 
 class HybridRetrievalRAG:
@@ -18,13 +25,39 @@ class HybridRetrievalRAG:
             ngram_range=(1, 2)  # Include bigrams
         )
 
-        self.knowledge_base = []
+        self.knowledge_base = ChunkStore()
+        self.dense_matrix = None
         self.tfidf_matrix = None
         self.is_fitted = False
+        # Fingerprint of the indexed content; result caches key on it
+        self.index_version = None
+        # Fingerprint per source document, so caches can drop only what changed
+        self.source_versions = {}
+
+        # Metadata postings: field -> value -> row ids, built at index time
+        self.metadata_index = {}
+        # Filters matching at most this share of rows score only those rows
+        self.selective_filter_ratio = 0.1
+
+        # Candidates taken from each side before fusion (see hybrid_search);
+        # these set fusion/rerank depth, every allowed row is scored regardless
+        self.candidate_config = {
+            'dense_k': 20,
+            'sparse_k': 20,
+            'adaptive': False,
+            'winner_gap': 0.25,  # Dense top-1 lead that ends the search early
+            'min_overlap': 0.2,  # Widen when dense/sparse lists share less than this
+            'max_k': 200  # Upper bound when widening
+        }
+        # Per-query depth and timing, for tuning candidate_config
+        self.depth_log = deque(maxlen=1000)
 
     def add_documents(self, documents: List[Dict]):
         """Add documents and build both dense and sparse indexes"""
-        self.knowledge_base = documents
+        # Compact column store; chunk dicts are only built for returned results
+        self.knowledge_base.close()
+        self.knowledge_base = ChunkStore()
+        self.knowledge_base.extend(documents)
 
         # Extract texts for indexing
         texts = [doc['text'] for doc in documents]
@@ -33,31 +66,111 @@ class HybridRetrievalRAG:
         # Create dense embeddings
         embeddings = self.embedding_model.encode(texts, show_progress_bar=True)
 
-        # Store embeddings with documents
-        for doc, embedding in zip(self.knowledge_base, embeddings):
-            doc['dense_embedding'] = embedding
+        # Unit-normalized matrix so dense scoring is a single matrix product
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.dense_matrix = embeddings / np.maximum(norms, 1e-12)
 
         print("🔄 Building sparse TF-IDF index...")
-        # Create sparse TF-IDF matrix
+        # Create sparse TF-IDF matrix (rows are L2-normalized)
         self.tfidf_matrix = self.tfidf_vectorizer.fit_transform(texts)
         self.is_fitted = True
 
+        self._build_metadata_index()
+        self.index_version = self._fingerprint(documents)
+        self.source_versions = self._source_fingerprints(documents)
+
         print(f"✅ Indexed {len(documents)} documents with hybrid search")
 
-    def dense_search(self, query: str, top_k: int = 10) -> List[Tuple[Dict, float]]:
+    def _fingerprint(self, documents: List[Dict]) -> str:
+        """Hash of every chunk's id, text and metadata; changes whenever the indexed content does"""
+        digest = hashlib.blake2b(digest_size=16)
+        for doc in documents:
+            fields = [doc.get('id'), doc['text'], doc.get('source'), doc.get('doc_type')]
+            digest.update(json.dumps(fields, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _source_fingerprints(self, documents: List[Dict]) -> Dict[str, str]:
+        """Hash of each source's chunks (id, text, doc_type), keyed by source"""
+        digests = {}
+        for doc in documents:
+            digest = digests.setdefault(doc.get('source'), hashlib.blake2b(digest_size=16))
+            digest.update(json.dumps([doc.get('id'), doc['text'], doc.get('doc_type')], default=str).encode('utf-8'))
+        return {source: digest.hexdigest() for source, digest in digests.items()}
+
+    def _build_metadata_index(self):
+        """Precompute the row ids for every metadata value"""
+        self.metadata_index = {
+            field: self.knowledge_base.postings(field)
+            for field in self.knowledge_base.metadata_fields()
+        }
+
+    def _filter_rows(self, filter_by: Dict = None) -> Optional[np.ndarray]:
+        """
+        Row ids matching every filter, or None when there is no filter
+
+        Each filter value may be a single value or a list of accepted values.
+        """
+        if not filter_by:
+            return None
+
+        rows = None
+        for key, value in filter_by.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            postings = self.metadata_index.get(key, {})
+            matches = [postings[v] for v in values if v in postings]
+
+            key_rows = np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+            rows = key_rows if rows is None else np.intersect1d(rows, key_rows, assume_unique=True)
+
+        return rows
+
+    def _score_rows(self, matrix, query_vector, rows: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Score query_vector against the allowed rows of matrix"""
+        num_rows = matrix.shape[0]
+
+        if rows is None:
+            return np.arange(num_rows), self._dot(matrix, query_vector)
+
+        if len(rows) <= self.selective_filter_ratio * num_rows:
+            # Highly selective filter: brute-force only the matching rows
+            return rows, self._dot(matrix[rows], query_vector)
+
+        # Broad filter: one full pass is cheaper than copying most of the matrix
+        return rows, self._dot(matrix, query_vector)[rows]
+
+    def _dot(self, matrix, query_vector) -> np.ndarray:
+        """Dot product of each row with the query, for dense or sparse matrices"""
+        if isinstance(matrix, np.ndarray):
+            return matrix @ query_vector
+        return (matrix @ query_vector.T).toarray().ravel()
+
+    def _top_indices(self, scores: np.ndarray, top_k: int) -> np.ndarray:
+        """Positions of the top_k scores, best first"""
+        if top_k >= len(scores):
+            return np.argsort(-scores, kind='stable')
+        top = np.argpartition(-scores, top_k)[:top_k]
+        return top[np.argsort(-scores[top], kind='stable')]
+
+    def _encode_query(self, query: str) -> np.ndarray:
+        """Unit-normalized query embedding"""
+        query_embedding = np.asarray(self.embedding_model.encode([query])[0], dtype=np.float32)
+        return query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+
+    def dense_search(self, query: str, top_k: int = 10,
+                     filter_by: Dict = None) -> List[Tuple[Dict, float]]:
         """Semantic vector search"""
-        query_embedding = self.embedding_model.encode([query])
+        if self.dense_matrix is None:
+            return []
 
-        similarities = []
-        for doc in self.knowledge_base:
-            similarity = cosine_similarity(query_embedding, [doc['dense_embedding']])[0][0]
-            similarities.append((doc, similarity))
+        rows, similarities = self._score_rows(self.dense_matrix, self._encode_query(query),
+                                              self._filter_rows(filter_by))
 
-        # Sort by similarity
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return similarities[:top_k]
+        return [(self.knowledge_base.to_dict(rows[i]), similarities[i])
+                for i in self._top_indices(similarities, top_k)]
 
-    def sparse_search(self, query: str, top_k: int = 10) -> List[Tuple[Dict, float]]:
+    def sparse_search(self, query: str, top_k: int = 10,
+                      filter_by: Dict = None) -> List[Tuple[Dict, float]]:
         """Keyword-based TF-IDF search"""
         if not self.is_fitted:
             return []
@@ -65,20 +178,20 @@ class HybridRetrievalRAG:
         # Transform query to TF-IDF vector
         query_vector = self.tfidf_vectorizer.transform([query])
 
-        # Calculate similarities with all documents
-        similarities = cosine_similarity(query_vector, self.tfidf_matrix).flatten()
-
-        # Get top results
-        top_indices = similarities.argsort()[-top_k:][::-1]
+        # Calculate similarities with the allowed documents only
+        rows, similarities = self._score_rows(self.tfidf_matrix, query_vector,
+                                              self._filter_rows(filter_by))
 
         results = []
-        for idx in top_indices:
-            if similarities[idx] > 0:  # Only include non-zero similarities
-                results.append((self.knowledge_base[idx], similarities[idx]))
+        for i in self._top_indices(similarities, top_k):
+            if similarities[i] > 0:  # Only include non-zero similarities
+                results.append((self.knowledge_base.to_dict(rows[i]), similarities[i]))
 
         return results
 
-    def hybrid_search(self, query: str, top_k: int = 5, alpha: float = 0.7) -> List[Dict]:
+    def hybrid_search(self, query: str, top_k: int = 5, alpha: float = 0.7,
+                      filter_by: Dict = None, dense_k: int = None, sparse_k: int = None,
+                      adaptive: bool = None) -> List[Dict]:
         """
         Combine dense and sparse search results
 
@@ -86,56 +199,379 @@ class HybridRetrievalRAG:
             query: Search query
             top_k: Number of results to return
             alpha: Weight for dense search (0.0 = only sparse, 1.0 = only dense)
+            filter_by: Metadata filters applied before scoring, e.g. {'doc_type': ['policy', 'faq']}
+            dense_k: Dense candidates to fuse (default from candidate_config, at least top_k)
+            sparse_k: Sparse candidates to fuse (default from candidate_config, at least top_k)
+            adaptive: Pick the depth per query from the score distribution; when on,
+                a decisive dense winner skips the sparse pass, queries without
+                in-vocabulary terms skip it too, and depth doubles (up to max_k)
+                while the two candidate lists barely overlap. Both scans are one
+                matrix product over every allowed row either way, so widening
+                only changes how many candidates are fused (and handed to a
+                reranker), not the scoring work; skipping the sparse pass is the
+                only saving in scan cost
         """
+        start_time = time.perf_counter()
+        config = self.candidate_config
+        adaptive = config['adaptive'] if adaptive is None else adaptive
+        dense_k = max(dense_k or config['dense_k'], top_k)
+        sparse_k = max(sparse_k or config['sparse_k'], top_k)
+        decision = 'fixed'
+
+        if self.dense_matrix is None:
+            return []
 
-        # Get results from both methods
-        dense_results = self.dense_search(query, top_k=20)
-        sparse_results = self.sparse_search(query, top_k=20)
+        # Score every allowed row once; depth changes below only re-select from
+        # these scores, so widening costs a top-k selection, not another scan
+        rows = self._filter_rows(filter_by)
+        with tracer.span('query_encode'):
+            query_embedding = self._encode_query(query)
+            query_vector = self.tfidf_vectorizer.transform([query])
+
+        with tracer.span('dense_scan') as span:
+            dense_rows, dense_scores = self._score_rows(self.dense_matrix, query_embedding, rows)
+            span.set(rows=len(dense_rows))
+        sparse_rows, sparse_scores = dense_rows[:0], dense_scores[:0]
+
+        run_sparse = query_vector.nnz > 0 or not adaptive
+
+        if adaptive:
+            if query_vector.nnz == 0:
+                decision = 'no_sparse_terms'
+            elif len(dense_scores) > 1:
+                top_two = dense_scores[self._top_indices(dense_scores, 2)]
+                if top_two[0] - top_two[1] >= config['winner_gap']:
+                    decision = 'early_stop'
+                    run_sparse = False
+                    dense_k = sparse_k = top_k
+
+        if run_sparse:
+            with tracer.span('sparse_scan') as span:
+                sparse_rows, sparse_scores = self._score_rows(self.tfidf_matrix, query_vector, rows)
+                span.set(rows=len(sparse_rows))
+
+        dense_top = self._top_indices(dense_scores, dense_k)
+        sparse_top = self._nonzero_top(sparse_scores, sparse_k)
+
+        if adaptive and decision == 'fixed':
+            # Widen while the two sides disagree and there are rows left to add
+            while (len(sparse_top) and self._overlap(dense_rows[dense_top], sparse_rows[sparse_top])
+                   < config['min_overlap'] and max(dense_k, sparse_k) < config['max_k']
+                   and (dense_k < len(dense_scores) or sparse_k < len(sparse_scores))):
+                dense_k = min(dense_k * 2, config['max_k'])
+                sparse_k = min(sparse_k * 2, config['max_k'])
+                dense_top = self._top_indices(dense_scores, dense_k)
+                sparse_top = self._nonzero_top(sparse_scores, sparse_k)
+                decision = 'widened'
+
+        # Candidates stay row ids until the final top_k is known
+        with tracer.span('fusion', dense_k=dense_k, sparse_k=sparse_k if run_sparse else 0,
+                         decision=decision) as span:
+            final_results, num_candidates = self._fuse_candidates(
+                dense_rows[dense_top], dense_scores[dense_top],
+                sparse_rows[sparse_top], sparse_scores[sparse_top], alpha, top_k
+            )
+            span.set(candidates=num_candidates, results=len(final_results))
+
+        self.depth_log.append({
+            'query': query,
+            'dense_k': dense_k,
+            'sparse_k': sparse_k if run_sparse else 0,
+            'decision': decision,
+            'candidates': num_candidates,
+            'time': time.perf_counter() - start_time
+        })
+
+        return final_results
+
+    def _fuse_candidates(self, dense_rows, dense_scores, sparse_rows, sparse_scores,
+                         alpha: float, top_k: int) -> Tuple[List[Dict], int]:
+        """Weighted fusion of dense and sparse candidate rows; returns (results, candidates)"""
+        dense_results = zip(dense_rows, dense_scores)
+        sparse_results = zip(sparse_rows, sparse_scores)
 
         # Combine scores using weighted average
         combined_scores = {}
 
         # Add dense scores
-        for doc, score in dense_results:
-            doc_id = doc['id']
-            combined_scores[doc_id] = {
-                'doc': doc,
+        for row, score in dense_results:
+            combined_scores[row] = {
+                'row': row,
                 'dense_score': score,
                 'sparse_score': 0.0,
                 'combined_score': alpha * score
             }
 
         # Add sparse scores
-        for doc, score in sparse_results:
-            doc_id = doc['id']
-            if doc_id in combined_scores:
-                combined_scores[doc_id]['sparse_score'] = score
-                combined_scores[doc_id]['combined_score'] += (1 - alpha) * score
+        for row, score in sparse_results:
+            if row in combined_scores:
+                combined_scores[row]['sparse_score'] = score
+                combined_scores[row]['combined_score'] += (1 - alpha) * score
             else:
-                combined_scores[doc_id] = {
-                    'doc': doc,
+                combined_scores[row] = {
+                    'row': row,
                     'dense_score': 0.0,
                     'sparse_score': score,
                     'combined_score': (1 - alpha) * score
                 }
 
-        # Sort by combined score
+        # Sort by combined score; equal scores in id order, so sharded and single-node search agree
         sorted_results = sorted(
             combined_scores.values(),
-            key=lambda x: x['combined_score'],
-            reverse=True
+            key=lambda x: (-x['combined_score'], str(self.knowledge_base.chunk_id(x['row'])))
         )
 
         # Format results
         final_results = []
         for result in sorted_results[:top_k]:
-            final_results.append({
-                'text': result['doc']['text'],
-                'source': result['doc']['source'],
-                'doc_type': result['doc']['doc_type'],
-                'dense_score': float(result['dense_score']),
-                'sparse_score': float(result['sparse_score']),
-                'combined_score': float(result['combined_score'])
+            final_results.append(self._format_result(
+                result['row'],
+                dense_score=float(result['dense_score']),
+                sparse_score=float(result['sparse_score']),
+                combined_score=float(result['combined_score'])
+            ))
+
+        return final_results, len(combined_scores)
+
+    def expanded_search(self, queries: List[str], weights: List[float] = None, top_k: int = 5,
+                        alpha: float = 0.7, dense_mode: str = 'max', filter_by: Dict = None,
+                        dense_k: int = None, sparse_k: int = None) -> List[Dict]:
+        """
+        Hybrid search for a query and its expansions as one batched operation
+
+        All variants are encoded in a single call. The dense side is either
+        one matrix product against every variant ('max': a row keeps its best
+        weighted similarity) or a single weighted centroid vector ('centroid').
+        The sparse side scores one expanded term-weight vector: the weighted
+        sum of the variants' TF-IDF vectors. Cost is flat in the number of
+        variants apart from the encode batch.
+
+        Args:
+            queries: Original query first, followed by its expansions
+            weights: Weight per query (default 1.0 each)
+            top_k: Number of results to return
+            alpha: Weight for dense search (0.0 = only sparse, 1.0 = only dense)
+            dense_mode: 'max' or 'centroid'
+            filter_by: Metadata filters applied before scoring
+            dense_k: Dense candidates to fuse (default from candidate_config, at least top_k)
+            sparse_k: Sparse candidates to fuse (default from candidate_config, at least top_k)
+        """
+        if self.dense_matrix is None or not queries:
+            return []
+
+        if dense_mode not in ('max', 'centroid'):
+            raise ValueError(f"Unknown dense_mode: {dense_mode}")
+
+        dense_k = max(dense_k or self.candidate_config['dense_k'], top_k)
+        sparse_k = max(sparse_k or self.candidate_config['sparse_k'], top_k)
+        weights = np.ones(len(queries)) if weights is None else np.asarray(weights, dtype=np.float32)
+
+        query_embeddings = np.asarray(self.embedding_model.encode(queries), dtype=np.float32)
+        query_embeddings /= np.maximum(np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+
+        rows = self._filter_rows(filter_by)
+        if dense_mode == 'centroid':
+            centroid = weights @ query_embeddings
+            centroid /= max(np.linalg.norm(centroid), 1e-12)
+            dense_rows, dense_scores = self._score_rows(self.dense_matrix, centroid, rows)
+        else:
+            dense_rows, variant_scores = self._score_rows(self.dense_matrix, query_embeddings.T, rows)
+            dense_scores = (variant_scores * weights[None, :]).max(axis=1)
+
+        # One expanded term-weight vector, re-normalized like a TF-IDF row
+        term_vector = normalize(csr_matrix(weights) @ self.tfidf_vectorizer.transform(queries))
+        sparse_rows, sparse_scores = self._score_rows(self.tfidf_matrix, term_vector, rows)
+
+        dense_top = self._top_indices(dense_scores, dense_k)
+        sparse_top = self._nonzero_top(sparse_scores, sparse_k)
+
+        final_results, _ = self._fuse_candidates(
+            dense_rows[dense_top], dense_scores[dense_top],
+            sparse_rows[sparse_top], sparse_scores[sparse_top], alpha, top_k
+        )
+        return final_results
+
+    def score_components(self, queries: List[str], filter_by: Dict = None,
+                         dense_k: int = None, sparse_k: int = None) -> List[Dict]:
+        """
+        Dense and sparse scores of each query's fusion candidates, retrieved once
+
+        The whole batch is encoded in one call and scored with one matrix
+        product per side. Candidates are the same as hybrid_search would fuse
+        (dense top first, then sparse-only rows), with 0.0 for a side that did
+        not return the row, so any fusion can be applied afterwards without
+        touching the indexes again.
+        """
+        if self.dense_matrix is None or not queries:
+            return []
+
+        dense_k = dense_k or self.candidate_config['dense_k']
+        sparse_k = sparse_k or self.candidate_config['sparse_k']
+
+        rows = self._filter_rows(filter_by)
+        dense_matrix = self.dense_matrix if rows is None else self.dense_matrix[rows]
+        tfidf_matrix = self.tfidf_matrix if rows is None else self.tfidf_matrix[rows]
+        if rows is None:
+            rows = np.arange(self.dense_matrix.shape[0])
+
+        query_embeddings = np.asarray(self.embedding_model.encode(queries), dtype=np.float32)
+        query_embeddings /= np.maximum(np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+
+        dense_scores = dense_matrix @ query_embeddings.T
+        sparse_scores = (tfidf_matrix @ self.tfidf_vectorizer.transform(queries).T).toarray()
+
+        components = []
+        for j, query in enumerate(queries):
+            dense_top = self._top_indices(dense_scores[:, j], dense_k)
+            sparse_top = self._nonzero_top(sparse_scores[:, j], sparse_k)
+            sparse_only = sparse_top[~np.isin(sparse_top, dense_top)]
+            candidates = np.concatenate([dense_top, sparse_only])
+
+            dense = np.zeros(len(candidates))
+            dense[:len(dense_top)] = dense_scores[dense_top, j]
+            sparse = np.where(np.isin(candidates, sparse_top), sparse_scores[candidates, j], 0.0)
+
+            dense_rank = np.zeros(len(candidates), dtype=int)
+            dense_rank[:len(dense_top)] = np.arange(1, len(dense_top) + 1)
+
+            components.append({
+                'query': query,
+                'rows': rows[candidates],
+                'dense': dense,
+                'sparse': sparse,
+                'dense_rank': dense_rank,
+                'sparse_rank': self._ranks_in(candidates, sparse_top)
             })
 
-        return final_results
\ No newline at end of file
+        return components
+
+    def _ranks_in(self, candidates: np.ndarray, ranked: np.ndarray) -> np.ndarray:
+        """1-based position of each candidate in ranked, 0 when absent"""
+        position = {row: rank for rank, row in enumerate(ranked, 1)}
+        return np.array([position.get(row, 0) for row in candidates])
+
+    def fusion_scores(self, component: Dict, alphas, fusion: str = 'weighted',
+                      rrf_k: int = 60) -> np.ndarray:
+        """
+        Fused scores for every alpha at once, shape (len(alphas), candidates)
+
+        Fusions:
+            weighted: alpha * dense + (1 - alpha) * sparse, as in hybrid_search
+            minmax: the same after min-max scaling each side over the candidates
+            zscore: the same after z-scoring each side over the candidates
+            rrf: alpha-weighted reciprocal rank fusion
+        """
+        alphas = np.asarray(alphas, dtype=float)[:, None]
+        dense, sparse = component['dense'], component['sparse']
+
+        if fusion == 'minmax':
+            dense, sparse = self._minmax(dense), self._minmax(sparse)
+        elif fusion == 'zscore':
+            dense, sparse = self._zscore(dense), self._zscore(sparse)
+        elif fusion == 'rrf':
+            dense = np.where(component['dense_rank'] > 0, 1.0 / (rrf_k + component['dense_rank']), 0.0)
+            sparse = np.where(component['sparse_rank'] > 0, 1.0 / (rrf_k + component['sparse_rank']), 0.0)
+        elif fusion != 'weighted':
+            raise ValueError(f"Unknown fusion: {fusion}")
+
+        return alphas * dense[None, :] + (1 - alphas) * sparse[None, :]
+
+    def _minmax(self, scores: np.ndarray) -> np.ndarray:
+        spread = scores.max() - scores.min() if len(scores) else 0.0
+        return (scores - scores.min()) / spread if spread > 0 else np.zeros_like(scores)
+
+    def _zscore(self, scores: np.ndarray) -> np.ndarray:
+        std = scores.std() if len(scores) else 0.0
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+
+    def rank_components(self, component: Dict, alphas, top_k: int = 5,
+                        fusion: str = 'weighted') -> Tuple[np.ndarray, np.ndarray]:
+        """Top candidate positions and fused scores per alpha"""
+        scores = self.fusion_scores(component, alphas, fusion)
+        order = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+        return order, np.take_along_axis(scores, order, axis=1)
+
+    def multi_alpha_search(self, query: str, alphas=(0.0, 0.3, 0.5, 0.7, 1.0), top_k: int = 5,
+                           fusions=('weighted',), filter_by: Dict = None) -> Dict[str, Dict[float, List[Dict]]]:
+        """
+        Rankings for many alpha values from a single retrieval pass
+
+        Returns {fusion: {alpha: results}} where results have the same format
+        as hybrid_search and 'combined_score' holds the fused score.
+        """
+        components = self.score_components([query], filter_by=filter_by)
+        if not components:
+            return {fusion: {float(alpha): [] for alpha in alphas} for fusion in fusions}
+
+        component = components[0]
+        rankings = {}
+
+        for fusion in fusions:
+            order, scores = self.rank_components(component, alphas, top_k, fusion)
+            rankings[fusion] = {}
+
+            for alpha, positions, fused in zip(alphas, order, scores):
+                results = []
+                for position, score in zip(positions, fused):
+                    results.append(self._format_result(
+                        component['rows'][position],
+                        dense_score=float(component['dense'][position]),
+                        sparse_score=float(component['sparse'][position]),
+                        combined_score=float(score)
+                    ))
+                rankings[fusion][float(alpha)] = results
+
+        return rankings
+
+    def _format_result(self, row: int, **scores) -> Dict:
+        """Result dict for one returned row"""
+        return {
+            'id': self.knowledge_base.chunk_id(row),
+            'text': self.knowledge_base.text(row),
+            'source': self.knowledge_base.source(row),
+            'doc_type': self.knowledge_base.doc_type(row),
+            **scores
+        }
+
+    def _nonzero_top(self, scores: np.ndarray, top_k: int) -> np.ndarray:
+        """Top positions with a non-zero score"""
+        top = self._top_indices(scores, top_k)
+        return top[scores[top] > 0]
+
+    def _overlap(self, dense_ids: np.ndarray, sparse_ids: np.ndarray) -> float:
+        """Share of the shorter candidate list found in the other"""
+        shorter = min(len(dense_ids), len(sparse_ids))
+        if shorter == 0:
+            return 1.0
+        return len(np.intersect1d(dense_ids, sparse_ids)) / shorter
+
+    def get_depth_stats(self) -> Dict:
+        """Summarize the per-query depth log"""
+        if not self.depth_log:
+            return {'queries': 0}
+
+        decisions = {}
+        for entry in self.depth_log:
+            decisions[entry['decision']] = decisions.get(entry['decision'], 0) + 1
+
+        return {
+            'queries': len(self.depth_log),
+            'avg_dense_k': float(np.mean([e['dense_k'] for e in self.depth_log])),
+            'avg_sparse_k': float(np.mean([e['sparse_k'] for e in self.depth_log])),
+            'avg_time': float(np.mean([e['time'] for e in self.depth_log])),
+            'decisions': decisions
+        }
+
+    def search(self, query: str, top_k: int = 5, filter_by: Dict = None) -> List[Dict]:
+        """Basic vector search - fixed version"""
+        if not self.knowledge_base:
+            return []
+
+        if self.dense_matrix is None:
+            return []
+
+        rows, similarities = self._score_rows(self.dense_matrix, self._encode_query(query),
+                                              self._filter_rows(filter_by))
+
+        return [self._format_result(rows[i], similarity_score=float(similarities[i]))
+                for i in self._top_indices(similarities, top_k)]
@@ -1,65 +1,137 @@
 # learning_to_rank.py
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
 import numpy as np
-from sentence_transformers import CrossEncoder
+from model_registry import get_cross_encoder
+from ltr_features import DocFeatureStore
+from compiled_trees import CompiledTreeEnsemble, train_lambdamart
 from typing import List, Dict, Tuple
 
 class LearningToRankReranker:
-    def __init__(self, base_rag):
+    # Column order of the feature matrix
+    FEATURE_NAMES = [
+        'dense_score', 'sparse_score', 'combined_score',
+        'doc_length', 'query_length', 'query_coverage', 'cross_encoder_score', 'source_prior'
+    ]  # Followed by one doc_type one-hot column per type in doc_type_columns
+
+    MODEL_TYPES = ('random_forest', 'gbrt', 'lambdamart')
+
+    def __init__(self, base_rag, source_priors: Dict[str, float] = None, model_type: str = 'random_forest'):
+        """
+        Args:
+            base_rag: Hybrid retrieval system supplying candidates
+            source_priors: Prior weight per source, used as a feature
+            model_type: 'random_forest', 'gbrt' (gradient-boosted regression trees)
+                or 'lambdamart' (boosted trees fit to NDCG-weighted pairwise gradients)
+        """
+        if model_type not in self.MODEL_TYPES:
+            raise ValueError(f"Unknown model_type '{model_type}', expected one of {self.MODEL_TYPES}")
+
         self.base_rag = base_rag
-        self.cross_encoder = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
-        self.ltr_model = RandomForestRegressor(n_estimators=100)
+        # Doc-side features computed once for the indexed chunks
+        self.doc_features = DocFeatureStore(source_priors=source_priors)
+        self.doc_features.sync(base_rag.knowledge_base)
+        # Fixed at training time so the feature width stays stable as new types are indexed
+        self.doc_type_columns = self.doc_features.doc_types()
+        self.cross_encoder = get_cross_encoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+        self.model_type = model_type
+        self.ltr_model = {
+            'random_forest': lambda: RandomForestRegressor(n_estimators=100),
+            'gbrt': lambda: GradientBoostingRegressor(n_estimators=100, max_depth=4),
+            'lambdamart': lambda: None  # Trained straight into compiled form
+        }[model_type]()
+        # Flat-array form of the fitted ensemble, used for scoring
+        self.compiled_model = None
         self.is_trained = False
 
     def extract_features(self, query: str, candidate) -> np.ndarray:
         """Extract features for learning-to-rank"""
-
-        text = self._extract_text(candidate)
-
-        features = [
-            # Original hybrid scores
-            self._extract_score(candidate, 'dense_score'),
-            self._extract_score(candidate, 'sparse_score'),
-            self._extract_score(candidate, 'combined_score'),
-
-            # Text features
-            len(text.split()),  # Document length
-            len(query.split()),  # Query length
-
-            # Overlap features
-            query_words = set(query.lower().split())
-        doc_words = set(text.lower().split())
-        len(query_words.intersection(doc_words)) / len(query_words),  # Query coverage
-
-            # Cross-encoder score
-        self.cross_encoder.predict([[query, text]])[0]]
-
-        return np.array(features)
+        return self.extract_features_batch(query, [candidate])[0]
+
+    def extract_features_batch(self, query: str, candidates: List) -> np.ndarray:
+        """Feature matrix for all candidates of one query, one cross-encoder batch"""
+        return self._feature_matrix([(query, candidates)])
+
+    def _feature_matrix(self, query_candidates: List[Tuple[str, List]]) -> np.ndarray:
+        """
+        Feature rows for many (query, candidates) groups at once
+
+        Doc-side features are gathered from the precomputed DocFeatureStore
+        by row id, query coverage is one sparse intersection over all pairs,
+        and all pairs go to the cross-encoder in one predict call.
+        """
+        queries, query_index, texts, candidates = [], [], [], []
+        for query, group in query_candidates:
+            queries.append(query)
+            for candidate in group:
+                query_index.append(len(queries) - 1)
+                texts.append(self._extract_text(candidate))
+                candidates.append(candidate)
+
+        if not candidates:
+            return np.zeros((0, len(self.feature_names())))
+
+        query_index = np.array(query_index)
+        self.doc_features.sync(self.base_rag.knowledge_base)
+        doc = self.doc_features.gather(self.doc_features.rows_for(candidates), texts, self.doc_type_columns)
+
+        # Original hybrid scores
+        hybrid_scores = np.array([
+            [self._extract_score(c, key) for key in ('dense_score', 'sparse_score', 'combined_score')]
+            for c in candidates
+        ], dtype=float)
+
+        # Query-side features, once per query
+        query_length = np.array([len(query.split()) for query in queries], dtype=float)[query_index]
+        query_terms = self.doc_features.query_terms(queries)[query_index]
+
+        # Overlap features
+        query_coverage = self.doc_features.query_coverage(query_terms, doc['term_matrix'])
+
+        # Cross-encoder score
+        pairs = [(queries[i], text) for i, text in zip(query_index, texts)]
+        cross_encoder_scores = np.asarray(self.cross_encoder.predict(pairs), dtype=float)
+
+        return np.column_stack([
+            hybrid_scores, doc['doc_length'], query_length, query_coverage, cross_encoder_scores,
+            doc['source_prior'], doc['doc_type_onehot']
+        ])
+
+    def feature_names(self) -> List[str]:
+        """Column names of the feature matrix"""
+        return self.FEATURE_NAMES + [f"doc_type={doc_type}" for doc_type in self.doc_type_columns]
 
     def train_ltr_model(self, training_queries: List[Dict]):
         """Train learning-to-rank model on labeled data"""
 
-        X_features = []
+        query_candidates = []
         y_relevance = []
+        groups = []
 
         for item in training_queries:
             query = item['query']
             candidates = self.base_rag.hybrid_search(query, top_k=20)
+            query_candidates.append((query, candidates))
 
+            # Use relevance labels (you'd need to create these)
             for candidate in candidates:
-                features = self.extract_features(query, candidate)
-                X_features.append(features)
-
-                # Use relevance labels (you'd need to create these)
                 relevance = item.get('relevance_scores', {}).get(
                     self._extract_field(candidate, 'id'), 0
                 )
                 y_relevance.append(relevance)
+                groups.append(len(query_candidates) - 1)
 
-        X = np.array(X_features)
+        # Features for every query in one batched pass
+        self.doc_features.sync(self.base_rag.knowledge_base)
+        self.doc_type_columns = self.doc_features.doc_types()
+        X = self._feature_matrix(query_candidates)
         y = np.array(y_relevance)
 
-        self.ltr_model.fit(X, y)
+        if self.model_type == 'lambdamart':
+            self.compiled_model = train_lambdamart(X, y, np.array(groups))
+        else:
+            self.ltr_model.fit(X, y)
+            self.compiled_model = CompiledTreeEnsemble.from_sklearn(self.ltr_model)
+        self.compiled_model.feature_names = self.feature_names()
         self.is_trained = True
         print(f"✅ Trained LTR model on {len(X)} examples")
 
@@ -70,13 +142,15 @@ class LearningToRankReranker:
             raise ValueError("LTR model not trained yet!")
 
         candidates = self.base_rag.hybrid_search(query, top_k=20)
+        if not candidates:
+            return []
 
-        # Extract features and predict relevance
-        reranked_results = []
-        for candidate in candidates:
-            features = self.extract_features(query, candidate)
-            ltr_score = self.ltr_model.predict([features])[0]
+        # Extract features and predict relevance for all candidates at once
+        features = self.extract_features_batch(query, candidates)
+        ltr_scores = self.compiled_model.predict(features)
 
+        reranked_results = []
+        for candidate, ltr_score in zip(candidates, ltr_scores):
             reranked_results.append({
                 'text': self._extract_text(candidate),
                 'source': self._extract_field(candidate, 'source'),
@@ -85,4 +159,40 @@ class LearningToRankReranker:
             })
 
         reranked_results.sort(key=lambda x: x['ltr_score'], reverse=True)
-        return reranked_results[:top_k]
\ No newline at end of file
+        return reranked_results[:top_k]
+
+    def save_model(self, path: str):
+        """Save the compiled model (a small .npz file)"""
+        if not self.is_trained:
+            raise ValueError("LTR model not trained yet!")
+        self.compiled_model.save(path)
+
+    def load_model(self, path: str):
+        """Load a compiled model saved by save_model"""
+        self.compiled_model = CompiledTreeEnsemble.load(path)
+        prefix = 'doc_type='
+        self.doc_type_columns = [name[len(prefix):] for name in self.compiled_model.feature_names
+                                 if name.startswith(prefix)]
+        self.is_trained = True
+
+    def _extract_text(self, candidate) -> str:
+        """Extract text from different candidate formats"""
+        if isinstance(candidate, dict):
+            if 'doc' in candidate:
+                return candidate['doc'].get('text', '')
+            return candidate.get('text', '')
+        return str(candidate)
+
+    def _extract_score(self, candidate, score_key: str) -> float:
+        """Extract score from different candidate formats"""
+        if isinstance(candidate, dict):
+            return candidate.get(score_key, 0.0)
+        return 0.0
+
+    def _extract_field(self, candidate, field: str):
+        """Extract field from different candidate formats"""
+        if isinstance(candidate, dict):
+            if 'doc' in candidate:
+                return candidate['doc'].get(field, 'unknown')
+            return candidate.get(field, 'unknown')
+        return 'unknown'
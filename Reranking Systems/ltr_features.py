@@ -0,0 +1,155 @@
+# ltr_features.py
+from typing import List, Dict
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction.text import HashingVectorizer
+
+
+class DocFeatureStore:
+    """
+    Document-side learning-to-rank features, computed once per chunk
+
+    Columns are aligned with the knowledge_base row ids: whitespace token
+    counts, the lowercase term set as a binary CSR matrix over hashed term
+    ids, doc_type codes and a prior per source. Query-time features are then
+    row gathers plus a sparse intersection with the hashed query terms.
+    """
+
+    def __init__(self, n_features: int = 2 ** 20, source_priors: Dict[str, float] = None,
+                 default_prior: float = 0.0):
+        """
+        Args:
+            n_features: Hash buckets for term ids (collisions are rare at 2**20)
+            source_priors: Prior weight per source, e.g. {'HR_Policy': 1.0}
+            default_prior: Prior for sources missing from source_priors
+        """
+        # Same tokenization as text.lower().split()
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features, lowercase=True, tokenizer=str.split, token_pattern=None,
+            binary=True, norm=None, alternate_sign=False, dtype=np.float32
+        )
+        self.source_priors = dict(source_priors or {})
+        self.default_prior = default_prior
+
+        self.knowledge_base = None
+        self.token_counts = np.zeros(0, dtype=np.int32)
+        self.term_matrix = csr_matrix((0, n_features), dtype=np.float32)
+        self.doc_type_codes = np.zeros(0, dtype=np.int32)
+        self.source_codes = np.zeros(0, dtype=np.int32)
+        self.source_prior_by_code = np.zeros(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.token_counts)
+
+    def sync(self, knowledge_base):
+        """Build features for a new knowledge base, or only for rows appended since the last sync"""
+        if knowledge_base is not self.knowledge_base:
+            self.knowledge_base = knowledge_base
+            self.token_counts = np.zeros(0, dtype=np.int32)
+            self.term_matrix = self.term_matrix[:0]
+
+        start = len(self)
+        if start < len(knowledge_base):
+            texts = [knowledge_base.text(row) for row in range(start, len(knowledge_base))]
+            counts = np.array([len(text.split()) for text in texts], dtype=np.int32)
+            self.token_counts = np.concatenate([self.token_counts, counts])
+            self.term_matrix = vstack([self.term_matrix, self.vectorizer.transform(texts)], format='csr')
+
+        # Metadata codes are already integer columns in the chunk store; copied, because a
+        # view would pin the store's arrays and make its next append fail
+        self.doc_type_codes = np.array(knowledge_base.doc_type_codes[:len(self)], dtype=np.int32)
+        self.source_codes = np.array(knowledge_base.source_codes[:len(self)], dtype=np.int32)
+        self._update_source_priors()
+
+    def set_source_priors(self, source_priors: Dict[str, float]):
+        self.source_priors.update(source_priors)
+        self._update_source_priors()
+
+    def _update_source_priors(self):
+        sources = self.knowledge_base.sources.values if self.knowledge_base is not None else []
+        self.source_prior_by_code = np.array(
+            [self.source_priors.get(source, self.default_prior) for source in sources], dtype=np.float32
+        )
+
+    def doc_types(self) -> List[str]:
+        """doc_type values in code order"""
+        return list(self.knowledge_base.doc_types.values) if self.knowledge_base is not None else []
+
+    def rows_for(self, candidates: List) -> np.ndarray:
+        """Row id of each candidate via its chunk id (-1 when it is not in the store)"""
+        rows = np.full(len(candidates), -1, dtype=np.int64)
+        if self.knowledge_base is None:
+            return rows
+
+        for i, candidate in enumerate(candidates):
+            chunk = candidate.get('doc', candidate) if isinstance(candidate, dict) else {}
+            chunk_id = chunk.get('id')
+            row = self.knowledge_base.row_of(chunk_id) if chunk_id is not None else None
+            if row is not None and row < len(self):
+                rows[i] = row
+        return rows
+
+    def gather(self, rows: np.ndarray, texts: List[str], doc_types: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Doc-side features for the given rows
+
+        Rows of -1 (candidates not in the store) are computed from their text,
+        with no doc_type column set and the default source prior.
+
+        Args:
+            rows: Row id per candidate, from rows_for
+            texts: Candidate texts, only read for rows of -1
+            doc_types: doc_type values that get a one-hot column, in column order
+        """
+        known = np.flatnonzero(rows >= 0)
+        unknown = np.flatnonzero(rows < 0)
+        known_rows = rows[known]
+
+        doc_length = np.zeros(len(rows))
+        doc_length[known] = self.token_counts[known_rows]
+        doc_length[unknown] = [len(texts[i].split()) for i in unknown]
+
+        source_prior = np.full(len(rows), self.default_prior)
+        source_prior[known] = self.source_prior_by_code[self.source_codes[known_rows]]
+
+        # One-hot column of each doc_type code (-1 for types without a column)
+        column_of = {doc_type: i for i, doc_type in enumerate(doc_types)}
+        code_to_column = np.array([column_of.get(t, -1) for t in self.doc_types()] + [-1], dtype=np.int64)
+        columns = code_to_column[self.doc_type_codes[known_rows]]
+        doc_type_onehot = np.zeros((len(rows), len(doc_types)), dtype=np.float32)
+        doc_type_onehot[known[columns >= 0], columns[columns >= 0]] = 1.0
+
+        # Stored term rows for known candidates, hashed from text for the rest, in candidate order
+        stacked = self.term_matrix[known_rows]
+        if len(unknown):
+            stacked = vstack([stacked, self.vectorizer.transform([texts[i] for i in unknown])], format='csr')
+        order = np.empty(len(rows), dtype=np.int64)
+        order[np.concatenate([known, unknown])] = np.arange(len(rows))
+
+        return {
+            'doc_length': doc_length,
+            'doc_type_onehot': doc_type_onehot,
+            'source_prior': source_prior,
+            'term_matrix': stacked[order]
+        }
+
+    def query_terms(self, queries: List[str]) -> csr_matrix:
+        """Binary hashed term rows for queries"""
+        return self.vectorizer.transform(queries)
+
+    def query_coverage(self, query_terms: csr_matrix, term_matrix: csr_matrix) -> np.ndarray:
+        """Share of each pair's distinct query terms present in its document (row-aligned inputs)"""
+        matches = np.asarray(term_matrix.multiply(query_terms).sum(axis=1)).ravel()
+        distinct = query_terms.getnnz(axis=1).astype(float)
+        return np.divide(matches, distinct, out=np.zeros(len(distinct)), where=distinct > 0)
+
+    def memory_usage(self) -> Dict:
+        """Bytes held by the feature columns"""
+        term_bytes = self.term_matrix.data.nbytes + self.term_matrix.indices.nbytes + self.term_matrix.indptr.nbytes
+        return {
+            'rows': len(self),
+            'token_counts_bytes': self.token_counts.nbytes,
+            'term_matrix_bytes': term_bytes,
+            'avg_terms_per_row': self.term_matrix.nnz / len(self) if len(self) else 0.0
+        }
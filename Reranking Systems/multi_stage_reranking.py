@@ -1,40 +1,203 @@
 # multi_stage_reranking.py
-from sentence_transformers import CrossEncoder
+import time
+from typing import List, Dict, Tuple
+
+import numpy as np
+from model_registry import get_cross_encoder
 
 
 class MultiStageReranker:
-    def __init__(self, base_rag):
+    def __init__(self, base_rag, backend: str = None):
+        """
+        Args:
+            base_rag: Retrieval system providing hybrid_search
+            backend: 'torch', 'onnx' or 'onnx-int8' (default: RERANKER_BACKEND env var, else torch)
+        """
         self.base_rag = base_rag
 
         # Different rerankers for different stages
-        self.stage_1_reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')  # Fast
-        self.stage_2_reranker = CrossEncoder('cross-encoder/ms-marco-electra-base')  # Accurate
+        self.stage_1_reranker = get_cross_encoder('cross-encoder/ms-marco-MiniLM-L-6-v2', backend=backend)  # Fast
+        self.stage_2_reranker = get_cross_encoder('cross-encoder/ms-marco-electra-base', backend=backend)  # Accurate
+
+        # Cascade settings; times are in seconds
+        self.cascade_config = {
+            'retrieve_k': 50,
+            'stage_1_budget': 0.25,  # Stage 1 stops scoring new batches after this
+            'stage_2_budget': 0.5,
+            'deadline': 1.0,  # Whole query; the best ranking so far is returned after it
+            'batch_size': 16,  # Pairs scored between budget checks
+            # Margins are in standard deviations of the query's stage-1 scores, so they
+            # do not depend on the stage-1 model's output scale or activation
+            'skip_margin': 1.0,  # Stage-1 top-1 lead over top-2 that makes stage 2 unnecessary
+            'pool_margin': 0.5,  # Stage-2 pool: candidates within this of the stage-1 top score
+            'min_pool': 5,
+            'max_pool': 10
+        }
+        self.cascade_stats = {'queries': 0, 'stage_2_skipped': 0, 'stage_1_cut': 0, 'stage_2_cut': 0}
+
+    def multi_stage_search(self, query: str, top_k: int = 5) -> List[Dict]:
+        """
+        Confidence-gated cascade: Retrieve → Fast Rerank → (optional) Precise Rerank
+
+        Returns the top_k results; see multi_stage_search_with_metadata for
+        the cascade's decisions and timings.
+        """
+        return self.multi_stage_search_with_metadata(query, top_k)['results']
+
+    def multi_stage_search_with_metadata(self, query: str, top_k: int = 5) -> Dict:
+        """
+        multi_stage_search plus the cascade's decisions and timings
 
-    def multi_stage_search(self, query: str, top_k: int = 5):
-        """Three-stage pipeline: Retrieve → Fast Rerank → Precise Rerank"""
+        Stage 2 is skipped when stage 1's top score leads by skip_margin, and
+        otherwise reranks an adaptive pool: stage-1 candidates within
+        pool_margin of the top score, clamped to [max(min_pool, top_k),
+        max_pool]. Both margins compare z-scored stage-1 scores, which need at
+        least three candidates to say anything (two always z-score to ±1), so
+        smaller candidate sets go to stage 2 whole. A stage that runs out of
+        its budget or the deadline stops after the current batch, and the last
+        complete ranking is returned.
+
+        Each result's final_score is on the scale of metadata['final_stage'],
+        the last stage whose ranking was kept: stage-2 scores when stage 2
+        reranked its pool, stage-1 scores otherwise. Results that stage did
+        not score (below the stage-2 pool, or left unscored when stage 1 was
+        cut) rank after the scored ones with final_score None.
+
+        Returns:
+            {'results': top_k results, 'metadata': timings, decisions and skip rates}
+        """
+        config = self.cascade_config
+        start_time = time.perf_counter()
+        deadline = start_time + config['deadline']
+        timings = {}
 
         # Stage 1: Broad retrieval
-        candidates = self.base_rag.hybrid_search(query, top_k=50)
+        candidates = self.base_rag.hybrid_search(query, top_k=config['retrieve_k'])
+        timings['retrieval'] = time.perf_counter() - start_time
+        self.cascade_stats['queries'] += 1
+
+        # Stage 2: Fast reranking of every candidate
+        stage_start = time.perf_counter()
+        stage_1_scores = self._score_until(self.stage_1_reranker, query, candidates,
+                                           min(deadline, stage_start + config['stage_1_budget']))
+        timings['stage_1'] = time.perf_counter() - stage_start
 
-        # Stage 2: Fast reranking (50 → 10)
-        stage_1_pairs = [[query, self._extract_text(c)] for c in candidates]
-        stage_1_scores = self.stage_1_reranker.predict(stage_1_pairs)
+        # Scored candidates best first; any left unscored keep retrieval order behind them
+        scored_order = np.argsort(-stage_1_scores, kind='stable')
+        order = list(scored_order) + list(range(len(stage_1_scores), len(candidates)))
+        ranking = [(candidates[i], float(stage_1_scores[i]) if i < len(stage_1_scores) else None, None)
+                   for i in order]
 
-        stage_1_results = list(zip(candidates, stage_1_scores))
-        stage_1_results.sort(key=lambda x: x[1], reverse=True)
-        top_10_candidates = [r[0] for r in stage_1_results[:10]]
+        decision, pool_size = self._stage_2_decision(stage_1_scores[scored_order], len(candidates), top_k)
+        if decision == 'stage_1_cut':
+            self.cascade_stats['stage_1_cut'] += 1
 
-        # Stage 3: Precise reranking (10 → 5)
-        stage_2_pairs = [[query, self._extract_text(c)] for c in top_10_candidates]
-        stage_2_scores = self.stage_2_reranker.predict(stage_2_pairs)
+        # Stage 3: Precise reranking of the adaptive pool
+        if decision == 'run_stage_2':
+            if time.perf_counter() >= deadline:
+                decision = 'deadline'
+            else:
+                stage_start = time.perf_counter()
+                pool = [candidate for candidate, _, _ in ranking[:pool_size]]
+                stage_2_scores = self._score_until(self.stage_2_reranker, query, pool,
+                                                   min(deadline, stage_start + config['stage_2_budget']))
+                timings['stage_2'] = time.perf_counter() - stage_start
 
+                if len(stage_2_scores) == len(pool):
+                    pool_order = np.argsort(-stage_2_scores, kind='stable')
+                    reranked_pool = [(ranking[i][0], ranking[i][1], float(stage_2_scores[i])) for i in pool_order]
+                    ranking = reranked_pool + ranking[pool_size:]
+                    decision = 'stage_2'
+                else:
+                    # A partly scored pool is not comparable; keep the stage-1 ranking
+                    self.cascade_stats['stage_2_cut'] += 1
+                    decision = 'stage_2_cut'
+        elif decision == 'skip_margin':
+            self.cascade_stats['stage_2_skipped'] += 1
+
+        # Never mix the two models' scales under final_score
+        final_stage = 'stage_2' if decision == 'stage_2' else 'stage_1'
         final_results = []
-        for candidate, score in zip(top_10_candidates, stage_2_scores):
+        for candidate, stage_1_score, stage_2_score in ranking[:top_k]:
             final_results.append({
                 'text': self._extract_text(candidate),
                 'source': self._extract_field(candidate, 'source'),
-                'final_score': float(score)
+                'final_score': stage_2_score if final_stage == 'stage_2' else stage_1_score,
+                'stage_1_score': stage_1_score,
+                'stage_2_score': stage_2_score
             })
 
-        final_results.sort(key=lambda x: x['final_score'], reverse=True)
-        return final_results[:top_k]
+        timings['total'] = time.perf_counter() - start_time
+        queries = self.cascade_stats['queries']
+
+        return {
+            'results': final_results,
+            'metadata': {
+                'decision': decision,
+                'final_stage': final_stage,
+                'candidates': len(candidates),
+                'stage_1_scored': len(stage_1_scores),
+                'stage_2_pool': pool_size if decision in ('stage_2', 'stage_2_cut') else 0,
+                'timings': timings,
+                'deadline_exceeded': timings['total'] > config['deadline'],
+                'stage_2_skip_rate': self.cascade_stats['stage_2_skipped'] / queries,
+                'stage_1_cut_rate': self.cascade_stats['stage_1_cut'] / queries,
+                'stage_2_cut_rate': self.cascade_stats['stage_2_cut'] / queries
+            }
+        }
+
+    def _stage_2_decision(self, sorted_scores: np.ndarray, num_candidates: int, top_k: int) -> Tuple[str, int]:
+        """Whether stage 2 should run, and on how many stage-1 leaders"""
+        config = self.cascade_config
+
+        if num_candidates == 0:
+            return 'no_candidates', 0
+        if len(sorted_scores) < num_candidates:
+            return 'stage_1_cut', 0
+        if len(sorted_scores) == 1:
+            return 'single_candidate', 0
+        if len(sorted_scores) < 3:
+            return 'run_stage_2', len(sorted_scores)
+
+        # Margins apply to z-scores: raw outputs may be logits or probabilities depending on the model
+        spread = float(sorted_scores.std())
+        if spread == 0:
+            z_scores = np.zeros(len(sorted_scores))
+        else:
+            z_scores = (sorted_scores - sorted_scores.mean()) / spread
+        if z_scores[0] - z_scores[1] >= config['skip_margin']:
+            return 'skip_margin', 0
+
+        # Pool grows with the number of candidates close to the leader
+        close = int(np.sum(z_scores >= z_scores[0] - config['pool_margin']))
+        pool_size = min(max(close, config['min_pool'], top_k), config['max_pool'], len(sorted_scores))
+        return 'run_stage_2', pool_size
+
+    def _score_until(self, reranker, query: str, candidates: List, stop_at: float) -> np.ndarray:
+        """Score candidates batch by batch until done or stop_at; returns the scored prefix"""
+        batch_size = self.cascade_config['batch_size']
+        scores = []
+
+        for start in range(0, len(candidates), batch_size):
+            if start and time.perf_counter() >= stop_at:
+                break
+            pairs = [[query, self._extract_text(c)] for c in candidates[start:start + batch_size]]
+            scores.extend(reranker.predict(pairs))
+
+        return np.asarray(scores, dtype=np.float32)
+
+    def _extract_text(self, candidate) -> str:
+        """Extract text from different candidate formats"""
+        if isinstance(candidate, dict):
+            if 'doc' in candidate:
+                return candidate['doc'].get('text', '')
+            return candidate.get('text', '')
+        return str(candidate)
+
+    def _extract_field(self, candidate, field: str):
+        """Extract field from different candidate formats"""
+        if isinstance(candidate, dict):
+            if 'doc' in candidate:
+                return candidate['doc'].get(field, 'unknown')
+            return candidate.get(field, 'unknown')
+        return 'unknown'
@@ -0,0 +1,243 @@
+# result_cache.py
+import copy
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from score_cache import normalize_query
+
+
+class SharedResultStore:
+    """
+    SQLite table of cached results that several processes on one host can share
+
+    Rows carry the index version they were computed for and an expiry
+    time. At most every prune_interval seconds a write prunes expired rows,
+    the oldest rows beyond max_entries, and rows of other index versions
+    once they are older than version_grace. The grace period lets
+    processes on different versions during a rolling reindex share the
+    store without wiping each other's fresh entries.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000, version_grace: float = 300,
+                 prune_interval: float = 30):
+        """
+        Args:
+            path: SQLite file
+            max_entries: Rows kept before the oldest are pruned
+            version_grace: Seconds rows of another index version survive
+            prune_interval: Minimum seconds between prunes
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.version_grace = version_grace
+        self.prune_interval = prune_interval
+        self.last_prune = 0.0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS reranked_results (
+                key TEXT PRIMARY KEY,
+                index_version TEXT,
+                value TEXT,
+                created_at REAL,
+                expires_at REAL
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM reranked_results WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, index_version: str, value: Any, expires_at: Optional[float]):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO reranked_results VALUES (?, ?, ?, ?, ?)",
+                (key, index_version, json.dumps(value, default=float), now, expires_at)
+            )
+            if now - self.last_prune >= self.prune_interval:
+                self._prune(index_version, now)
+            self.conn.commit()
+
+    def _prune(self, index_version: str, now: float):
+        """Drop expired rows, other versions' rows past the grace period and rows beyond max_entries"""
+        self.last_prune = now
+        self.conn.execute(
+            "DELETE FROM reranked_results WHERE expires_at <= ? OR (index_version != ? AND created_at < ?)",
+            (now, index_version, now - self.version_grace)
+        )
+        self.conn.execute("""
+            DELETE FROM reranked_results WHERE key IN (
+                SELECT key FROM reranked_results ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM reranked_results")
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class ResultCache:
+    """
+    Bounded LRU/TTL cache of reranked results
+
+    Keys combine a namespace (e.g. the reranker), the retriever's index
+    version, the normalized query and the request parameters. When the index
+    version changes, every entry of the old version is dropped on the next
+    lookup. Concurrent misses for the same key are coalesced: one caller
+    computes and the others wait for its result. Every caller gets its own
+    copy of the result, so mutating it never changes the cached entry. With
+    shared_path set, results are also kept in a SQLite store that other
+    processes can read.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: Optional[float] = 600, namespace: str = '',
+                 shared_path: str = None):
+        """
+        Args:
+            max_entries: Entries kept before the least recently used are evicted
+            ttl: Seconds an entry stays valid (None = until the index changes)
+            namespace: Separates caches of different rerankers in a shared store
+            shared_path: SQLite file shared across processes (None = in-process only)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.namespace = namespace
+        self.shared = SharedResultStore(shared_path) if shared_path else None
+
+        self.entries = OrderedDict()
+        self.index_version = None
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'version_invalidations': 0
+        }
+
+    def make_key(self, query: str, **params) -> Tuple:
+        """Cache key for a query and its request parameters"""
+        return (self.namespace, normalize_query(query), tuple(sorted(params.items())))
+
+    def get_or_compute(self, index_version, query: str, compute: Callable[[], Any], **params) -> Any:
+        """
+        Cached result for (query, params) at index_version, or compute() once
+
+        Args:
+            index_version: Current version of the index the results come from
+            compute: Produces the result on a miss
+            params: Request parameters that change the result (e.g. top_k)
+        """
+        key = self.make_key(query, **params)
+        index_version = str(index_version)
+
+        with self.lock:
+            self._check_version(index_version)
+            value = self._get_local(key)
+            if value is not None:
+                self.stats['hits'] += 1
+                return copy.deepcopy(value)
+
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            value = self.shared.get(self._shared_key(index_version, key)) if self.shared else None
+            if value is not None:
+                with self.lock:
+                    self.stats['shared_hits'] += 1
+            else:
+                with self.lock:
+                    self.stats['misses'] += 1
+                value = compute()
+                if self.shared:
+                    self.shared.put(self._shared_key(index_version, key), index_version, value, self._expires_at())
+
+            # The cache keeps a snapshot; the caller gets the computed object itself
+            snapshot = copy.deepcopy(value)
+            with self.lock:
+                # Skip storing if the index changed while computing
+                if self.index_version == index_version:
+                    self._put_local(key, snapshot)
+            future.set_result(snapshot)
+            return value
+
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def _check_version(self, index_version: str):
+        """Drop all entries once the index version changes"""
+        if index_version != self.index_version:
+            if self.index_version is not None and self.entries:
+                self.stats['version_invalidations'] += len(self.entries)
+            self.entries.clear()
+            self.index_version = index_version
+
+    def _get_local(self, key: Tuple) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def _put_local(self, key: Tuple, value: Any):
+        self.entries[key] = (value, self._expires_at())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl is not None else None
+
+    def _shared_key(self, index_version: str, key: Tuple) -> str:
+        return json.dumps([index_version, key])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.shared:
+            self.shared.clear()
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_ratio'] = (lookups - stats['misses']) / lookups if lookups else 0.0
+        return stats
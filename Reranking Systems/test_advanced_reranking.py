@@ -1,6 +1,28 @@
 # test_advanced_reranking.py
+import asyncio
+import json
+import threading
+
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.linear_model import LogisticRegression
+
 from hybrid_retrieval_system import HybridRetrievalRAG
 from advanced_reranking_system import AdvancedRerankedRAG
+from batching_server import MicroBatchScheduler
+from chunk_store import ChunkStore
+from compiled_trees import CompiledTreeEnsemble, train_lambdamart
+from domain_specific_reranking import DomainSpecificReranker
+from learning_to_rank import LearningToRankReranker
+from ltr_features import DocFeatureStore
+from model_registry import ModelRegistry, default_registry, get_cross_encoder
+from multi_stage_reranking import MultiStageReranker
+from onnx_backend import OnnxCrossEncoder, export_cross_encoder, forward_inputs
+from production_reranking import ProductionReranker
+from result_cache import ResultCache, SharedResultStore
+from score_cache import PairScoreCache
+from tracing import NOOP_SPAN, OTLPJsonSink, RingBufferSink, Tracer, format_trace
 
 
 def setup_test_system():
@@ -141,7 +163,7 @@ def test_reranker_comparison():
         reranked_rag.compare_rerankers(query, top_k=3)
 
 
-def test_performance_benchmark():
+def run_performance_benchmark():
     """Benchmark reranking performance"""
 
     reranked_rag = setup_test_system()
@@ -162,6 +184,628 @@ def test_performance_benchmark():
     return metrics
 
 
+def test_performance_benchmark():
+    metrics = run_performance_benchmark()
+
+    assert metrics['queries_tested'] == 8
+    assert 0.0 <= metrics['average_improvements']['positive_percentage'] <= 100.0
+    assert metrics['timing']['average_reranking'] >= 0.0
+
+
+class FixedScoreReranker:
+    """Stand-in cross-encoder returning a preset score per document text"""
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    def predict(self, pairs, **kwargs):
+        return np.array([self.scores[text] for _, text in pairs], dtype=float)
+
+
+class FixedCandidatesRAG:
+    """Stand-in retrieval system returning the same candidates for every query"""
+
+    def __init__(self, candidates):
+        self.candidates = candidates
+
+    def hybrid_search(self, query, top_k=5, **kwargs):
+        return self.candidates[:top_k]
+
+
+def test_domain_merge_calibrated_with_uncalibrated():
+    """A calibrated group merged with an uncalibrated group falls back to raw scores for both"""
+    candidates = [
+        {'id': 'p1', 'text': 'policy strong', 'source': 'Handbook', 'doc_type': 'policy'},
+        {'id': 'p2', 'text': 'policy weak', 'source': 'Handbook', 'doc_type': 'policy'},
+        {'id': 'f1', 'text': 'faq high logit', 'source': 'FAQ', 'doc_type': 'faq'},
+        {'id': 'f2', 'text': 'faq low logit', 'source': 'FAQ', 'doc_type': 'faq'}
+    ]
+    reranker = DomainSpecificReranker(FixedCandidatesRAG(candidates), max_workers=2)
+    reranker.rerankers['policy'] = FixedScoreReranker({'policy strong': 0.9, 'policy weak': -0.9})
+    reranker.rerankers['faq'] = FixedScoreReranker({'faq high logit': 10.0, 'faq low logit': -8.0})
+
+    platt = LogisticRegression(C=1e4).fit(np.array([[-1.0], [-0.8], [0.8], [1.0]]), [0, 0, 1, 1])
+    reranker.calibrators['policy'] = ('platt', platt)
+
+    response = reranker.domain_aware_search_with_metadata("vacation policy", top_k=4)
+    results = response['results']
+
+    assert response['metadata']['calibrated'] == {'policy': 'raw', 'faq': 'raw'}
+    assert all(r['rerank_score'] == r['raw_score'] for r in results)
+    assert [r['text'] for r in results] == ['faq high logit', 'policy strong', 'policy weak', 'faq low logit']
+    # The plain API still returns the result list
+    assert reranker.domain_aware_search("vacation policy", top_k=4) == results
+
+    # Once every group is calibrated, probabilities are merged instead: a logit of 10 is only a coin flip here
+    reranker.calibrators['faq'] = ('platt', LogisticRegression(C=1e4).fit(
+        np.array([[8.0], [9.0], [11.0], [12.0]]), [0, 0, 1, 1]))
+    response = reranker.domain_aware_search_with_metadata("vacation policy", top_k=4)
+    assert response['metadata']['calibrated'] == {'policy': 'platt', 'faq': 'platt'}
+    assert all(0.0 <= r['rerank_score'] <= 1.0 for r in response['results'])
+    assert response['results'][0]['text'] == 'policy strong'
+
+
+def test_compare_rerankers_report():
+    """compare_rerankers returns per-model rankings, latency and pairwise rank correlation"""
+    candidates = [
+        {'id': f'doc_{i}', 'text': f'document {i}', 'source': 'Docs', 'doc_type': 'policy',
+         'combined_score': 1.0 - i / 10} for i in range(4)
+    ]
+    same = {'document 0': 4.0, 'document 1': 3.0, 'document 2': 2.0, 'document 3': 1.0}
+    reversed_scores = {text: -score for text, score in same.items()}
+
+    rag = AdvancedRerankedRAG(FixedCandidatesRAG(candidates), reranker_models={
+        'a': FixedScoreReranker(same),
+        'b': FixedScoreReranker(same),
+        'c': FixedScoreReranker(reversed_scores)
+    })
+    report = rag.compare_rerankers("policy", top_k=2)
+
+    assert [r['id'] for r in report['rankings']['a']] == ['doc_0', 'doc_1']
+    assert [r['id'] for r in report['rankings']['c']] == ['doc_3', 'doc_2']
+    assert set(report['latency']) == {'a', 'b', 'c'}
+    assert all(latency >= 0 for latency in report['latency'].values())
+    assert report['rank_correlation']['a vs b'] == pytest.approx(1.0)
+    assert report['rank_correlation']['a vs c'] == pytest.approx(-1.0)
+
+
+def test_compare_rerankers_without_candidates():
+    """No retrieved candidates gives an empty report without calling any model"""
+    rag = AdvancedRerankedRAG(FixedCandidatesRAG([]), reranker_models={
+        'a': FixedScoreReranker({}),
+        'b': FixedScoreReranker({})
+    })
+    report = rag.compare_rerankers("anything")
+
+    assert report['rankings'] == {'a': [], 'b': []}
+    assert report['rank_correlation'] == {}
+
+
+def test_shared_cross_encoder_empty_input():
+    """Empty input scores to an empty array on every predict path"""
+    reranker = get_cross_encoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+    reranker.enable_token_cache()
+
+    for scores in (reranker.predict([]), reranker.predict_uncached([])):
+        assert isinstance(scores, np.ndarray)
+        assert scores.shape == (0,)
+
+
+def test_multi_stage_scores_stay_on_one_scale():
+    """final_score comes from one model only, and the skip decision ignores the stage-1 output scale"""
+    candidates = [{'id': f'doc_{i}', 'text': f'document {i}', 'source': 'Docs', 'doc_type': 'policy'}
+                  for i in range(12)]
+    close_scores = {f'document {i}': 5.0 - 0.1 * i for i in range(12)}
+
+    cascade = MultiStageReranker(FixedCandidatesRAG(candidates))
+    cascade.cascade_config['retrieve_k'] = 12
+    cascade.stage_1_reranker = FixedScoreReranker(close_scores)
+    cascade.stage_2_reranker = FixedScoreReranker({f'document {i}': 0.01 * i for i in range(12)})
+
+    response = cascade.multi_stage_search_with_metadata("policy", top_k=12)
+    results = response['results']
+    pool = response['metadata']['stage_2_pool']
+
+    assert response['metadata']['decision'] == 'stage_2'
+    assert response['metadata']['final_stage'] == 'stage_2'
+    assert all(r['final_score'] == r['stage_2_score'] for r in results[:pool])
+    assert all(r['final_score'] is None for r in results[pool:])
+
+    # A decisive stage-1 leader skips stage 2 whatever the scale of the stage-1 scores
+    for scale in (0.01, 1.0, 100.0):
+        leader_scores = {text: score * scale for text, score in close_scores.items()}
+        leader_scores['document 0'] = 20.0 * scale
+        cascade.stage_1_reranker = FixedScoreReranker(leader_scores)
+        response = cascade.multi_stage_search_with_metadata("policy", top_k=3)
+        assert response['metadata']['decision'] == 'skip_margin'
+        assert response['metadata']['final_stage'] == 'stage_1'
+        assert all(r['final_score'] == r['stage_1_score'] for r in response['results'])
+
+
+def test_multi_stage_small_candidate_sets():
+    """Empty and tiny candidate sets get their own decisions, and the plain API returns a list"""
+    def cascade_over(texts):
+        candidates = [{'id': text, 'text': text, 'source': 'Docs', 'doc_type': 'policy'} for text in texts]
+        cascade = MultiStageReranker(FixedCandidatesRAG(candidates))
+        cascade.stage_1_reranker = FixedScoreReranker({'document 0': 9.0, 'document 1': 0.0})
+        cascade.stage_2_reranker = FixedScoreReranker({'document 0': 0.1, 'document 1': 0.9})
+        return cascade
+
+    assert cascade_over([]).multi_stage_search_with_metadata("policy")['metadata']['decision'] == 'no_candidates'
+    assert cascade_over([]).multi_stage_search("policy") == []
+
+    single = cascade_over(['document 0']).multi_stage_search_with_metadata("policy")
+    assert single['metadata']['decision'] == 'single_candidate'
+    assert [r['text'] for r in single['results']] == ['document 0']
+
+    # Two candidates always z-score to ±1, so however large the lead, stage 2 decides
+    results = cascade_over(['document 0', 'document 1']).multi_stage_search("policy")
+    assert isinstance(results, list)
+    assert [r['text'] for r in results] == ['document 1', 'document 0']
+    assert all(r['final_score'] == r['stage_2_score'] for r in results)
+
+
+def test_result_cache_hands_out_copies():
+    """Mutating a returned result never changes what later hits see"""
+    cache = ResultCache(max_entries=10, ttl=None)
+    compute = lambda: [{'text': 'document 0', 'rerank_score': 1.0}]
+
+    first = cache.get_or_compute('v1', "policy", compute, top_k=5)
+    first[0]['rerank_score'] = -1.0
+    first.append({'text': 'injected'})
+
+    second = cache.get_or_compute('v1', "policy", compute, top_k=5)
+    assert second == [{'text': 'document 0', 'rerank_score': 1.0}]
+    second.clear()
+    assert cache.get_or_compute('v1', "policy", compute, top_k=5) == [{'text': 'document 0', 'rerank_score': 1.0}]
+    assert cache.get_stats()['misses'] == 1
+
+
+def test_shared_store_keeps_fresh_rows_of_other_versions(tmp_path):
+    """Two processes on different index versions do not wipe each other's fresh entries"""
+    path = str(tmp_path / 'results.sqlite')
+    old_version = SharedResultStore(path, prune_interval=0)
+    new_version = SharedResultStore(path, prune_interval=0)
+
+    old_version.put('old-key', 'v1', ['old result'], None)
+    new_version.put('new-key', 'v2', ['new result'], None)
+    old_version.put('old-key-2', 'v1', ['old result 2'], None)
+
+    assert new_version.get('old-key') == ['old result']
+    assert old_version.get('new-key') == ['new result']
+
+    # Past the grace period the other version's rows are pruned
+    new_version.version_grace = 0
+    new_version.put('new-key-2', 'v2', ['new result 2'], None)
+    assert new_version.get('old-key') is None
+    assert new_version.get('new-key') == ['new result']
+
+
+class BertLikeNetwork:
+    """Stand-in for a BERT forward signature, which takes attention_mask before token_type_ids"""
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, position_ids=None):
+        pass
+
+
+class NoMaskNetwork:
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None):
+        pass
+
+
+def test_onnx_export_inputs_follow_forward_order():
+    """Graph input names line up with the tensors the exporter traces positionally"""
+    # Tokenizers return token_type_ids before attention_mask
+    features = {'input_ids': 'ids', 'token_type_ids': 'types', 'attention_mask': 'mask'}
+
+    input_names, args = forward_inputs(BertLikeNetwork(), features)
+    assert input_names == ['input_ids', 'attention_mask', 'token_type_ids']
+    assert args == ('ids', 'mask', 'types')
+
+    input_names, args = forward_inputs(NoMaskNetwork(), {'input_ids': 'ids', 'token_type_ids': 'types'})
+    assert input_names == ['input_ids', 'token_type_ids']
+    assert args == ('ids', None, 'types')
+
+    with pytest.raises(ValueError):
+        forward_inputs(NoMaskNetwork(), {'input_ids': 'ids', 'pixel_values': 'pixels'})
+
+
+def test_onnx_scores_match_pytorch(tmp_path):
+    """The exported fp32 model scores pairs like the PyTorch CrossEncoder"""
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('transformers')
+    from sentence_transformers import CrossEncoder
+
+    model_name = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+    pairs = [
+        ["How many vacation days?", "New employees receive 15 vacation days in their first year."],
+        ["How many vacation days?", "Password reset: visit the company portal."],
+        ["VPN setup", "Download Cisco AnyConnect and use your network credentials to connect."]
+    ]
+
+    model_dir = export_cross_encoder(model_name, str(tmp_path), quantize=False)
+    onnx_scores = OnnxCrossEncoder(model_dir, quantized=False).predict(pairs)
+    torch_scores = np.asarray(CrossEncoder(model_name).predict(pairs), dtype=np.float32)
+
+    np.testing.assert_allclose(onnx_scores, torch_scores, atol=1e-4)
+
+
+class TruncationRecordingModel:
+    """Stand-in model recording the max_length each predict call ran with"""
+
+    def __init__(self, name):
+        self.max_length = 512
+        self.seen_lengths = []
+
+    def predict(self, sentences, **kwargs):
+        self.seen_lengths.append(self.max_length)
+        return np.ones(len(sentences), dtype=np.float32)
+
+
+def test_registry_keeps_released_models_loaded():
+    """Releasing or collecting a proxy never forces a reload; only evict() unloads"""
+    registry = ModelRegistry(loader=TruncationRecordingModel)
+
+    reranker = registry.acquire('model')
+    reranker.predict([['query', 'text']])
+    del reranker  # __del__ releases the only reference
+
+    registry.acquire('model').predict([['query', 'text']])
+    assert registry.get_stats()['model']['loads'] == 1
+    assert registry.get_stats()['model']['loaded']
+
+    assert registry.evict('model')
+    assert not registry.get_stats()['model']['loaded']
+    registry.acquire('model').predict([['query', 'text']])
+    assert registry.get_stats()['model']['loads'] == 2
+
+
+def test_default_length_predict_waits_for_truncated_predict():
+    """A proxy without max_length never scores while another proxy has the shared model truncated"""
+    registry = ModelRegistry(loader=TruncationRecordingModel)
+    default_proxy = registry.acquire('model')
+    model = registry.get_model('model')
+
+    lock = registry.model_lock('model')
+    with lock:
+        model.max_length = 8  # What a truncating proxy does while holding the lock
+        worker = threading.Thread(target=default_proxy.predict_uncached, args=([['query', 'text']],))
+        worker.start()
+        worker.join(timeout=0.2)
+        assert worker.is_alive()
+        model.max_length = 512
+    worker.join(timeout=5)
+
+    assert model.seen_lengths == [512]
+
+
+class BlockingOTLPSink(OTLPJsonSink):
+    """Export whose write waits for the test, like a collector that stopped answering"""
+
+    def __init__(self, **kwargs):
+        self.release = threading.Event()
+        super().__init__(**kwargs)
+
+    def _send(self, batch):
+        self.release.wait(timeout=5)
+        super()._send(batch)
+
+
+def test_otlp_export_does_not_block_the_emitting_thread(tmp_path):
+    """Full batches are written by the export thread; flush() waits for them"""
+    path = tmp_path / 'traces.jsonl'
+    sink = BlockingOTLPSink(path=str(path), batch_size=2)
+    otlp_tracer = Tracer([sink], enabled=True)
+
+    for _ in range(4):
+        with otlp_tracer.span('stage'):
+            pass  # Returns although the first batch is still stuck in _send
+
+    assert not path.exists()
+    sink.release.set()
+    sink.close()
+
+    requests = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert len(requests) == 2
+    assert all(len(r['resourceSpans'][0]['scopeSpans'][0]['spans']) == 2 for r in requests)
+    assert not sink.worker.is_alive()
+
+
+class PairRecordingModel:
+    """Stand-in model scoring a pair by its text length and recording every pair it scored"""
+
+    def __init__(self, name):
+        self.max_length = 512
+        self.scored = []
+
+    def predict(self, sentences, **kwargs):
+        self.scored.extend(tuple(pair) for pair in sentences)
+        return np.array([len(text) for _, text in sentences], dtype=np.float32)
+
+
+def test_pair_score_cache_skips_scored_pairs():
+    """Only unseen (query, chunk text) pairs reach the model; changed or invalidated text is rescored"""
+    cache = PairScoreCache(max_entries=3)
+    registry = ModelRegistry(loader=PairRecordingModel, score_cache=cache)
+    reranker = registry.acquire('model')
+    model = registry.get_model('model')
+
+    pairs = [['Vacation days', 'policy text'], ['Vacation days', 'faq']]
+    np.testing.assert_array_equal(reranker.predict(pairs), [11, 3])
+    # Same query up to case and whitespace, one new chunk
+    scores = reranker.predict([['  vacation   DAYS ', 'policy text'], ['vacation days', 'guide text']])
+    np.testing.assert_array_equal(scores, [11, 10])
+    assert model.scored == [('Vacation days', 'policy text'), ('Vacation days', 'faq'),
+                            ('vacation days', 'guide text')]
+
+    # Truncating proxies key their scores separately
+    registry.acquire('model', max_length=8).predict(pairs[:1])
+    assert len(model.scored) == 4
+
+    assert cache.invalidate_chunk(text='policy text') == 2
+    reranker.predict(pairs[:1])
+    assert len(model.scored) == 5
+
+    stats = cache.get_stats()
+    assert stats['hits'] == 1
+    # The truncated score pushed out the least recently used entry ('faq')
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 2
+    assert stats['invalidations'] == 2
+
+    expired = PairScoreCache(ttl=0)
+    expired.store(expired.lookup('model', pairs)[1], [1.0, 2.0])
+    assert expired.lookup('model', pairs)[0] == [None, None]
+
+
+def test_micro_batch_scheduler_routes_scores_to_callers():
+    """Concurrent requests share predict calls and each caller gets its own pairs' scores"""
+    batches = []
+
+    def predict(pairs):
+        batches.append(len(pairs))
+        if any(text == 'boom' for _, text in pairs):
+            raise RuntimeError('model failed')
+        return [len(text) for _, text in pairs]
+
+    async def serve():
+        scheduler = MicroBatchScheduler(predict, max_batch_size=4, max_wait=0.05)
+        requests = [
+            [['q1', 'a'], ['q1', 'bb']],
+            [['q2', 'ccc'], ['q2', 'dddd']],
+            [['q3', 'e'], ['q3', 'ff'], ['q3', 'ggg']],
+            [['q4', 'hhhhh']],
+            [['q5', 'x'] for _ in range(6)]  # Larger than a batch: scored alone, never split
+        ]
+        try:
+            results = await asyncio.gather(*(scheduler.score(pairs) for pairs in requests))
+            with pytest.raises(RuntimeError):
+                await scheduler.score([['q6', 'boom']])
+            assert len(await scheduler.score([])) == 0
+            return results, scheduler.get_stats()
+        finally:
+            await scheduler.close()
+
+    results, stats = asyncio.run(serve())
+
+    assert [r.tolist() for r in results] == [[1, 2], [3, 4], [1, 2, 3], [5], [1] * 6]
+    assert batches == [4, 4, 6, 1]
+    assert stats['requests'] == 5 and stats['batches'] == 3  # The failed batch is not counted
+    assert stats['avg_batch_size'] == pytest.approx(14 / 3)
+    assert stats['batch_size_histogram'] == {4: 2, 8: 1}
+
+
+def test_token_budget_batches_group_similar_lengths():
+    """Batches stay in one length bucket and under the token budget; scores land on their own pairs"""
+    word_counts = [2, 40, 3, 100, 5, 60, 4, 45, 120, 6, 50, 3]
+    candidates = [{'text': ' '.join(['vacation'] + [f'w{i}'] * (n - 1)), 'source': f'doc_{i}',
+                   'combined_score': 0.5} for i, n in enumerate(word_counts)]
+    reranker = ProductionReranker(FixedCandidatesRAG(candidates), precompute_tokens=False)
+    reranker.token_budget = 256
+
+    pairs = reranker._prepare_pairs('vacation days', candidates)
+    lengths = reranker._pair_lengths(pairs)
+    batches = reranker._token_budget_batches(lengths)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(candidates)))
+    for batch in batches:
+        assert len(set(np.searchsorted(reranker.length_buckets, lengths[batch]))) == 1
+        assert len(batch) == 1 or len(batch) * lengths[batch].max() <= reranker.token_budget
+
+    # Each result keeps the score of its own pair despite the reordering
+    expected = dict(zip((text for _, text in pairs), reranker.reranker.predict_uncached(pairs)))
+    results = reranker.optimized_rerank('vacation days', candidates)
+    assert {r['text']: r['rerank_score'] for r in results} == pytest.approx(expected)
+    assert [r['rerank_score'] for r in results] == sorted(expected.values(), reverse=True)
+
+    fixed = [np.arange(i, min(i + 4, len(pairs))) for i in range(0, len(pairs), 4)]
+    assert reranker._padding_cost(lengths, batches)[1] < reranker._padding_cost(lengths, fixed)[1]
+    assert reranker.get_padding_stats()['pairs'] == len(candidates)
+
+
+class CallCountingEncoder:
+    """Wraps a cross-encoder and records the size of each predict call"""
+
+    def __init__(self, model):
+        self.model = model
+        self.calls = []
+
+    def predict(self, pairs, **kwargs):
+        self.calls.append(len(pairs))
+        return self.model.predict(pairs, **kwargs)
+
+
+def test_ltr_features_are_batched_per_query():
+    """One cross-encoder call per query (or per training pass); rows match the per-candidate features"""
+    reranked_rag = setup_test_system()
+    ltr = LearningToRankReranker(reranked_rag.base_rag, source_priors={'HR_Procedures': 0.5})
+    encoder = CallCountingEncoder(ltr.cross_encoder)
+    ltr.cross_encoder = encoder
+
+    query = 'Vacation request procedures'
+    candidates = reranked_rag.base_rag.hybrid_search(query, top_k=5)
+    features = ltr.extract_features_batch(query, candidates)
+    assert encoder.calls == [5]
+    assert features.shape == (5, len(ltr.feature_names()))
+
+    names = ltr.feature_names()
+    for candidate, row in zip(candidates, features):
+        np.testing.assert_allclose(row, ltr.extract_features(query, candidate))
+        terms = set(candidate['text'].lower().split())
+        assert row[names.index('doc_length')] == len(candidate['text'].split())
+        assert row[names.index('query_length')] == 3
+        assert row[names.index('query_coverage')] == pytest.approx(len(terms & {'vacation', 'request', 'procedures'}) / 3)
+        assert row[names.index('cross_encoder_score')] == pytest.approx(ltr.cross_encoder.model.predict([[query, candidate['text']]])[0])
+        assert row[names.index('source_prior')] == (0.5 if candidate['source'] == 'HR_Procedures' else 0.0)
+        assert row[names.index(f"doc_type={candidate['doc_type']}")] == 1.0
+
+    encoder.calls.clear()
+    ltr.train_ltr_model([
+        {'query': query, 'relevance_scores': {'hr_004': 2}},
+        {'query': 'reset my password', 'relevance_scores': {'it_001': 2}}
+    ])
+    assert len(encoder.calls) == 1  # Both queries' candidates in one batch
+    assert len(ltr.ltr_rerank(query, top_k=3)) == 3
+
+
+def test_doc_feature_store_syncs_and_gathers_by_row():
+    """Doc-side features are built once per row, extended incrementally and gathered by chunk id"""
+    store = ChunkStore()
+    store.extend([
+        {'id': 'hr_001', 'text': 'Vacation days accrue monthly', 'source': 'HR', 'doc_type': 'policy'},
+        {'id': 'it_001', 'text': 'Reset the VPN password', 'source': 'IT', 'doc_type': 'faq'}
+    ])
+    features = DocFeatureStore(source_priors={'HR': 1.0}, default_prior=0.1)
+    features.sync(store)
+    first_terms = features.term_matrix
+
+    store.append('Vacation requests need manager approval', 'HR', 'procedure', chunk_id='hr_002')
+    features.sync(store)
+    assert len(features) == 3
+    # Existing rows were kept, only the new row was hashed
+    assert (features.term_matrix[:2] != first_terms).nnz == 0
+    assert features.token_counts.tolist() == [4, 4, 5]
+
+    candidates = [{'id': 'hr_002'}, {'id': 'unknown', 'text': 'vacation policy'}, {'doc': {'id': 'it_001'}}]
+    rows = features.rows_for(candidates)
+    assert rows.tolist() == [2, -1, 1]
+
+    gathered = features.gather(rows, ['', 'vacation policy', ''], ['policy', 'procedure'])
+    assert gathered['doc_length'].tolist() == [5, 2, 4]
+    assert gathered['source_prior'].tolist() == pytest.approx([1.0, 0.1, 0.1])
+    assert gathered['doc_type_onehot'].tolist() == [[0, 1], [0, 0], [0, 0]]
+
+    query_terms = features.query_terms(['VACATION requests'] * 3)
+    assert features.query_coverage(query_terms, gathered['term_matrix']).tolist() == [1.0, 0.5, 0.0]
+
+    features.set_source_priors({'IT': 0.7})
+    assert features.gather(rows, ['', 'vacation policy', ''], [])['source_prior'][2] == pytest.approx(0.7)
+    store.close()
+
+
+def synthetic_ltr_data(n_queries, n_candidates=10, seed=0):
+    """Features, graded labels and query ids; relevance mostly follows features 0 and 2"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_queries * n_candidates, 6))
+    y = np.clip(np.round(X[:, 0] + 0.5 * X[:, 2] + rng.normal(scale=0.3, size=len(X))), 0, 3)
+    return X, y, np.repeat(np.arange(n_queries), n_candidates)
+
+
+def mean_ndcg(scores, y, groups, k=5):
+    """Mean NDCG@k over query groups"""
+    values = []
+    for group in np.unique(groups):
+        labels, group_scores = y[groups == group], scores[groups == group]
+        discounts = 1.0 / np.log2(np.arange(2, k + 2))
+        gains = 2.0 ** labels[np.argsort(-group_scores, kind='stable')][:k] - 1
+        ideal = 2.0 ** np.sort(labels)[::-1][:k] - 1
+        if ideal.sum() > 0:
+            values.append((gains * discounts[:len(gains)]).sum() / (ideal * discounts[:len(ideal)]).sum())
+    return float(np.mean(values))
+
+
+def test_compiled_tree_ensemble_matches_sklearn(tmp_path):
+    """Compiled forests and boosted trees score like sklearn and survive a save/load round trip"""
+    X, y, _ = synthetic_ltr_data(30)
+
+    for model in (RandomForestRegressor(n_estimators=20, random_state=0),
+                  GradientBoostingRegressor(n_estimators=30, max_depth=3, random_state=0)):
+        model.fit(X, y)
+        compiled = CompiledTreeEnsemble.from_sklearn(model)
+        np.testing.assert_allclose(compiled.predict(X), model.predict(X), atol=1e-9)
+
+        path = str(tmp_path / 'model.npz')
+        compiled.feature_names = [f'f{i}' for i in range(X.shape[1])]
+        compiled.save(path)
+        loaded = CompiledTreeEnsemble.load(path)
+        np.testing.assert_array_equal(loaded.predict(X), compiled.predict(X))
+        assert loaded.feature_names == compiled.feature_names
+
+    with pytest.raises(TypeError):
+        CompiledTreeEnsemble.from_sklearn(LogisticRegression())
+
+
+def test_lambdamart_improves_ndcg_over_baseline():
+    """LambdaMART ranks held-out queries better than the best single feature"""
+    X, y, groups = synthetic_ltr_data(80)
+    train, test = groups < 60, groups >= 60
+
+    model = train_lambdamart(X[train], y[train], groups[train], n_estimators=40, max_depth=3)
+    assert model.n_trees == 40
+
+    baseline = mean_ndcg(X[test, 0], y[test], groups[test])
+    lambdamart = mean_ndcg(model.predict(X[test]), y[test], groups[test])
+    assert lambdamart > baseline
+
+
+def test_tracer_nests_spans_and_records_to_ring_buffer():
+    """Spans nest across await points, record errors and attributes, and cost nothing while disabled"""
+    sink = RingBufferSink(max_spans=3)
+    stage_tracer = Tracer([sink], enabled=False)
+    assert stage_tracer.span('stage', candidates=20) is NOOP_SPAN
+
+    # capture() records its own context even while tracing is off, without touching sinks
+    with stage_tracer.capture() as captured:
+        with stage_tracer.span('request'):
+            with stage_tracer.span('rerank') as span:
+                span.set(pairs=5)
+    assert [s.name for s in captured] == ['rerank', 'request']
+    assert captured[0].parent_id == captured[1].span_id
+    assert captured[0].attributes == {'pairs': 5}
+    assert sink.spans() == []
+
+    stage_tracer.enable()
+
+    async def pipeline():
+        with stage_tracer.span('request'):
+            await asyncio.sleep(0)
+            with stage_tracer.span('retrieve'):
+                await asyncio.sleep(0)
+
+    asyncio.run(pipeline())
+    request, = sink.spans('request')
+    retrieve, = sink.spans('retrieve')
+    assert retrieve.parent_id == request.span_id and retrieve.trace_id == request.trace_id
+    assert format_trace([request, retrieve]).splitlines()[1].startswith('   ⏱️ retrieve')
+
+    with pytest.raises(ValueError):
+        with stage_tracer.span('rerank'):
+            raise ValueError('bad batch')
+    failed, = sink.spans('rerank')
+    assert failed.status == 'error' and 'bad batch' in failed.attributes['error']
+
+    with stage_tracer.span('extra'):
+        pass
+    # Spans are recorded as they finish, so the inner 'retrieve' was the oldest and is dropped
+    assert [s.name for s in sink.spans()] == ['request', 'rerank', 'extra']
+    summary = sink.summary()
+    assert set(summary) == {'request', 'rerank', 'extra'}
+    assert summary['extra']['count'] == 1 and summary['extra']['max_ms'] >= 0
+
+    stage_tracer.disable()
+    assert stage_tracer.span('stage') is NOOP_SPAN
+
+
 if __name__ == "__main__":
     print("🚀 Starting Advanced Reranking Tests...")
 
@@ -178,7 +822,7 @@ if __name__ == "__main__":
     print(f"\n{'=' * 80}")
     print("📊 PERFORMANCE BENCHMARK")
     print(f"{'=' * 80}")
-    metrics = test_performance_benchmark()
+    metrics = run_performance_benchmark()
 
     print(f"\n🎯 FINAL RESULTS:")
     print(f"   Queries improved by reranking: {metrics['average_improvements']['positive_percentage']:.1f}%")
@@ -188,4 +832,7 @@ if __name__ == "__main__":
     if metrics['average_improvements']['positive_percentage'] > 70:
         print(f"✅ Reranking is working well!")
     else:
-        print(f"⚠️ Consider tuning reranking parameters or trying different models")
\ No newline at end of file
+        print(f"⚠️ Consider tuning reranking parameters or trying different models")
+
+    # Every setup_test_system() call above shared the same model instances
+    default_registry.print_stats()